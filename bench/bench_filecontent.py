@@ -0,0 +1,81 @@
+"""
+Compare cache hit throughput of the mmap backed FileContent against the
+original 4k chunked read loop.
+
+The read loop is also run with FileContent's 256k chunks, so the gain of
+larger chunks shows apart from the gain of mmap.
+
+Usage::
+
+    python bench/bench_filecontent.py [size_mb] [repeat]
+"""
+import os
+import sys
+import time
+from tempfile import NamedTemporaryFile
+
+from fragrant.contrib.httpcache import FileContent
+
+class ChunkedContent(object):
+    """
+    The pre-mmap hit path: read() and yield 4096 bytes at a time.
+    """
+    readsize = 4096
+
+    def __init__(self, f, range):
+        self.range = range
+        self.f = f
+
+    def __iter__(self):
+        self.f.seek(self.range[0])
+        remaining = (self.range[1] - self.range[0]) + 1
+        while remaining:
+            output = self.f.read(min(self.readsize, remaining))
+            if not output:
+                break
+            yield output
+            remaining -= len(output)
+        self.f.close()
+
+class LargeChunkedContent(ChunkedContent):
+    """
+    The read loop with the chunk size of FileContent.
+    """
+    readsize = FileContent.readsize
+
+def consume(content):
+    total = 0
+    for chunk in content:
+        total += len(chunk)
+    return total
+
+def run(cls, path, size, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        sent = consume(cls(open(path, 'rb'), (0, size - 1)))
+        elapsed = time.time() - start
+        assert sent == size
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(argv):
+    size = int(argv[1] if len(argv) > 1 else 512) * 1024 * 1024
+    repeat = int(argv[2] if len(argv) > 2 else 3)
+
+    f = NamedTemporaryFile(delete=False)
+    try:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size // len(block)):
+            f.write(block)
+        f.close()
+
+        for name, cls in [('chunked-4k', ChunkedContent), ('chunked-256k', LargeChunkedContent),
+                ('mmap-256k', FileContent)]:
+            elapsed = run(cls, f.name, size, repeat)
+            print('%-12s %8.1f MB/s' % (name, size / elapsed / (1024 * 1024)))
+    finally:
+        os.unlink(f.name)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,101 @@
+"""
+Compare write paths of a cache fill: the original 4k read, write and flush
+loop against larger reads and writes with the temp file preallocated, and
+the cost of the fsync policies.
+
+Each configuration streams size_mb of in-memory "upstream" data through
+CacheFill and StreamingDownload into a fresh cache directory. Throughput is
+reported until the file is in place and again including writeback, along
+with the extents of the result when filefrag is installed.
+
+Usage::
+
+    python bench/bench_fill.py [size_mb] [repeat] [dir]
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fragrant.contrib.httpcache import CacheFill, HttpCache, Response, StreamingDownload
+
+MB = 1024 * 1024
+
+CONFIGS = [
+    ('4k', dict(read_size=4096, write_size=4096, fallocate=False)),
+    ('64k', dict(read_size=64 * 1024, write_size=64 * 1024, fallocate=False)),
+    ('64k-fallocate', dict(read_size=64 * 1024, write_size=64 * 1024, fallocate=True)),
+    ('1m-fallocate', dict(read_size=MB, write_size=MB, fallocate=True)),
+    ('1m-fsync-file', dict(read_size=MB, write_size=MB, fallocate=True, fsync='file')),
+]
+
+class MemoryUpstream(object):
+    """
+    Enough of an upstream response for StreamingDownload, size bytes of a
+    repeated block.
+    """
+    def __init__(self, size, block):
+        self.remaining = size
+        self.block = block
+
+    def read(self, amt):
+        amt = min(amt, self.remaining)
+        self.remaining -= amt
+        if amt <= len(self.block):
+            return self.block[:amt]
+        return (self.block * (amt // len(self.block) + 1))[:amt]
+
+    def close(self):
+        pass
+
+def extents(path):
+    try:
+        output = subprocess.check_output(['filefrag', path], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r'(\d+) extents? found', output)
+    return int(match.group(1)) if match else None
+
+def run(root, options, size, block):
+    cache_dir = tempfile.mkdtemp(dir=root)
+    try:
+        app = HttpCache({}, cache_dir, **options)
+        path = os.path.join(cache_dir, 'm', 'file.bin')
+        os.makedirs(os.path.dirname(path))
+
+        start = time.time()
+        fill = CacheFill(path, app)
+        fill.start(Response('application/octet-stream', size), app.write_size)
+        StreamingDownload(fill, MemoryUpstream(size, block), app.read_size).run()
+        assert fill.finished and os.path.getsize(path) == size
+        written = time.time() - start
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        synced = time.time() - start
+        return written, synced, extents(path)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+def main(argv):
+    size = int(argv[1] if len(argv) > 1 else 2048) * MB
+    repeat = int(argv[2] if len(argv) > 2 else 3)
+    root = argv[3] if len(argv) > 3 else None
+    block = os.urandom(MB)
+
+    print('%-16s %10s %10s %8s' % ('', 'MB/s', 'synced', 'extents'))
+    for name, options in CONFIGS:
+        results = [run(root, options, size, block) for _ in range(repeat)]
+        written = min(result[0] for result in results)
+        synced = min(result[1] for result in results)
+        print('%-16s %10.1f %10.1f %8s' % (name, size / written / MB, size / synced / MB,
+            results[-1][2] if results[-1][2] is not None else '-'))
+
+if __name__ == '__main__':
+    main(sys.argv)
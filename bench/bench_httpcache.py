@@ -0,0 +1,283 @@
+"""
+Load test HttpCache against a local stand-in for an upstream mirror.
+
+Starts a fake upstream and ``httpcache.start`` on local ports in a fresh
+cache directory, runs client scenarios against them in order and prints a
+JSON document with throughput, latency percentiles and upstream request
+counts per scenario, so runs can be compared.
+
+Scenarios:
+
+    cold_miss    distinct files fetched once each
+    warm_hit     the cold_miss files again
+    range_hit    random ranges of a cached large file
+    small_files  many tiny files, cold
+    huge_files   a few huge files, cold
+    coalesced    many clients fetching the same uncached file at once
+
+Usage::
+
+    python bench/bench_httpcache.py [--scenarios cold_miss,warm_hit] [--workers 2]
+        [--upstream-latency 0.05] [-o memory_cache=...] [--output run.json]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import eventlet
+from eventlet import wsgi
+from eventlet.green import httplib
+
+from fragrant.contrib import httpcache
+
+MB = 1024 * 1024
+
+# Upstream file contents repeat this block, see FakeUpstream
+PATTERN = ''.join(chr(i % 251) for i in xrange(MB))
+
+class FakeUpstream(object):
+    """
+    WSGI stand-in for a mirror serving /<name>-<size>.bin of that many bytes.
+
+    Supports ranges and validators like a real mirror, optionally with a
+    latency per request and a bandwidth per connection. /_counts reports the
+    requests and bytes served.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.bytes = 0
+
+    def __call__(self, environ, start_response):
+        path = environ['PATH_INFO']
+        if path == '/_counts':
+            body = json.dumps({'requests': self.requests, 'bytes': self.bytes})
+            start_response('200 OK', [('Content-Length', str(len(body)))])
+            return [body]
+
+        self.requests += 1
+        try:
+            size = int(path.rsplit('-', 1)[1].split('.')[0])
+        except (IndexError, ValueError):
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return ['']
+
+        if self.latency:
+            eventlet.sleep(self.latency)
+
+        headers = [('ETag', '"%s"' % path), ('Accept-Ranges', 'bytes'),
+            ('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')]
+        start, end = 0, size - 1
+        http_range = environ.get('HTTP_RANGE')
+        if http_range and environ.get('HTTP_IF_RANGE', headers[0][1]) == headers[0][1]:
+            first, last = http_range.split('=', 1)[1].split('-')
+            start, end = int(first), min(int(last or end), end)
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+            status = '206 Partial Content'
+        else:
+            status = '200 OK'
+
+        start_response(status, headers + [('Content-Length', str(end + 1 - start))])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return ['']
+        return self._body(start, end)
+
+    def _body(self, start, end):
+        pos = start
+        while pos <= end:
+            offset = pos % MB
+            chunk = PATTERN[offset:offset + min(self.chunk_size, end + 1 - pos)]
+            yield chunk
+            pos += len(chunk)
+            self.bytes += len(chunk)
+            if self.bandwidth:
+                eventlet.sleep(float(len(chunk)) / self.bandwidth)
+
+def fork_upstream(port, latency, bandwidth):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            wsgi.server(eventlet.listen(('127.0.0.1', port)), FakeUpstream(latency, bandwidth),
+                log_output=False, custom_pool=eventlet.GreenPool(1000))
+        finally:
+            os._exit(0)
+    return pid
+
+def upstream_counts(port):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/_counts')
+    counts = json.loads(conn.getresponse().read())
+    conn.close()
+    return counts
+
+def wait_for(port):
+    for _ in xrange(100):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            conn.request('HEAD', '/m/probe-1.bin')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except IOError:
+            eventlet.sleep(0.1)
+    raise IOError('Nothing listening on port %d' % port)
+
+def client(port, requests, results):
+    """
+    Run (path, range) requests over one keep-alive connection.
+    """
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    for path, range in requests:
+        headers = {'Range': 'bytes=%d-%d' % range} if range else {}
+        start = time.time()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            size = 0
+            for chunk in iter(lambda: response.read(256 * 1024), ''):
+                size += len(chunk)
+            ok = response.status in (200, 206)
+        except (IOError, httplib.HTTPException):
+            conn.close()
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            size, ok = 0, False
+        results.append((time.time() - start, size, ok))
+    conn.close()
+
+def run(port, upstream_port, requests, concurrency):
+    """
+    Spread requests over concurrency clients, summarize the results.
+    """
+    before = upstream_counts(upstream_port)
+    results = []
+    pool = eventlet.GreenPool(concurrency)
+    start = time.time()
+    for i in xrange(concurrency):
+        pool.spawn(client, port, requests[i::concurrency], results)
+    pool.waitall()
+    elapsed = time.time() - start
+    after = upstream_counts(upstream_port)
+
+    latencies = sorted(latency for latency, size, ok in results)
+    total = sum(size for latency, size, ok in results)
+    percentile = lambda q: latencies[int(round(q * (len(latencies) - 1)))] if latencies else None
+    return {
+        'requests': len(results),
+        'errors': sum(1 for latency, size, ok in results if not ok),
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'requests_per_second': len(results) / elapsed,
+        'mb_per_second': total / elapsed / MB,
+        'bytes': total,
+        'latency_p50': percentile(0.5),
+        'latency_p99': percentile(0.99),
+        'latency_max': latencies[-1] if latencies else None,
+        'upstream_requests': after['requests'] - before['requests'],
+        'upstream_bytes': after['bytes'] - before['bytes'],
+    }
+
+def scenarios(args):
+    """
+    Yield (name, requests to prime the cache with, requests, concurrency).
+    """
+    cold = ['/m/cold/file%d-%d.bin' % (i, args.file_size) for i in xrange(args.files)]
+    big = '/m/range/big-%d.bin' % (args.huge_size)
+    span = args.range_size
+    ranges = [random.randrange(0, args.huge_size - span) for _ in xrange(args.files)]
+
+    yield 'cold_miss', [], [(path, None) for path in cold], args.concurrency
+    yield 'warm_hit', [(path, None) for path in cold], [(path, None) for path in cold], args.concurrency
+    yield 'range_hit', [(big, None)], [(big, (start, start + span - 1)) for start in ranges], args.concurrency
+    yield 'small_files', [], [('/m/small/file%d-%d.bin' % (i, args.small_size), None)
+        for i in xrange(args.small_files)], args.concurrency
+    yield 'huge_files', [], [('/m/huge/file%d-%d.bin' % (i, args.huge_size), None)
+        for i in xrange(args.huge_files)], args.huge_files
+    yield 'coalesced', [], [('/m/coalesced/file-%d.bin' % args.coalesced_size, None)] * args.coalesced, args.coalesced
+
+def option(value):
+    name, value = value.split('=', 1)
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', default=None, help='comma separated, default all')
+    parser.add_argument('--port', type=int, default=18996)
+    parser.add_argument('--upstream-port', type=int, default=18997)
+    parser.add_argument('--workers', type=int, default=1, help='HttpCache worker processes')
+    parser.add_argument('-o', '--option', type=option, action='append', default=[],
+        help='HttpCache option as name=json, e.g. -o index=true')
+    parser.add_argument('--upstream-latency', type=float, default=0.0, help='seconds per request')
+    parser.add_argument('--upstream-bandwidth', type=float, default=0.0, help='MB/s per connection, 0 unlimited')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=256 * 1024)
+    parser.add_argument('--range-size', type=int, default=64 * 1024)
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--small-size', type=int, default=2048)
+    parser.add_argument('--huge-files', type=int, default=2)
+    parser.add_argument('--huge-size', type=int, default=256 * MB)
+    parser.add_argument('--coalesced', type=int, default=50, help='clients')
+    parser.add_argument('--coalesced-size', type=int, default=32 * MB)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='keep HttpCache info logging')
+    args = parser.parse_args(argv[1:])
+    random.seed(args.seed)
+    if not args.verbose:
+        logging.getLogger('httpcache').setLevel(logging.WARNING)
+    selected = args.scenarios and args.scenarios.split(',')
+
+    cache_dir = tempfile.mkdtemp(prefix='bench-httpcache-')
+    upstream_pid = fork_upstream(args.upstream_port, args.upstream_latency, args.upstream_bandwidth * MB)
+    stop = httpcache.start({'m': 'http://127.0.0.1:%d' % args.upstream_port}, cache_dir, port=args.port,
+        workers=args.workers, **dict(args.option))
+    report = {
+        'config': dict(vars(args), option=dict(args.option), time=time.time()),
+        'scenarios': {},
+    }
+    try:
+        wait_for(args.port)
+        for name, prime, requests, concurrency in scenarios(args):
+            if selected and name not in selected:
+                continue
+            if prime:
+                run(args.port, args.upstream_port, prime, concurrency)
+            report['scenarios'][name] = result = run(args.port, args.upstream_port, requests, concurrency)
+            print >>sys.stderr, '%-12s %8.1f req/s %8.1f MB/s  p50 %.4fs  p99 %.4fs  upstream %d' % (
+                name, result['requests_per_second'], result['mb_per_second'],
+                result['latency_p50'], result['latency_p99'], result['upstream_requests'])
+    finally:
+        os.kill(upstream_pid, signal.SIGTERM)
+        if args.workers:
+            stop()
+        # Reap the upstream and the workers stop() terminates, a server
+        # thread goes away with this process
+        while 1:
+            try:
+                os.wait()
+            except OSError:
+                break
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main(sys.argv)
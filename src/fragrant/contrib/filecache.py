@@ -1,21 +1,31 @@
 import hashlib
-from tempfile import NamedTemporaryFile
 import urllib2
 import os
-import shutil
+import errno
+import fcntl
+import time
 
 import logging
 
+from fragrant.exceptions import Timeout
+
 log = logging.getLogger(__name__)
 
 class FileCache(object):
     """
     Cache remote files locally.
+
+    Safe to share between processes. A lock file per cached file makes sure
+    only one process downloads it while the others wait and use the result.
     """
     readsize = 4096
+    # Seconds between attempts to take a download lock
+    poll_interval = 0.1
 
-    def __init__(self, cache_dir):
+    def __init__(self, cache_dir, lock_timeout=3600):
         self.cache_dir = cache_dir
+        # Seconds to wait for another process downloading the same file
+        self.lock_timeout = lock_timeout
 
     def get(self, url):
         filename = os.path.basename(url)
@@ -23,38 +33,112 @@ class FileCache(object):
         path = os.path.join(self.cache_dir, '%s-%s' % (hashlib.sha1(url).hexdigest(), filename))
 
         if not os.path.exists(path):
-            self._download(url, path)
+            lock = self._lock(path)
+            try:
+                # Another process may have downloaded it while we waited
+                if not os.path.exists(path):
+                    self._download(url, path)
+            finally:
+                self._unlock(lock)
 
         return path
 
+    def _lock(self, path):
+        """
+        Take the download lock of path, waiting up to lock_timeout seconds.
+
+        Locks are flock()s, which the kernel releases when their holder dies.
+        Holders remove the lock file before unlocking, so finding one with a
+        pid in it means that process crashed mid download.
+        """
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        lock_path = path + '.lock'
+        deadline = time.time() + self.lock_timeout
+        while 1:
+            f = open(lock_path, 'a+b')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                elif time.time() >= deadline:
+                    raise Timeout('Waiting for download of %s by pid %s timed out' % (path, self._holder(lock_path)))
+                time.sleep(self.poll_interval)
+                continue
+
+            # The holder we waited for removed this file, retry on the new one
+            try:
+                if os.fstat(f.fileno()).st_ino != os.stat(lock_path).st_ino:
+                    f.close()
+                    continue
+            except OSError:
+                f.close()
+                continue
+
+            f.seek(0)
+            crashed = f.read().strip()
+            if crashed:
+                log.warning('Cleaning up after download of %s by pid %s that did not finish', path, crashed)
+                self._remove(path + '.tmp')
+            f.truncate(0)
+            f.write(str(os.getpid()))
+            f.flush()
+            return f
+
+    def _unlock(self, f):
+        self._remove(f.name)
+        f.close()
+
+    def _holder(self, lock_path):
+        try:
+            with open(lock_path, 'rb') as f:
+                return f.read().strip() or 'unknown'
+        except IOError:
+            return 'unknown'
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def _download(self, url, path):
         fetch_request = urllib2.Request(url)
 
 
         remote_file = urllib2.urlopen(fetch_request)
 
+        # Beside the cached file so it can be renamed into place atomically
+        tmp_path = path + '.tmp'
         try:
             log.info('Caching "%s" as "%s"', url, path)
 
-            dir = os.path.dirname(path)
-            if not os.path.exists(dir):
-                os.makedirs(dir)
-
             filesize = int(remote_file.info().getheader('Content-Length', 0))
 
-            outfile = NamedTemporaryFile('wb', self.readsize, delete=False)
-            read = 0
-            while 1:
-                bytes = remote_file.read(self.readsize)
-                if not bytes:
-                    break
-
-                outfile.write(bytes)
-                read += len(bytes)
-            outfile.close()
-            
+            with open(tmp_path, 'wb', self.readsize) as outfile:
+                read = 0
+                while 1:
+                    bytes = remote_file.read(self.readsize)
+                    if not bytes:
+                        break
+
+                    outfile.write(bytes)
+                    read += len(bytes)
+
             log.debug('Read %d bytes', read)
+            if filesize and read != filesize:
+                raise IOError('Download of %s ended after %d of %d bytes' % (url, read, filesize))
 
-            shutil.move(outfile.name, path)
+            os.rename(tmp_path, path)
+        except:
+            self._remove(tmp_path)
+            raise
         finally:
             remote_file.close()
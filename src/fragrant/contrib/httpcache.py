@@ -6,9 +6,48 @@ import logging
 import posixpath
 import urllib
 import re
+import mmap
+import json
+import stat
+import time
+import fnmatch
+import heapq
+import marshal
+import errno
+import struct
+import fcntl
+import signal
+import email.utils
+import gzip
+import hashlib
+import xml.etree.cElementTree as ElementTree
 from BaseHTTPServer import BaseHTTPRequestHandler
 from eventlet.green import urllib2
+from eventlet.green import httplib
+from eventlet.green import socket
+from eventlet.event import Event
+from eventlet.queue import Queue, Empty
+from eventlet.semaphore import Semaphore
+from eventlet.hubs import trampoline
+from StringIO import StringIO
+import urlparse
 import thread
+from collections import OrderedDict, deque
+from contextlib import closing
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate_call = getattr(_libc, 'fallocate64', None) or _libc.fallocate
+    _fallocate_call.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (ImportError, OSError, AttributeError):
+    _fallocate_call = None
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('httpcache')
@@ -17,17 +56,147 @@ __doc__ = """
 An Eventlet based HTTP pass-through mirror.
 
 Will transparently mirror files locally. Files that do not exist will be fetched
-from the remote server and persisted locally. Range requests work by caching the range
-as a separate file.
+from the remote server and persisted locally. Range requests are cached as blocks of
+a sparse copy of the full file, which becomes a normal cached file once every block
+has been fetched.
 """
 
+# Suffixes of the cache's own bookkeeping files
+INTERNAL_SUFFIXES = ('.tmp', '.partial', '.blocks', '.meta', '.access-index', '.access-journal', '.lock',
+    '.progress', '.gzip', '.pack', '.pack-index', '.status')
+
+# Suffixes of files kept to resume interrupted fetches
+RESUMABLE_SUFFIXES = ('.tmp', '.progress', '.partial', '.blocks')
+
+# Namespaces of yum repository metadata
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+
+# Python 2 does not define SO_REUSEPORT, this is the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# fallocate(2) mode reserving blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 1
+
+def _makedirs(dir):
+    """
+    Create dir and its parents, other processes may be doing the same.
+    """
+    try:
+        os.makedirs(dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _shared_inode(fs):
+    """
+    Identity of the file with stat result fs if it has other links, or None.
+    """
+    if fs.st_nlink > 1:
+        return fs.st_dev, fs.st_ino
+
+def _fallocate(f, offset, length):
+    """
+    Reserve disk blocks for length bytes of f from offset, leaving its size
+    alone. Returns False where the platform or filesystem can't.
+    """
+    if _fallocate_call is None or length <= 0:
+        return False
+    elif _fallocate_call(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length):
+        log.debug('Could not preallocate %d bytes of %s: %s', length, f.name,
+            os.strerror(ctypes.get_errno()))
+        return False
+    return True
+
+def _fsync_dir(dir):
+    fd = os.open(dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _try_lock(path):
+    """
+    Take an exclusive lock on path without blocking.
+
+    Returns the open lock file, or None if another process holds the lock.
+    """
+    while 1:
+        f = open(path, 'a+b')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+
+        # Holders unlink the lock file before unlocking, retry if we got an old one
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                return f
+        except OSError:
+            pass
+        f.close()
+
+def _unlock(f):
+    """
+    Release a lock taken with _try_lock.
+    """
+    os.unlink(f.name)
+    f.close()
+
+def _locked(path):
+    """
+    Return True if another process holds the lock on path.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return False
+
+    try:
+        fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except IOError:
+        return True
+    finally:
+        f.close()
+    return False
+
+def _flock(f, poll_interval=0.01):
+    """
+    Take an exclusive lock on the open file f, sleeping between tries so a
+    holder in another process does not block the hub.
+    """
+    while 1:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        eventlet.sleep(poll_interval)
+
+# Upstream response headers kept in the .meta sidecar of a cached file
+META_HEADERS = ('ETag', 'Last-Modified')
+
+# Key of the .meta sidecar recording when upstream last confirmed a cached
+# file is current, its mtime stays when the file was stored
+VALIDATED_META = 'validated'
+
+# Marks requests from a peer cache, see Peers
+PEER_HEADER = 'X-Fragrant-Peer'
+PEER_ENVIRON = 'HTTP_' + PEER_HEADER.upper().replace('-', '_')
+
 class Response(object):
     FULL_RANGE = (0, -1)
     
-    def __init__(self, content_type, size, range=None):
+    def __init__(self, content_type, size, range=None, headers=None):
         self._range = range or self.FULL_RANGE
         self.content_type = content_type
         self.size = size
+        # Further headers such as validators
+        self.extra_headers = headers or []
         
     @property
     def status(self):
@@ -49,7 +218,7 @@ class Response(object):
         if self._range[1] == -1:
             return self.size - 1
         else:
-            return self._range[1]
+            return min(self._range[1], self.size - 1)
 
     @property
     def content_length(self):
@@ -60,83 +229,3055 @@ class Response(object):
         headers = [
             ('Content-Length', str(self.content_length)),
         ]
+        if self.content_type:
+            headers.append(('Content-Type', self.content_type))
         
         if self.status == 206:
             headers.append(('Content-Range', 'bytes %d-%d/%d' % (self.content_start, self.content_end, self.size)))
-        
+
+        headers.extend(self.extra_headers)
         return headers
     
-class FileContent(object):
-    readsize = 4096
-    
-    def __init__(self, f, range):
-        self.range = range
-        self.f = f
-                    
+class PooledResponse(object):
+    """
+    An upstream response on a pooled connection.
+
+    Looks enough like a urllib2 response for the cache. Closing it hands the
+    connection back to the pool if the body was read to the end.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.bytes_read = 0
+        # Called with the response once it is closed
+        self.on_close = None
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        bytes = self._response.read(amt)
+        self.bytes_read += len(bytes)
+        return bytes
+
+    def close(self):
+        if self._conn is None:
+            return
+        elif self.on_close:
+            self.on_close(self)
+
+        response = self._response
+        if not response.isclosed() and response.length == 0:
+            # Nothing left to read (HEAD, 304), drain so the connection is reusable
+            response.read()
+
+        reusable = response.isclosed() and not response.will_close
+        self._pool._release(self._key, self._conn, reusable)
+        self._conn = None
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP/1.1 connections to upstream hosts.
+
+    Up to ``max_per_host`` connections are open to a host at once, requests
+    beyond that wait for a free connection. At most ``max_idle`` connections
+    per host are kept open between requests.
+    """
+    max_redirects = 5
+
+    def __init__(self, max_idle=4, max_per_host=20, timeout=60):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        # Connections opened and requests sent on an already open connection
+        self.created = 0
+        self.reused = 0
+
+        self._idle = {}
+        self._limits = {}
+
+    def stats(self):
+        return dict(
+            created=self.created,
+            reused=self.reused,
+            idle=sum(len(conns) for conns in self._idle.values()),
+        )
+
+    def urlopen(self, url, headers=None, method='GET'):
+        """
+        Request url, following redirects.
+
+        Raises urllib2.HTTPError for error statuses like urllib2.urlopen does.
+        """
+        for _ in xrange(self.max_redirects + 1):
+            response = self._request(url, headers or {}, method)
+            if response.code in (301, 302, 303, 307) and response.info().getheader('Location', None):
+                location = response.info().getheader('Location')
+                response.read()
+                response.close()
+                url = urlparse.urljoin(url, location)
+                continue
+
+            if response.code >= 400:
+                body = response.read()
+                response.close()
+                raise urllib2.HTTPError(url, response.code, response.msg, response.info(), StringIO(body))
+
+            return response
+
+        raise urllib2.HTTPError(url, 502, 'Too many redirects', None, StringIO(''))
+
+    def _request(self, url, headers, method):
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        key = (scheme, netloc)
+
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = Semaphore(self.max_per_host)
+        limit.acquire()
+
+        try:
+            idle = self._idle.get(key)
+            while idle:
+                conn = idle.pop()
+                try:
+                    conn.request(method, path or '/', headers=headers)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, socket.error):
+                    # Server closed the idle connection, try the next one
+                    conn.close()
+                    continue
+
+                self.reused += 1
+                return PooledResponse(self, key, conn, response, url)
+
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self.created += 1
+
+            try:
+                conn.request(method, path or '/', headers=headers)
+                response = conn.getresponse()
+            except:
+                conn.close()
+                raise
+
+            return PooledResponse(self, key, conn, response, url)
+        except:
+            limit.release()
+            raise
+
+    def _release(self, key, conn, reusable):
+        idle = self._idle.setdefault(key, [])
+        if reusable and len(idle) < self.max_idle:
+            idle.append(conn)
+        else:
+            conn.close()
+        self._limits[key].release()
+
+class Stats(object):
+    """
+    Counters, gauges and histograms exported in the Prometheus text format.
+
+    Updating a counter is a single dict operation so it is cheap enough for
+    the request path.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    descriptions = {
+        'httpcache_requests_total' : ('counter', 'Requests by mirror and result (hit, miss, peer, partial, coalesced, negative, error)'),
+        'httpcache_cache_bytes_total' : ('counter', 'Bytes served from the cache'),
+        'httpcache_upstream_bytes_total' : ('counter', 'Bytes fetched from upstream'),
+        'httpcache_upstream_ttfb_seconds' : ('histogram', 'Time until upstream response headers arrive'),
+        'httpcache_upstream_seconds' : ('histogram', 'Total time of upstream responses'),
+        'httpcache_queue_wait_seconds' : ('histogram', 'Time requests waited for a lane slot'),
+        'httpcache_shed_total' : ('counter', 'Requests answered 503 because their lane was full'),
+    }
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+    def render(self, values=()):
+        """
+        Render all metrics plus (name, type, description, value) values read
+        from elsewhere at render time.
+        """
+        lines = []
+        described = set()
+
+        def describe(name, type, description):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s %s' % (name, type))
+
+        def format_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+        for (name, labels), value in sorted(self.counters.items()):
+            describe(name, *self.descriptions.get(name, ('counter', name)))
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+            describe(name, *self.descriptions.get(name, ('histogram', name)))
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %f' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+
+        for name, type, description, value in values:
+            describe(name, type, description)
+            lines.append('%s %s' % (name, value))
+
+        return '\n'.join(lines) + '\n'
+
+class Upstream(object):
+    """
+    One base URL serving a mirror, with its health and latency record.
+
+    Latency is the time until response headers arrive. An upstream that
+    fails is ejected for ``cooldown`` seconds.
+    """
+    cooldown = 30
+    samples = 100
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.latencies = deque(maxlen=self.samples)
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __repr__(self):
+        return '<Upstream %s>' % self.base_url
+
+    @property
+    def healthy(self):
+        return time.time() >= self.ejected_until
+
+    @property
+    def latency(self):
+        """
+        Mean recent latency, 0 for an upstream not tried yet.
+        """
+        if not self.latencies:
+            return 0
+        return sum(self.latencies) / len(self.latencies)
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+    def succeeded(self, elapsed):
+        self.latencies.append(elapsed)
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+        self.ejected_until = time.time() + self.cooldown
+        log.warning('Ejecting %s for %d seconds after %d failures', self.base_url, self.cooldown, self.failures)
+
+class Mirror(object):
+    """
+    The upstreams serving one mirror name.
+
+    Requests go to the fastest healthy upstream. If it has not answered
+    within its p95 latency a hedged request goes to the next one and the
+    first answer wins. Connection errors and 5xx responses fail over to the
+    remaining upstreams and eject the upstream that failed.
+    """
+    # Hedge delay used until an upstream has latency samples
+    default_hedge_delay = 1.0
+    min_hedge_delay = 0.05
+
+    def __init__(self, base_urls, hedge=True):
+        if isinstance(base_urls, basestring):
+            base_urls = [base_urls]
+        self.upstreams = [Upstream(base_url) for base_url in base_urls]
+        self.hedge = hedge
+
+    def ranked(self):
+        """
+        Healthy upstreams fastest first, followed by ejected ones as a last resort.
+        """
+        return sorted(self.upstreams, key=lambda upstream: (not upstream.healthy, upstream.latency))
+
+    def hedge_delay(self, upstream):
+        delay = upstream.percentile(0.95)
+        if delay is None:
+            return self.default_hedge_delay
+        return max(delay, self.min_hedge_delay)
+
+    def urlopen(self, pool, url, headers=None, method='GET'):
+        """
+        Request url from the best upstream. Raises like ConnectionPool.urlopen.
+        """
+        candidates = self.ranked()
+        results = Queue()
+        in_flight = [0]
+        started = {}
+
+        def attempt(upstream):
+            start = time.time()
+            try:
+                response = pool.urlopen(upstream.base_url + url, headers, method)
+            except urllib2.HTTPError as e:
+                if e.code >= 500:
+                    upstream.failed()
+                else:
+                    upstream.succeeded(time.time() - start)
+                results.put((upstream, None, e))
+            except Exception as e:
+                log.warning('Request to %s failed: %s', upstream.base_url, e)
+                upstream.failed()
+                results.put((upstream, None, e))
+            else:
+                upstream.succeeded(time.time() - start)
+                results.put((upstream, response, None))
+
+        def launch():
+            upstream = candidates.pop(0)
+            started[upstream] = time.time()
+            in_flight[0] += 1
+            eventlet.spawn_n(attempt, upstream)
+            return upstream
+
+        def discard_late(count):
+            for _ in xrange(count):
+                upstream, response, error = results.get()
+                if response:
+                    response.close()
+
+        primary = launch()
+        hedged = False
+        error = None
+        while in_flight[0]:
+            timeout = None
+            if self.hedge and not hedged and candidates:
+                timeout = self.hedge_delay(primary)
+
+            try:
+                upstream, response, error = results.get(timeout=timeout)
+            except Empty:
+                log.debug('%s slower than %.3fs, hedging', primary.base_url, timeout)
+                hedged = True
+                launch()
+                continue
+
+            in_flight[0] -= 1
+            del started[upstream]
+            if response or (isinstance(error, urllib2.HTTPError) and error.code < 500):
+                if in_flight[0]:
+                    # Lost the race, count the time so far against the slower upstreams
+                    for slower, start in started.items():
+                        slower.latencies.append(time.time() - start)
+                    eventlet.spawn_n(discard_late, in_flight[0])
+
+                if response:
+                    return response
+                raise error
+
+            if candidates and not in_flight[0]:
+                launch()
+
+        raise error
+
+class Peers(object):
+    """
+    Sibling caches asked for a file before going upstream.
+
+    On a miss every healthy peer gets a HEAD marked with PEER_HEADER, which
+    a peer answers from complete cached files only, so lookups never travel
+    further. The file is fetched from the first peer to answer 200 within
+    ``timeout`` seconds. A peer that fails or times out is ejected for
+    Upstream.cooldown seconds, a dead peer costs one timeout per cooldown.
+    """
+    def __init__(self, base_urls, timeout=0.25, connection_pool=None):
+        self.peers = [Upstream(base_url.rstrip('/')) for base_url in base_urls]
+        self.timeout = timeout
+        self.connection_pool = connection_pool or ConnectionPool(max_idle=2, timeout=10)
+
+    def urlopen(self, mirror_name, url):
+        """
+        Fetch url of mirror_name from a peer that has it, or return None.
+        """
+        candidates = [peer for peer in self.peers if peer.healthy]
+        results = Queue()
+
+        def lookup(peer):
+            start = time.time()
+            try:
+                with eventlet.Timeout(self.timeout):
+                    self._request(peer, mirror_name, url, 'HEAD').close()
+            except urllib2.HTTPError as e:
+                if e.code >= 500:
+                    peer.failed()
+                else:
+                    peer.succeeded(time.time() - start)
+                results.put(None)
+            except eventlet.Timeout:
+                log.warning('Lookup on peer %s timed out', peer.base_url)
+                peer.failed()
+                results.put(None)
+            except Exception as e:
+                log.warning('Lookup on peer %s failed: %s', peer.base_url, e)
+                peer.failed()
+                results.put(None)
+            else:
+                peer.succeeded(time.time() - start)
+                results.put(peer)
+
+        for peer in candidates:
+            eventlet.spawn_n(lookup, peer)
+
+        for _ in candidates:
+            peer = results.get()
+            if peer is None:
+                continue
+
+            try:
+                return self._request(peer, mirror_name, url)
+            except Exception as e:
+                log.warning('Fetch from peer %s failed: %s', peer.base_url, e)
+                peer.failed()
+                return None
+
+    def _request(self, peer, mirror_name, url, method='GET'):
+        return self.connection_pool.urlopen('%s/%s%s' % (peer.base_url, mirror_name, url),
+            {PEER_HEADER : '1'}, method)
+
+class RequestLanes(object):
+    """
+    Admission control for requests, in a lane for small transfers and one
+    for large ones.
+
+    Each lane has its own slots, so a burst of ISO downloads cannot hold
+    every slot while repodata requests wait. Small requests also borrow idle
+    large slots, and a request of unknown size that turns out larger than
+    ``large_size`` moves over to the large lane once its response starts.
+
+    A request finding no free slot waits, up to ``max_queue`` requests for
+    at most ``max_wait`` seconds each. Past that it is shed with a 503 and
+    Retry-After instead of letting latency grow without bound.
+
+    With ``adaptive`` the configured slots are a ceiling. Every ``interval``
+    seconds a lane whose requests took more than ``tolerance`` times its
+    best latency to start responding loses a quarter of its slots, down to a
+    quarter of the configured ones, so the backlog waits in the queue rather
+    than on the disk or network. A lane that had requests queueing otherwise
+    gets one back.
+    """
+    interval = 5
+    tolerance = 2.0
+
+    def __init__(self, small_slots=32, large_slots=16, large_size=16 * 1024 * 1024, max_queue=256,
+        max_wait=30, retry_after=5, adaptive=True):
+        self.slots = {'small' : small_slots, 'large' : large_slots}
+        self.max_slots = dict(self.slots)
+        self.adaptive = adaptive
+        self.large_size = large_size
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.running = {'small' : 0, 'large' : 0}
+        # Events of waiting requests per lane, sent the lane of the slot granted
+        self.waiting = {'small' : deque(), 'large' : deque()}
+        # Per lane [latency sum, samples, queued] since the last adjustment,
+        # and the best average latency seen
+        self._window = {'small' : [0.0, 0, False], 'large' : [0.0, 0, False]}
+        self._best = {}
+        self._adjusted = time.time()
+
+    def classify(self, size):
+        """
+        Lane of a request expected to transfer size bytes. Requests of
+        unknown size (None) start out small.
+        """
+        return 'large' if size > self.large_size else 'small'
+
+    def acquire(self, lane):
+        """
+        Wait for a slot, returns the lane it belongs to or None if shed.
+        """
+        slot = self._free(lane)
+        if slot:
+            self.running[slot] += 1
+            return slot
+        elif sum(len(waiting) for waiting in self.waiting.values()) >= self.max_queue:
+            return None
+
+        granted = Event()
+        self.waiting[lane].append(granted)
+        self._window[lane][2] = True
+        with eventlet.Timeout(self.max_wait, False):
+            return granted.wait()
+
+        if granted.ready():
+            # Granted just as the wait timed out
+            return granted.wait()
+        self.waiting[lane].remove(granted)
+
+    def release(self, slot):
+        self.running[slot] -= 1
+        self._dispatch()
+
+    def observe(self, lane, latency):
+        """
+        Record how long an admitted request took to start responding.
+        """
+        window = self._window[lane]
+        window[0] += latency
+        window[1] += 1
+        if self.adaptive and time.time() - self._adjusted >= self.interval:
+            self._adjust()
+
+    def _adjust(self):
+        self._adjusted = time.time()
+        for lane, (total, samples, queued) in self._window.items():
+            self._window[lane] = [0.0, 0, False]
+            if not samples:
+                continue
+
+            latency = total / samples
+            # The best drifts up so a lasting change of workload is accepted
+            best = self._best[lane] = min(latency, self._best.get(lane, latency) * 1.1)
+            if latency > self.tolerance * best:
+                self.slots[lane] = max(self.max_slots[lane] // 4 or 1, self.slots[lane] * 3 // 4)
+            elif queued and self.slots[lane] < self.max_slots[lane]:
+                self.slots[lane] += 1
+        self._dispatch()
+
+    def promote(self, slot):
+        """
+        Move a running small request to the large lane, returns its new slot.
+
+        Never waits, the large lane may briefly run over its slots.
+        """
+        if slot == 'small':
+            self.running['large'] += 1
+            self.release('small')
+        return 'large'
+
+    def _free(self, lane):
+        for slot in (lane, 'large'):
+            if self.running[slot] < self.slots[slot]:
+                return slot
+
+    def _dispatch(self):
+        for lane in ('large', 'small'):
+            waiting = self.waiting[lane]
+            while waiting:
+                slot = self._free(lane)
+                if not slot:
+                    break
+                self.running[slot] += 1
+                waiting.popleft().send(slot)
+
+class LaneContent(object):
+    """
+    A response body holding a RequestLanes slot until it is closed.
+    """
+    def __init__(self, content, release):
+        self.content = content
+        self.release = release
+
     def __iter__(self):
-        self.f.seek(self.range[0])
+        return iter(self.content)
+
+    def close(self):
+        try:
+            if hasattr(self.content, 'close'):
+                self.content.close()
+        finally:
+            self.release()
+
+class MemoryCache(object):
+    """
+    Small cached files held in memory in front of the disk cache.
+
+    Keeps whole files up to ``max_object_size`` bytes along with their
+    precomputed full response, evicting least recently used files once
+    ``max_bytes`` is exceeded. Hits never touch the filesystem.
+    """
+    def __init__(self, max_bytes, max_object_size=256 * 1024):
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, path):
+        """
+        Return (data, status, headers) for path or None.
+        """
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return None
+        elif entry[3] is not None and entry[3] < time.time():
+            self.size -= len(entry[0])
+            return None
+
+        self._entries[path] = entry
+        return entry[:3]
+
+    def put(self, path, data, status, headers, expires=None):
+        """
+        Keep data for path, optionally only until the ``expires`` timestamp.
+        """
+        if len(data) > self.max_object_size:
+            return
+
+        self.discard(path)
+        self._entries[path] = (data, status, headers, expires)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted[0])
+
+    def discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+class CacheIndex(object):
+    """
+    In-memory index of cached files, path -> (size, mtime, content type).
+
+    Built by scanning cache_dir and kept current by the cache's own writes.
+    When pyinotify is installed changes made by other processes are picked up
+    too, and the index is trusted for misses as well as hits.
+    """
+    def __init__(self, cache_dir, guess_type):
+        self.cache_dir = cache_dir
+        self.guess_type = guess_type
+        self.watching = False
+        # Validator headers read from .meta sidecars, filled in on demand
+        self.meta = {}
+        self._files = {}
+
+    def scan(self):
+        for dir, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                self.add(os.path.join(dir, name))
+
+        log.info('Indexed %d cached files in %s', len(self._files), self.cache_dir)
+
+    def get(self, path):
+        return self._files.get(path)
+
+    def add(self, path):
+        if path.endswith('.meta'):
+            self.meta.pop(path[:-len('.meta')], None)
+        if path.endswith(INTERNAL_SUFFIXES):
+            return
+
+        self.meta.pop(path, None)
+        try:
+            fs = os.stat(path)
+        except OSError:
+            self.discard(path)
+        else:
+            self._files[path] = (fs.st_size, fs.st_mtime, self.guess_type(path))
+
+    def discard(self, path):
+        if path.endswith('.meta'):
+            path = path[:-len('.meta')]
+        self._files.pop(path, None)
+        self.meta.pop(path, None)
+
+    def watch(self):
+        """
+        Follow filesystem changes under cache_dir in a green thread, which is
+        returned.
+        """
+        if pyinotify is None:
+            log.info('pyinotify is not installed, changes outside the cache will not be indexed')
+            return
+
+        index = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.dir:
+                    return
+                elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                    index.discard(event.pathname)
+                else:
+                    index.add(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM \
+            | pyinotify.IN_DELETE | pyinotify.IN_CREATE
+        manager.add_watch(self.cache_dir, mask, rec=True, auto_add=True)
+        notifier = pyinotify.Notifier(manager, Handler(), timeout=0)
+
+        def run():
+            try:
+                while 1:
+                    trampoline(manager.get_fd(), read=True)
+                    notifier.read_events()
+                    notifier.process_events()
+            finally:
+                self.watching = False
+                notifier.stop()
+
+        self.watching = True
+        return eventlet.spawn(run)
+
+class DiskQuota(object):
+    """
+    Keeps the files in cache_dir under ``max_bytes`` by evicting them.
+
+    Last access time and hit count of each file are tracked in memory and
+    saved to a compact marshal index in cache_dir rather than relying on
+    atime. The index is a sequence of marshalled dicts, later ones win: each
+    save appends the records changed since the last one and the index is
+    rewritten once it holds mostly stale records.
+
+    Eviction runs in a green thread until the store is back under
+    ``low_water`` of the budget. Each pass orders the files once and both
+    that and rewriting the index yield to requests every ``chunk`` files.
+
+    Policies are ``lru`` (least recently used first) and ``lfu``, which
+    evicts files with the fewest hits per byte first.
+
+    Bytes of a file hardlinked under several cached paths are charged to one
+    of them, and passed on to another when that one goes.
+
+    A ``shared`` quota is kept by one of the worker processes sharing
+    cache_dir, the one holding the lock on ``.quota.lock``: only it scans,
+    evicts and writes the index, and only it counts size and evictions. The
+    others append the files they store and hit to a journal the keeper
+    replays every ``interval`` seconds, and take over when it exits. The
+    keeper re-scans cache_dir every ``rescan_interval`` seconds for changes
+    nobody reported.
+    """
+    policies = {
+        'lru' : lambda entry: entry[0],
+        'lfu' : lambda entry: float(entry[1]) / max(entry[2], 1),
+    }
+    low_water = 0.9
+    chunk = 10000
+    interval = 30
+    rescan_interval = 3600
+
+    def __init__(self, cache_dir, max_bytes, policy='lru', on_evict=None, exclude=(), packed=None, shared=False):
+        if policy not in self.policies:
+            raise ValueError('Unknown eviction policy %r' % policy)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # Called with the path of a file about to be evicted
+        self.on_evict = on_evict
+        # Directories below cache_dir that are not cached files, such as the
+        # root of a BlobStore
+        self.exclude = set(os.path.abspath(dir) for dir in exclude)
+        # Returns (path, size, mtime) of the files kept in a PackStorage
+        self.packed = packed
+        # Kept by one of the processes sharing cache_dir
+        self.shared = shared
+        self.size = 0
+        self.evicted = 0
+        # Bytes of interrupted fetches kept to resume, included in size
+        self.scratch = 0
+        self.index_path = os.path.join(cache_dir, '.access-index')
+        self.journal_path = os.path.join(cache_dir, '.access-journal')
+        self.lock_path = os.path.join(cache_dir, '.quota.lock')
+
+        # path -> [last access, hits, size]
+        self._entries = {}
+        # (device, inode) -> paths of files with several links, and back
+        self._links = {}
+        self._inodes = {}
+        # Paths whose records changed since the last save
+        self._changed = set()
+        # Records in the index file, stale ones included
+        self._journal = 0
+        # Lock on lock_path while this process keeps a shared quota
+        self._lock = None
+        # (path, access time, size, inode) records for the keeper, size is
+        # None for hits
+        self._pending = []
+        # When cache_dir was last scanned
+        self._scanned = 0
+        self._wakeup = Event()
+
+    @property
+    def keeper(self):
+        """
+        True if this process keeps the quota.
+        """
+        return not self.shared or self._lock is not None
+
+    def scan(self):
+        """
+        Account for the files in cache_dir and those kept in a PackStorage,
+        unless another worker keeps the quota.
+        """
+        if self.shared and self._lock is None:
+            self._lock = _try_lock(self.lock_path)
+            if self._lock is None:
+                log.debug('Another worker keeps the quota of %s', self.cache_dir)
+                return
+
+        self._reconcile(self._load())
+        log.info('Cache store holds %d bytes of %d allowed', self.size, self.max_bytes)
+
+    def _load(self):
+        """
+        Read the index, returns path -> (last access, hits).
+        """
+        saved = {}
+        try:
+            with open(self.index_path, 'rb') as f:
+                while 1:
+                    records = marshal.load(f)
+                    self._journal += len(records)
+                    for path, record in records.iteritems():
+                        if record is None:
+                            saved.pop(path, None)
+                        else:
+                            saved[path] = record
+        except (IOError, EOFError, ValueError, TypeError):
+            # End of the index, or a save cut short
+            pass
+        return saved
+
+    def _files(self):
+        """
+        Yield (path, size, mtime, inode) of the cached files, yielding to
+        requests after each directory.
+        """
+        for dir, dirs, files in os.walk(self.cache_dir):
+            dirs[:] = [name for name in dirs if os.path.abspath(os.path.join(dir, name)) not in self.exclude]
+            for name in files:
+                path = os.path.join(dir, name)
+                if path.endswith(INTERNAL_SUFFIXES):
+                    continue
+
+                try:
+                    fs = os.stat(path)
+                except OSError:
+                    continue
+
+                yield path, fs.st_size, fs.st_mtime, _shared_inode(fs)
+            eventlet.sleep(0)
+
+        for path, size, mtime in (self.packed() if self.packed else ()):
+            yield path, size, mtime, None
+
+    def _reconcile(self, saved):
+        """
+        Bring the records in line with the files on disk, saved holds the
+        (last access, hits) of files not tracked yet.
+        """
+        started = time.time()
+        found = set()
+        for path, size, mtime, inode in self._files():
+            found.add(path)
+            entry = self._entries.get(path)
+            if entry is None:
+                atime, hits = saved.get(path, (mtime, 0))
+                self._track(path, atime, hits, size, inode)
+            elif entry[2] != size and path not in self._inodes:
+                self.size += size - entry[2]
+                entry[2] = size
+
+        for path in self._entries.keys():
+            entry = self._entries.get(path)
+            # Files stored since the scan started may not have been seen
+            if entry and path not in found and entry[0] < started:
+                self.discard(path)
+        self._scanned = time.time()
+
+    def touch(self, path):
+        self._record(path, time.time())
+
+    def add(self, path, size, inode=None):
+        """
+        Account for a newly stored file, inode identifies it if it is
+        hardlinked, see _shared_inode().
+        """
+        self._record(path, time.time(), size, inode)
+        if self.size > self.max_bytes:
+            self._wake()
+
+    def _record(self, path, atime, size=None, inode=None):
+        """
+        Count a hit on path, or a store of size bytes. Left for the keeper if
+        that is another worker.
+        """
+        if not self.keeper:
+            self._pending.append((path, atime, size, inode))
+            return
+
+        if size is None:
+            entry = self._entries.get(path)
+            if entry:
+                entry[0] = max(entry[0], atime)
+                entry[1] += 1
+                self._changed.add(path)
+        else:
+            self.discard(path)
+            self._track(path, atime, 1, size, inode)
+            self._changed.add(path)
+
+    def _track(self, path, atime, hits, size, inode=None):
+        if inode:
+            paths = self._links.setdefault(inode, set())
+            if paths:
+                # Already charged to another link
+                size = 0
+            paths.add(path)
+            self._inodes[path] = inode
+        self._entries[path] = [atime, hits, size]
+        self.size += size
+
+    def discard(self, path):
+        entry = self._entries.pop(path, None)
+        if entry:
+            self.size -= entry[2]
+            self._changed.add(path)
+
+        inode = self._inodes.pop(path, None)
+        if inode:
+            paths = self._links[inode]
+            paths.discard(path)
+            if not paths:
+                del self._links[inode]
+            elif entry and entry[2]:
+                # Still stored under another path, which carries the bytes now
+                self._entries[next(iter(paths))][2] = entry[2]
+                self.size += entry[2]
+
+    def charge(self, scratch):
+        """
+        Count scratch bytes of interrupted fetches against the budget.
+        """
+        self.size += scratch - self.scratch
+        self.scratch = scratch
+        if self.size > self.max_bytes:
+            self._wake()
+
+    def run(self, busy=lambda path: False):
+        """
+        Evict and save the access index forever, call in a green thread.
+        """
+        while 1:
+            self._wakeup.wait()
+            self._wakeup = Event()
+            try:
+                if not self.keeper:
+                    self.save()
+                    # Take over from a keeper that exited
+                    self.scan()
+                if self.keeper:
+                    if self.shared:
+                        self._replay()
+                    if time.time() - self._scanned >= self.rescan_interval:
+                        self._reconcile({})
+                    if self.size > self.max_bytes:
+                        self.evict(busy)
+                    self.save()
+            except Exception:
+                log.exception('Cache eviction failed')
+
+    def evict(self, busy):
+        target = self.max_bytes * self.low_water
+        key = self.policies[self.policy]
+        log.info('Evicting from %d bytes down to %d', self.size, target)
+        while self.size > target:
+            heap = []
+            for i, path in enumerate(self._entries.keys()):
+                entry = self._entries.get(path)
+                if entry:
+                    heapq.heappush(heap, (key(entry), path))
+                if i % self.chunk == self.chunk - 1:
+                    eventlet.sleep(0)
+
+            evicted = 0
+            while heap and self.size > target:
+                order, path = heapq.heappop(heap)
+                entry = self._entries.get(path)
+                if entry is None:
+                    continue
+
+                # Used since the pass started, put it back in its new place
+                if key(entry) != order:
+                    heapq.heappush(heap, (key(entry), path))
+                    continue
+
+                if busy(path):
+                    continue
+
+                if self.on_evict:
+                    self.on_evict(path)
+                for name in (path, path + '.meta', path + '.gzip'):
+                    try:
+                        os.unlink(name)
+                    except OSError:
+                        pass
+
+                self.discard(path)
+                self.evicted += 1
+                evicted += 1
+                eventlet.sleep(0)
+
+            if not evicted:
+                break
+
+    def save(self):
+        """
+        Save the changed records, or hand them to the keeper.
+        """
+        if not self.keeper:
+            self._flush()
+            return
+
+        if not self._changed:
+            return
+
+        if self._journal > 2 * len(self._entries) + self.chunk:
+            self._rewrite()
+            return
+
+        changed, self._changed = list(self._changed), set()
+        with open(self.index_path, 'ab') as f:
+            self._journal += self._dump(f, changed)
+
+    def close(self):
+        """
+        Save the records and let another worker keep a shared quota.
+        """
+        self.save()
+        if self._lock is not None:
+            _unlock(self._lock)
+            self._lock = None
+
+    def _flush(self):
+        """
+        Append the pending records to the journal of the keeper.
+        """
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        with open(self.journal_path, 'ab') as f:
+            _flock(f)
+            marshal.dump(pending, f)
+
+    def _replay(self):
+        """
+        Apply the records other workers appended to the journal and empty it.
+        """
+        try:
+            f = open(self.journal_path, 'r+b')
+        except IOError:
+            return
+
+        batches = []
+        with f:
+            _flock(f)
+            try:
+                while 1:
+                    batches.append(marshal.load(f))
+            except (EOFError, ValueError, TypeError):
+                pass
+            f.truncate(0)
+
+        for records in batches:
+            for record in records:
+                self._record(*record)
+            eventlet.sleep(0)
+
+    def _rewrite(self):
+        """
+        Replace the index with the current records. Changes made meanwhile
+        are appended by the next save.
+        """
+        self._changed = set()
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self._journal = self._dump(f, self._entries.keys())
+        os.rename(tmp_path, self.index_path)
+
+    def _dump(self, f, paths):
+        """
+        Write the records of paths to f a chunk at a time, None for paths no
+        longer stored. Returns the number of records written.
+        """
+        for i in xrange(0, len(paths), self.chunk):
+            records = {}
+            for path in paths[i:i + self.chunk]:
+                entry = self._entries.get(path)
+                records[path] = (entry[0], entry[1]) if entry else None
+            marshal.dump(records, f)
+            eventlet.sleep(0)
+        return len(paths)
+
+    def _wake(self):
+        if not self._wakeup.ready():
+            self._wakeup.send()
+
+    def tick(self):
+        """
+        Periodically save the index, or hand records to the keeper and check
+        that it is still there, call in a green thread.
+        """
+        while 1:
+            eventlet.sleep(self.interval)
+            self._wake()
+
+class Storage(object):
+    """
+    Where complete cached files are kept besides plain files at their cache
+    path, which is always tried first.
+
+    This base class keeps every file a plain file. Subclasses such as
+    PackStorage take files over in store() and answer for them.
+    """
+
+    def lookup(self, path):
+        """
+        Return (size, mtime) of a file kept here or None.
+        """
+        return None
+
+    def open(self, path):
+        """
+        Return (file, offset, size) of a file kept here or None.
+        """
+        return None
+
+    def meta(self, path):
+        """
+        Validators of a file kept here.
+        """
+        return {}
+
+    def files(self):
+        """
+        Return (path, size, mtime) of every file kept here.
+        """
+        return []
+
+    def store(self, path, meta):
+        """
+        Take over the complete plain file at path along with its validators.
+
+        Returns its size if it is kept here now, or None if it stays a plain
+        file.
+        """
+        return None
+
+    def touch(self, path):
+        """
+        Mark a file kept here as just validated, returns False if it is not
+        kept here.
+        """
+        return False
+
+    def discard(self, path):
+        """
+        Forget a file evicted from the cache.
+        """
+
+    def run(self):
+        """
+        Background upkeep, call in a green thread.
+        """
+
+class PackStorage(Storage):
+    """
+    Keeps small cached files in large append-only pack files.
+
+    Files of up to ``max_object_size`` bytes are moved into the current pack
+    once complete, saving an inode each, and hits are served from the pack by
+    offset. Packs roll over at ``pack_size`` bytes.
+
+    An append-only index log holds a (pack, offset, size, mtime, key,
+    validators) record per stored, touched or removed file, the last record
+    for a path wins. It is memory mapped and replayed at startup and whenever
+    a lookup misses, which picks up files packed by other worker processes.
+    Appends are serialised between processes with flock on the log, taken
+    without blocking the hub.
+
+    Every ``interval`` seconds the live files of packs with more than
+    ``max_garbage`` of their bytes replaced or evicted are copied into the
+    current pack and the old pack is removed. The index log is rewritten once
+    it is mostly stale records, a chunk at a time without holding the lock.
+    Processes notice by its inode and replay it from the start.
+    """
+    record = struct.Struct('<IQidHH')
+    interval = 600
+    chunk = 10000
+
+    def __init__(self, cache_dir, max_object_size=64 * 1024, pack_size=256 * 1024 * 1024, max_garbage=0.25):
+        self.cache_dir = cache_dir
+        self.max_object_size = max_object_size
+        self.pack_size = pack_size
+        self.max_garbage = max_garbage
+        self.dir = os.path.join(cache_dir, '.packs')
+        self.index_path = os.path.join(self.dir, 'index.pack-index')
+
+        # cache path -> (pack, offset, size, mtime, validators)
+        self._entries = {}
+        # Current pack and how much of the index log has been replayed
+        self._pack = 0
+        self._replayed = 0
+        # Identity of the index log replayed and how many records it held
+        self._index_ino = None
+        self._records = 0
+
+        _makedirs(self.dir)
+        self.refresh()
+
+    def pack_path(self, pack):
+        return os.path.join(self.dir, '%05d.pack' % pack)
+
+    def refresh(self):
+        """
+        Replay index records appended since the last refresh.
+        """
+        try:
+            f = open(self.index_path, 'rb')
+        except IOError:
+            return
+
+        with f:
+            fs = os.fstat(f.fileno())
+            if fs.st_ino != self._index_ino:
+                # Rewritten by compact(), replay it from the start
+                self._index_ino = fs.st_ino
+                self._entries = {}
+                self._pack = self._replayed = self._records = 0
+            size = fs.st_size
+            if size <= self._replayed:
+                return
+            m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                self._replay(m, size)
+            finally:
+                m.close()
+
+    def _replay(self, m, size):
+        pos = self._replayed
+        header = self.record.size
+        while pos + header <= size:
+            pack, offset, length, mtime, key_length, meta_length = self.record.unpack_from(m, pos)
+            key_end = pos + header + key_length
+            end = key_end + meta_length
+            if end > size:
+                # Still being appended
+                break
+
+            path = os.path.join(self.cache_dir, m[pos + header:key_end])
+            if length < 0:
+                self._entries.pop(path, None)
+            else:
+                meta = json.loads(m[key_end:end]) if meta_length else {}
+                self._entries[path] = (pack, offset, length, mtime, meta)
+            self._pack = max(self._pack, pack)
+            self._records += 1
+            pos = end
+        self._replayed = pos
+
+    def lookup(self, path):
+        """
+        Return (size, mtime) of a packed file or None.
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            self.refresh()
+            entry = self._entries.get(path)
+        if entry:
+            return entry[2], entry[3]
+
+    def open(self, path):
+        """
+        Return (pack file, offset, size) of a packed file or None.
+        """
+        entry = self._entries.get(path)
+        if entry:
+            try:
+                return open(self.pack_path(entry[0]), 'rb'), entry[1], entry[2]
+            except IOError:
+                pass
+
+            # The pack may have been compacted by another process
+            self.refresh()
+            entry = self._entries.get(path)
+            if entry:
+                try:
+                    return open(self.pack_path(entry[0]), 'rb'), entry[1], entry[2]
+                except IOError:
+                    return None
+
+    def meta(self, path):
+        """
+        Validators of a packed file.
+        """
+        entry = self._entries.get(path)
+        return entry[4] if entry else {}
+
+    def files(self):
+        """
+        Return (path, size, mtime) of every packed file, those packed by other
+        processes included.
+        """
+        self.refresh()
+        return [(path, entry[2], entry[3]) for path, entry in self._entries.iteritems()]
+
+    def store(self, path, meta):
+        """
+        Move the complete cached file at path into a pack if it is small.
+
+        Returns its size if it was packed.
+        """
+        try:
+            with open(path, 'rb') as f:
+                fs = os.fstat(f.fileno())
+                if fs.st_size > self.max_object_size:
+                    return None
+                data = f.read()
+        except IOError:
+            return None
+
+        entry = self._entries.get(path)
+        if entry and entry[2] == len(data) and self._read(entry) == data:
+            # Refetched unchanged, keep the packed copy
+            self._append(path, fs.st_mtime, meta, location=entry[:3])
+        else:
+            self._append(path, fs.st_mtime, meta, data)
+        for name in (path, path + '.meta'):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+        return len(data)
+
+    def touch(self, path):
+        """
+        Mark a packed file as just validated, returns False if it is not packed.
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            return False
+        self._append(path, time.time(), entry[4], location=entry[:3])
+        return True
+
+    def discard(self, path):
+        """
+        Forget a packed file evicted from the cache.
+        """
+        if path in self._entries:
+            self._append(path, time.time(), None, location=(0, 0, -1))
+
+    def _append(self, path, mtime, meta, data=None, location=None):
+        """
+        Write data to the current pack and record it, or record a new
+        location for path.
+        """
+        with self._lock_index() as index:
+            self._write(index, path, mtime, meta, data, location)
+
+    def _lock_index(self):
+        """
+        Open the index log for appending and lock it, returns the file.
+        """
+        while 1:
+            index = open(self.index_path, 'ab')
+            _flock(index)
+            try:
+                # Rewritten while we waited, lock the new one
+                if os.fstat(index.fileno()).st_ino == os.stat(self.index_path).st_ino:
+                    self.refresh()
+                    return index
+            except OSError:
+                pass
+            index.close()
+
+    def _write(self, index, path, mtime, meta, data=None, location=None):
+        if data is not None:
+            try:
+                offset = os.path.getsize(self.pack_path(self._pack))
+            except OSError:
+                offset = 0
+            if offset and offset + len(data) > self.pack_size:
+                self._pack += 1
+                offset = 0
+            with open(self.pack_path(self._pack), 'ab') as pack:
+                pack.write(data)
+            location = (self._pack, offset, len(data))
+
+        index.write(self._record(path, location, mtime, meta))
+        index.flush()
+        self.refresh()
+
+    def _record(self, path, location, mtime, meta):
+        key = os.path.relpath(path, self.cache_dir)
+        meta = json.dumps(meta) if meta else ''
+        return self.record.pack(location[0], location[1], location[2], mtime, len(key), len(meta)) + key + meta
+
+    def _read(self, entry):
+        try:
+            with open(self.pack_path(entry[0]), 'rb') as f:
+                f.seek(entry[1])
+                return f.read(entry[2])
+        except IOError:
+            return None
+
+    def compact(self):
+        """
+        Move the live files out of packs that are mostly garbage and remove
+        those packs, then rewrite the index log if it is mostly stale.
+        """
+        self.refresh()
+        live = {}
+        for entry in self._entries.values():
+            live[entry[0]] = live.get(entry[0], 0) + entry[2]
+
+        for name in sorted(os.listdir(self.dir)):
+            if not name.endswith('.pack'):
+                continue
+            try:
+                pack = int(name[:-len('.pack')])
+                size = os.path.getsize(self.pack_path(pack))
+            except (ValueError, OSError):
+                continue
+            if pack == self._pack or size - live.get(pack, 0) <= size * self.max_garbage:
+                continue
+
+            log.info('Compacting pack %d, %d of %d bytes live', pack, live.get(pack, 0), size)
+            for path in [path for path, entry in self._entries.items() if entry[0] == pack]:
+                self._move(path, pack)
+                eventlet.sleep(0)
+
+            with self._lock_index():
+                if pack != self._pack and not any(entry[0] == pack for entry in self._entries.itervalues()):
+                    try:
+                        os.unlink(self.pack_path(pack))
+                    except OSError:
+                        pass
+
+        if self._records > 2 * len(self._entries) + 1000:
+            self._rewrite_index()
+
+    def _move(self, path, pack):
+        """
+        Copy path out of pack into the current one, unless it moved already.
+        """
+        with self._lock_index() as index:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != pack:
+                return
+            data = self._read(entry)
+            if data is not None and len(data) == entry[2]:
+                self._write(index, path, entry[3], entry[4], data)
+
+    def _rewrite_index(self):
+        """
+        Replace the index log with the current records. They are written
+        without the lock, which is only taken to copy the records appended
+        meanwhile and rename the new log into place.
+        """
+        self.refresh()
+        index_ino, replayed = self._index_ino, self._replayed
+        entries = self._entries.items()
+        tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                for i in xrange(0, len(entries), self.chunk):
+                    f.write(''.join(
+                        self._record(path, (pack, offset, length), mtime, meta)
+                        for path, (pack, offset, length, mtime, meta) in entries[i:i + self.chunk]
+                    ))
+                    eventlet.sleep(0)
+
+                with self._lock_index():
+                    if self._index_ino != index_ino:
+                        # Rewritten by another process meanwhile
+                        return
+                    with open(self.index_path, 'rb') as current:
+                        current.seek(replayed)
+                        f.write(current.read())
+                    f.flush()
+                    os.rename(tmp_path, self.index_path)
+                    self.refresh()
+        finally:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def run(self):
+        while 1:
+            eventlet.sleep(self.interval)
+            try:
+                self.compact()
+            except Exception:
+                log.exception('Compacting packs failed')
+
+class BlobStore(object):
+    """
+    Content addressed store that cached files are hardlinked into.
+
+    Blobs are keyed by sha256 under ``root``, which must be on the same
+    filesystem as the cache and outside the mirror directories. Checksums
+    come from fills computing them while streaming, or are learned from
+    repository primary metadata so that a package requested through a
+    second mirror name is linked from the blob before it is ever fetched.
+
+    A blob is removed along with the last cached file linking to it when
+    that is evicted. Blobs no cached file links to any more are also pruned
+    every ``interval`` seconds.
+    """
+    checksum_type = 'sha256'
+    interval = 600
+
+    def __init__(self, root):
+        self.root = root
+        # cache path -> checksum announced by repository metadata
+        self.known = {}
+        # (device, inode) -> blob path, of blobs linked or seen by prune()
+        self._blobs = {}
+
+    def blob_path(self, checksum):
+        return os.path.join(self.root, self.checksum_type, checksum[:2], checksum)
+
+    def learn(self, repo_dir, packages):
+        """
+        Record checksums of (location, checksum type, checksum) packages of
+        the repository cached in repo_dir.
+        """
+        for i, (href, checksum_type, checksum) in enumerate(packages):
+            if checksum_type == self.checksum_type:
+                self.known[os.path.join(repo_dir, href)] = checksum
+            if i % 1000 == 999:
+                # Large repositories take a while, let requests through
+                eventlet.sleep()
+
+    def link(self, path):
+        """
+        Create path from a blob if its checksum is known and stored.
+        """
+        checksum = self.known.get(path)
+        if not checksum:
+            return False
+
+        _makedirs(os.path.dirname(path))
+        blob = self.blob_path(checksum)
+        try:
+            os.link(blob, path)
+        except OSError as e:
+            # EEXIST: someone just stored path anyway
+            return e.errno == errno.EEXIST
+        self._remember(blob)
+        return True
+
+    def add(self, path, checksum=None):
+        """
+        Link a newly cached file into the store, or replace it with a link to
+        an identical blob. Without a streamed checksum only files announced by
+        repository metadata are added, after verifying them.
+        """
+        known = self.known.get(path)
+        if checksum is None:
+            if known is None:
+                return
+            checksum = _file_checksum(path, self.checksum_type)
+        if known and known != checksum:
+            log.warning('Checksum of "%s" does not match repository metadata', path)
+            return
+
+        blob = self.blob_path(checksum)
+        try:
+            if os.path.exists(blob):
+                if not os.path.samefile(blob, path):
+                    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+                    os.link(blob, tmp_path)
+                    os.rename(tmp_path, path)
+            else:
+                _makedirs(os.path.dirname(blob))
+                os.link(path, blob)
+            self._remember(blob)
+        except OSError as e:
+            log.warning('Could not link "%s" to blob %s: %s', path, checksum, e)
+
+    def release(self, path):
+        """
+        Called before the cached file at path is removed, removes its blob
+        too if nothing else links to it.
+        """
+        try:
+            fs = os.stat(path)
+        except OSError:
+            return
+
+        inode = _shared_inode(fs)
+        blob = self._blobs.get(inode)
+        if blob and fs.st_nlink == 2:
+            try:
+                if os.stat(blob).st_ino == fs.st_ino:
+                    os.unlink(blob)
+            except OSError:
+                pass
+            del self._blobs[inode]
+
+    def _remember(self, blob):
+        try:
+            fs = os.stat(blob)
+        except OSError:
+            return
+        self._blobs[fs.st_dev, fs.st_ino] = blob
+
+    def prune(self):
+        """
+        Remove blobs no cached file links to.
+        """
+        blobs = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                blob = os.path.join(dirpath, filename)
+                try:
+                    fs = os.stat(blob)
+                    if fs.st_nlink == 1:
+                        os.unlink(blob)
+                    else:
+                        blobs[fs.st_dev, fs.st_ino] = blob
+                except OSError:
+                    pass
+            eventlet.sleep(0)
+        self._blobs = blobs
+
+    def run(self):
+        while 1:
+            try:
+                self.prune()
+            except Exception:
+                log.exception('Pruning blobs failed')
+            eventlet.sleep(self.interval)
+
+def _file_checksum(path, checksum_type):
+    digest = hashlib.new(checksum_type)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FileContent(object):
+    """
+    Iterates over a byte range of a local file.
+
+    The file is memory mapped and handed out in large slices so a hit costs a
+    single copy out of the page cache instead of a read() call per small chunk.
+    Falls back to plain reads when the file cannot be mapped.
+    """
+    readsize = 256 * 1024
+    
+    def __init__(self, f, range):
+        self.range = range
+        self.f = f
+                    
+    def __iter__(self):
+        start, end = self.range
+        total = (end - start) + 1
+        sent = 0
+
+        try:
+            if total > 0:
+                try:
+                    chunks = self._mapped(start, total)
+                except (mmap.error, ValueError):
+                    chunks = self._read(start, total)
+
+                for output in chunks:
+                    yield output
+                    sent += len(output)
+        finally:
+            log.debug('Sent %d bytes of %d (range: %d-%d)', sent, total, start, end)
+            self.close()
+
+    def _mapped(self, start, total):
+        m = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def chunks():
+            try:
+                offset = start
+                stop = min(start + total, len(m))
+                while offset < stop:
+                    yield m[offset:min(offset + self.readsize, stop)]
+                    offset += self.readsize
+            finally:
+                m.close()
+
+        return chunks()
+
+    def _read(self, start, total):
+        self.f.seek(start)
+        remaining = total
+        while remaining:
+            output = self.f.read(min(self.readsize, remaining))
+            if not output:
+                break
+
+            yield output
+            remaining -= len(output)
+
+    def close(self):
+        self.f.close()
+                
+class CacheFill(object):
+    """
+    A single upstream fetch being written into the cache.
+
+    The first request for a missing file creates the fill and starts a
+    download into it; that request and concurrent requests for the same file
+    follow along by reading the temp file as bytes land.
+
+    A preallocated fill is written out of order (see SegmentedDownload), its
+    ``written`` is the length of the contiguous prefix that has landed.
+
+    Writes are buffered up to the cache's ``write_size``, ``written`` only
+    counts bytes flushed to the temp file where followers can read them.
+    With the cache's ``fallocate`` the blocks of the whole file are reserved
+    up front so large files are not fragmented as they grow.
+
+    Progress is checkpointed to a ``.progress`` record. When the fetch fails
+    midway the temp file and record are kept, and a later fill resumes from
+    them with a range request.
+    """
+    # Bytes between progress records
+    checkpoint_interval = 1024 * 1024
+
+    def __init__(self, path, cache, lock=None):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.progress_path = path + '.progress'
+        self.response = None
+        self.status = None
+        # Upstream headers to keep in the .meta sidecar
+        self.meta = {}
+        # URL of the upstream response, resumed fetches go back to it
+        self.source = None
+        self.written = 0
+        self.finished = False
+        self.failed = False
+
+        self._cache = cache
+        self._cache._fills[path] = self
+        # Lock file shared with other worker processes, see ForeignFill
+        self._lock = lock
+        self._outfile = None
+        self._preallocated = False
+        self._bufsize = 0
+        # Bytes written to _outfile but not flushed yet
+        self._buffered = 0
+        self._checkpointed = 0
+        # Checksum computed while streaming, for the blob store
+        self._digest = None
+        self._ready = Event()
+        self._progress = Event()
+
+    def start(self, response, bufsize=4096, preallocate=False, offset=0):
+        """
+        Upstream answered; begin writing the temp file, or continue it after
+        its first offset bytes.
+        """
+        self.response = response
+        self._bufsize = bufsize
+        if offset:
+            self._outfile = open(self.tmp_path, 'r+b', bufsize)
+            self._outfile.truncate(offset)
+            self._outfile.seek(offset)
+            self.written = offset
+            self._checkpoint()
+        elif preallocate:
+            self._outfile = open(self.tmp_path, 'wb', bufsize)
+            self._outfile.truncate(response.size)
+            self._preallocated = True
+            self._checkpoint()
+        else:
+            # A record left by an earlier fetch no longer applies
+            self._unlink_progress()
+            self._outfile = open(self.tmp_path, 'wb', bufsize)
+            if self._cache.blob_store:
+                self._digest = hashlib.new(self._cache.blob_store.checksum_type)
+        if self._cache.fallocate and response.size:
+            _fallocate(self._outfile, offset, response.size - offset)
+        self._share(size=response.size)
+        self._ready.send()
+
+    def refuse(self, status):
+        """
+        Upstream refused the request; followers get the same status.
+        """
+        self.status = status
+        self.failed = True
+        self._share(status=status)
+        if self._lock:
+            self._keep_status(status)
+        self._release()
+        self._ready.send()
+
+    def _keep_status(self, status):
+        """
+        Leave status in a sidecar for followers in other workers, the lock
+        file holding it is gone as soon as the lock is released.
+        """
+        status_path = self.path + '.status'
+        tmp_path = '%s.%d.tmp' % (status_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(status)
+            os.rename(tmp_path, status_path)
+            ino = os.stat(status_path).st_ino
+        except (IOError, OSError) as e:
+            log.warning('Could not keep status of %s: %s', self.path, e)
+            return
+
+        def expire():
+            try:
+                if os.stat(status_path).st_ino == ino:
+                    os.unlink(status_path)
+            except OSError:
+                pass
+        eventlet.spawn_after(ForeignFill.status_ttl, expire)
+
+    def unchanged(self, response):
+        """
+        Upstream confirmed the cached copy is current, nothing to write.
+        """
+        self.response = response
+        self.written = response.size
+        self.finished = True
+        self._release()
+        self._ready.send()
+        self._notify()
+
+    def write(self, bytes):
+        self._outfile.write(bytes)
+        self._buffered += len(bytes)
+        if self._digest:
+            self._digest.update(bytes)
+        if self._buffered >= self._bufsize:
+            self.flush()
+
+    def flush(self):
+        """
+        Make buffered bytes visible to followers reading the temp file.
+        """
+        self._outfile.flush()
+        self.written += self._buffered
+        self._buffered = 0
+        if self.written - self._checkpointed >= self.checkpoint_interval:
+            self._checkpoint()
+        self._notify()
+
+    def advance(self, written):
+        """
+        A preallocated fill has its first written bytes in place.
+        """
+        self.written = written
+        if written - self._checkpointed >= self.checkpoint_interval:
+            self._checkpoint()
+        self._notify()
+
+    def finish(self):
+        self.flush()
+        if self._cache.fsync:
+            os.fsync(self._outfile.fileno())
+        self._outfile.close()
+        os.rename(self.tmp_path, self.path)
+        if self._cache.fsync == 'full':
+            _fsync_dir(os.path.dirname(self.path))
+        self._unlink_progress()
+        self.finished = True
+        self._release()
+        try:
+            self._cache._stored(self.path, self.meta, self._digest and self._digest.hexdigest())
+        finally:
+            self._notify()
+
+    def abort(self):
+        if self.finished:
+            # Failed after the file was in place, it stays cached
+            return
+
+        try:
+            if self._outfile:
+                try:
+                    self.flush()
+                except (IOError, ValueError):
+                    # Out of space, or closed by a failed finish(). written
+                    # still covers what landed.
+                    pass
+                try:
+                    self._outfile.close()
+                except IOError:
+                    pass
+
+                if self.written and self.response.size and self._validator():
+                    # Keep what we have for the next fill to resume
+                    self._checkpoint()
+                    log.info('Keeping %d of %d bytes of %s', self.written, self.response.size, self.path)
+                else:
+                    try:
+                        os.unlink(self.tmp_path)
+                    except OSError:
+                        pass
+                    self._unlink_progress()
+        finally:
+            self.failed = True
+            self._release()
+            self._notify()
+
+    def wait(self):
+        """
+        Block until upstream has answered.
+        """
+        self._ready.wait()
+
+    def wait_progress(self):
+        """
+        Block until more bytes are written or the fill ends.
+        """
+        if not (self.finished or self.failed):
+            self._progress.wait()
+
+    def _notify(self):
+        progress, self._progress = self._progress, Event()
+        progress.send()
+
+    def _share(self, **state):
+        if self._lock:
+            self._lock.truncate(0)
+            self._lock.write(json.dumps(state))
+            self._lock.flush()
+
+    def _validator(self):
+        return self.meta.get('ETag') or self.meta.get('Last-Modified')
+
+    def _checkpoint(self):
+        """
+        Record how much of the temp file is valid.
+
+        The size of a preallocated temp file says nothing, so followers in
+        other processes read this instead. Replaced by rename so readers never
+        see a partial record.
+        """
+        record = {
+            'written' : self.written,
+            'size' : self.response.size,
+            'validator' : self._validator(),
+            'source' : self.source,
+            'preallocated' : self._preallocated,
+        }
+        tmp_path = self.progress_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(record, f)
+        os.rename(tmp_path, self.progress_path)
+        self._checkpointed = self.written
+
+    def _unlink_progress(self):
+        try:
+            os.unlink(self.progress_path)
+        except OSError:
+            pass
+
+    def _release(self):
+        if self._cache._fills.get(self.path) is self:
+            del self._cache._fills[self.path]
+
+        if self._lock:
+            try:
+                os.unlink(self._lock.name)
+            except OSError:
+                pass
+            self._lock.close()
+            self._lock = None
+
+class ForeignFill(object):
+    """
+    A fill running in another worker process.
+
+    Followed by polling the temp file and the lock file the worker holds.
+    A refused fill leaves its status in a ``.status`` sidecar for
+    ``status_ttl`` seconds.
+    """
+    poll_interval = 0.05
+    status_ttl = 10
+
+    def __init__(self, path, ctype, storage):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.lock_path = path + '.lock'
+        self.progress_path = path + '.progress'
+        self.ctype = ctype
+        self.response = None
+        self.status = None
+        # Storage the finished file may have moved to
+        self.storage = storage
+
+    @property
+    def written(self):
+        # A preallocated temp file is written out of order, trust its progress
+        # record. The fill removes it only after renaming the temp file.
+        try:
+            with open(self.progress_path, 'rb') as f:
+                record = json.load(f)
+            if record.get('preallocated'):
+                return record['written']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        for path in (self.tmp_path, self.path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                pass
+        packed = self._packed()
+        return packed[0] if packed else 0
+
+    @property
+    def finished(self):
+        return not _locked(self.lock_path) and (os.path.isfile(self.path) or bool(self._packed()))
+
+    @property
+    def failed(self):
+        return not (_locked(self.lock_path) or os.path.isfile(self.path) or self._packed())
+
+    def _packed(self):
+        return self.storage.lookup(self.path)
+
+    def wait(self):
+        while 1:
+            try:
+                with open(self.lock_path, 'rb') as f:
+                    state = json.loads(f.read() or 'null')
+            except (IOError, ValueError):
+                state = None
+
+            if state:
+                self.status = state.get('status')
+                if not self.status:
+                    self.response = Response(self.ctype, state['size'])
+                return
+            elif not _locked(self.lock_path):
+                if self.finished:
+                    self.response = Response(self.ctype, self.written)
+                else:
+                    self.status = self._refused() or '502 Bad Gateway'
+                return
+
+            eventlet.sleep(self.poll_interval)
+
+    def _refused(self):
+        """
+        Status the fill was recently refused with, or None.
+        """
+        try:
+            with open(self.path + '.status', 'rb') as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime < self.status_ttl:
+                    return f.read().strip() or None
+        except (IOError, OSError):
+            pass
+
+    def wait_progress(self):
+        eventlet.sleep(self.poll_interval)
+
+def _finish(fill):
+    """
+    Complete a fully downloaded fill, failing it if that goes wrong so its
+    followers are never left waiting.
+    """
+    try:
+        fill.finish()
+    except:
+        log.exception('Could not store %s', fill.path)
+        fill.abort()
+
+class StreamingDownload(object):
+    """
+    Fetches an upstream response into a CacheFill in order, in a green thread
+    of its own.
+
+    Clients, the one that caused the fetch included, follow the fill at their
+    own pace. A slow or disconnected client neither throttles nor abandons the
+    fetch, a completed fetch always leaves a cache entry.
+    """
+    readsize = 65536
+
+    def __init__(self, fill, remote_file, readsize=None):
+        self.fill = fill
+        self.remote_file = remote_file
+        if readsize:
+            self.readsize = readsize
+
+    def run(self):
+        try:
+            with closing(self.remote_file):
+                while 1:
+                    bytes = self.remote_file.read(self.readsize)
+                    if not bytes:
+                        break
+                    self.fill.write(bytes)
+            self.fill.flush()
+        except:
+            log.exception('Fetch of %s failed after %d bytes', self.fill.path, self.fill.written)
+            self.fill.abort()
+            return
+
+        size = self.fill.response.size
+        if size and self.fill.written < size:
+            log.warning('Upstream closed %s after %d of %d bytes', self.fill.path, self.fill.written, size)
+            self.fill.abort()
+            return
+
+        log.debug('Fetched %d bytes of %s', self.fill.written, self.fill.path)
+        _finish(self.fill)
+
+class SegmentedDownload(object):
+    """
+    Fetches a large file into a preallocated CacheFill as several ranges in
+    parallel, each over its own upstream connection.
+
+    The response already open for the whole file supplies the first segment.
+    The others are asked of the same upstream, whose validator they must
+    match. Clients follow the fill, reading bytes in order as the prefix
+    grows.
+    """
+    readsize = 65536
+
+    def __init__(self, fill, remote_file, opener, count, readsize=None):
+        self.fill = fill
+        self.remote_file = remote_file
+        self.opener = opener
+        if readsize:
+            self.readsize = readsize
+        self.validator = _validator(remote_file)
+        self.source = remote_file.geturl()
+
+        size = fill.response.size
+        step = -(-size // count)
+        # [start, end] of each segment and the next offset to write in it
+        self.segments = [(start, min(start + step, size) - 1) for start in xrange(0, size, step)]
+        self.positions = [start for start, end in self.segments]
+
+    def run(self):
+        workers = [
+            eventlet.spawn(self._fetch, i, self.remote_file if i == 0 else None)
+            for i in xrange(len(self.segments))
+        ]
+        try:
+            for worker in workers:
+                worker.wait()
+        except:
+            log.exception('Segmented fetch of %s failed', self.fill.path)
+            for worker in workers:
+                worker.kill()
+            self.fill.abort()
+        else:
+            _finish(self.fill)
+
+    def _fetch(self, i, remote_file):
+        start, end = self.segments[i]
+        if remote_file is None:
+            headers = {'Range': 'bytes=%d-%d' % (start, end)}
+            if self.validator:
+                headers['If-Range'] = self.validator
+            remote_file = self.opener(headers, self.source)
+            content_range = _content_range(remote_file)
+            if not content_range or content_range[0] != start:
+                remote_file.close()
+                raise IOError('Upstream ignored range %d-%d of %s' % (start, end, self.fill.path))
+
+        pos = start
+        try:
+            with open(self.fill.tmp_path, 'r+b', 0) as f:
+                f.seek(start)
+                while pos <= end:
+                    output = remote_file.read(min(self.readsize, end + 1 - pos))
+                    if not output:
+                        raise IOError('Upstream closed %s at %d of %d-%d' % (self.fill.path, pos, start, end))
+                    f.write(output)
+                    pos += len(output)
+                    self._advance(i, pos)
+        finally:
+            # Stops the first segment short of the whole file
+            remote_file.close()
+
+    def _advance(self, i, pos):
+        self.positions[i] = pos
+        written = 0
+        for (start, end), pos in zip(self.segments, self.positions):
+            written = pos
+            if pos <= end:
+                break
+        if written != self.fill.written:
+            self.fill.advance(written)
+
+class FollowContent(object):
+    """
+    Streams a file that another request is still fetching into the cache.
+    """
+    readsize = 65536
+
+    def __init__(self, fill, range=None, readsize=None):
+        self.fill = fill
+        self.range = range
+        if readsize:
+            self.readsize = readsize
+        # Open now, the temp file is renamed (but stays readable) once complete.
+        # Unbuffered, read-ahead could pick up preallocated space not yet written.
+        try:
+            self.f = open(fill.path if fill.finished else fill.tmp_path, 'rb', 0)
+        except IOError:
+            # Renamed in the meantime
+            self.f = open(fill.path, 'rb', 0)
+
+    def __iter__(self):
+        start, end = self.range or (0, None)
+        pos = start
+        try:
+            self.f.seek(start)
+            while end is None or pos <= end:
+                limit = self.fill.written
+                if end is not None:
+                    limit = min(limit, end + 1)
+
+                if limit > pos:
+                    output = self.f.read(min(self.readsize, limit - pos))
+                    yield output
+                    pos += len(output)
+                elif self.fill.finished or self.fill.failed:
+                    break
+                else:
+                    self.fill.wait_progress()
+        finally:
+            self.f.close()
+
+        if self.fill.failed:
+            log.warning('Fetch of %s failed after %d bytes', self.fill.path, pos - start)
+        else:
+            log.debug('Sent %d bytes from in-flight fetch', pos - start)
+
+    def close(self):
+        self.f.close()
+
+class BlockMap(object):
+    """
+    Tracks which blocks of a sparse cache file have been fetched.
+
+    Persisted as a JSON header line followed by the raw bitmap.
+    """
+    def __init__(self, path, size, block_size, validator=None, bits=None, source=None):
+        self.path = path
+        self.size = size
+        self.block_size = block_size
+        self.validator = validator
+        # URL of the upstream the validator came from
+        self.source = source
+        self.count = (size + block_size - 1) // block_size
+        self.bits = bits or bytearray((self.count + 7) // 8)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                bits = bytearray(f.read())
+        except (IOError, ValueError):
+            return None
+
+        return cls(path, header['size'], header['block_size'], header.get('validator'), bits,
+            header.get('source'))
+
+    def save(self):
+        # Keep blocks another process sharing the file has added meanwhile
+        saved = BlockMap.load(self.path)
+        if saved and (saved.size, saved.validator) == (self.size, self.validator):
+            for i, byte in enumerate(saved.bits):
+                self.bits[i] |= byte
+
+        tmp_path = self.path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(dict(
+                size=self.size,
+                block_size=self.block_size,
+                validator=self.validator,
+                source=self.source,
+            )) + '\n')
+            f.write(str(self.bits))
+        os.rename(tmp_path, self.path)
+
+    def __contains__(self, block):
+        return bool(self.bits[block >> 3] & (1 << (block & 7)))
+
+    def add(self, block):
+        self.bits[block >> 3] |= 1 << (block & 7)
+
+    @property
+    def complete(self):
+        return all(block in self for block in xrange(self.count))
+
+    def missing(self):
+        """
+        Yield (first, last) runs of blocks that have not been fetched.
+        """
+        first = None
+        for block in xrange(self.count):
+            if block in self:
+                if first is not None:
+                    yield first, block - 1
+                    first = None
+            elif first is None:
+                first = block
+
+        if first is not None:
+            yield first, self.count - 1
+
+def _validator(remote_file):
+    info = remote_file.info()
+    return info.getheader('ETag', None) or info.getheader('Last-Modified', None)
+
+def _validator_meta(validator):
+    """
+    Turn a validator from _validator back into its response header.
+    """
+    if not validator:
+        return {}
+    return {'ETag' if validator.startswith(('"', 'W/')) else 'Last-Modified' : validator}
+
+def _content_range(remote_file):
+    """
+    Parse a Content-Range response header into (start, end, size).
+    """
+    content_range = remote_file.info().getheader('Content-Range', None)
+    if content_range:
+        m = re.match(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<size>\d+)$', content_range)
+        return int(m.group('start')), int(m.group('end')), int(m.group('size'))
+
+class SparseFile(object):
+    """
+    A partially fetched cache file.
+
+    Data lives at its final offsets in a sparse ``.partial`` file, with a
+    ``.blocks`` BlockMap recording which blocks are present. Missing blocks are
+    fetched upstream with range requests, from the upstream the first range
+    came from since others may not share its validator. Once every block is
+    present the data file is renamed into place as a normal cached file.
+    """
+    block_size = 1024 * 1024
+    readsize = 65536
+
+    def __init__(self, path, blocks, opener, cache):
+        self.path = path
+        self.data_path = path + '.partial'
+        self.blocks = blocks
+        self.size = blocks.size
+        self.filling = False
+
+        self._opener = opener
+        self._cache = cache
+        self._cache._sparse_files[path] = self
+        self.finished = False
+
+    @classmethod
+    def load(cls, path, opener, cache):
+        blocks = BlockMap.load(path + '.blocks')
+        if blocks and os.path.isfile(path + '.partial'):
+            return cls(path, blocks, opener, cache)
+
+    @classmethod
+    def create(cls, path, size, validator, opener, cache, source=None):
+        _makedirs(os.path.dirname(path))
+
+        # Another process may have created it already, never truncate data
+        fd = os.open(path + '.partial', os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+        blocks = BlockMap(path + '.blocks', size, cls.block_size, validator, source=source)
+        blocks.save()
+        return cls(path, blocks, opener, cache)
+
+    def block_span(self, first, last):
+        """
+        Byte range covered by blocks first..last.
+        """
+        return first * self.blocks.block_size, min(self.size, (last + 1) * self.blocks.block_size) - 1
+
+    def open(self):
+        return open(self.path if self.finished else self.data_path, 'rb')
+
+    def fetch(self, first, last, remote_file=None):
+        """
+        Fetch blocks first..last into the data file.
+
+        Yields (offset, bytes) as data is written. An already opened upstream
+        response may be passed in as long as it starts at the first block.
+        """
+        start, end = self.block_span(first, last)
+        if remote_file is None:
+            remote_file = self._opener({'Range' : 'bytes=%d-%d' % (start, end)}, self.blocks.source)
+
+        try:
+            content_range = _content_range(remote_file)
+            offset = content_range[0] if content_range else 0
+            validator = _validator(remote_file)
+            if validator and self.blocks.validator and validator != self.blocks.validator:
+                log.warning('%s changed upstream, discarding partial copy', self.path)
+                self.discard()
+                raise IOError('%s changed upstream' % self.path)
+
+            try:
+                f = open(self.data_path, 'r+b')
+            except IOError:
+                # Completed by another process
+                f = open(self.path, 'r+b')
+                self.finished = True
+                self._release()
+
+            try:
+                f.seek(offset)
+                block_size = self.blocks.block_size
+                # Only blocks written start to finish by this fetch are marked
+                next_block = (offset + block_size - 1) // block_size
+                while offset <= end:
+                    bytes = remote_file.read(self.readsize)
+                    if not bytes:
+                        break
+
+                    f.write(bytes)
+                    yield offset, bytes
+                    offset += len(bytes)
+
+                    done = False
+                    while next_block < self.blocks.count and \
+                        min(self.size, (next_block + 1) * block_size) <= offset:
+                        self.blocks.add(next_block)
+                        next_block += 1
+                        done = True
+
+                    # Once another process renamed the data file its map is gone too
+                    if done and not self.finished and os.path.exists(self.data_path):
+                        f.flush()
+                        self.blocks.save()
+            finally:
+                f.close()
+        finally:
+            remote_file.close()
+
+        if not self.finished and self.blocks.complete:
+            self._finish()
+
+    def fill_missing(self):
+        """
+        Fetch every missing block, used to complete the file in the background.
+        """
+        self.filling = True
+        try:
+            for first, last in list(self.blocks.missing()):
+                for _ in self.fetch(first, last):
+                    pass
+        except Exception:
+            log.exception('Background fill of %s failed', self.path)
+        finally:
+            self.filling = False
+
+    def discard(self):
+        self._release()
+        for path in (self.data_path, self.blocks.path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _finish(self):
+        try:
+            os.rename(self.data_path, self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT or not os.path.isfile(self.path):
+                raise
+            log.debug('"%s" was completed by another process', self.path)
+            self.finished = True
+            self._release()
+            return
+
+        try:
+            os.unlink(self.blocks.path)
+        except OSError:
+            pass
+        self.finished = True
+        self._release()
+
+        self._cache._stored(self.path, _validator_meta(self.blocks.validator))
+        log.info('Completed "%s" from ranges', self.path)
+
+    def _release(self):
+        if self._cache._sparse_files.get(self.path) is self:
+            del self._cache._sparse_files[self.path]
+
+class SparseContent(object):
+    """
+    Streams a byte range of a SparseFile, fetching missing blocks on the way.
+    """
+    def __init__(self, sparse, range, remote_file=None, on_close=None):
+        self.sparse = sparse
+        self.range = range
+        self.remote_file = remote_file
+        # Called with the number of bytes served from the cache when done
+        self.on_close = on_close
+        self.cached = 0
+
+    def __iter__(self):
+        start, end = self.range
+        pos = start
+        block_size = self.sparse.blocks.block_size
+        try:
+            while pos <= end:
+                block = pos // block_size
+                last = block
+                present = block in self.sparse.blocks
+                while (last + 1) * block_size <= end and ((last + 1) in self.sparse.blocks) == present:
+                    last += 1
+                    
+                if present:
+                    run_end = min(end, self.sparse.block_span(block, last)[1])
+                    for output in FileContent(self.sparse.open(), (pos, run_end)):
+                        yield output
+                    self.cached += run_end + 1 - pos
+                    pos = run_end + 1
+                else:
+                    remote_file, self.remote_file = self.remote_file, None
+                    if remote_file and _content_range(remote_file)[0] != block * block_size:
+                        remote_file.close()
+                        remote_file = None
+
+                    fetched = pos
+                    for offset, bytes in self.sparse.fetch(block, last, remote_file):
+                        lo = max(offset, pos)
+                        hi = min(offset + len(bytes), end + 1)
+                        if hi > lo:
+                            yield bytes[lo - offset:hi - offset]
+                            pos = hi
+
+                    if pos == fetched:
+                        log.warning('Upstream sent no data for %s at %d', self.sparse.path, pos)
+                        break
+        finally:
+            self.close()
+            if self.on_close:
+                self.on_close(self.cached)
+
+    def close(self):
+        # Hands the pooled connection back if the body is never iterated
+        remote_file, self.remote_file = self.remote_file, None
+        if remote_file:
+            remote_file.close()
+
+class HttpCache(object):
+    """
+    HTTP pass-through cache server.
+
+    Requests first checked for local copy, if not existing
+    requests are forwarded to remote_base_url.
+
+    Files are cached in cache_dir.
+    """
+    extensions_map = {
+        '.rpm' : 'application/x-redhat-package-manager',
+        '.xml' : 'text/xml',
+        '.html' : 'text/html',
+        '.htm' : 'text/html',
+        '.txt' : 'text/plain',
+        '.repo' : 'text/plain',
+        None : 'application/octet-stream',
+    }
+    # Types sent gzip encoded to clients accepting it, see compress
+    compressible_types = ('text/xml', 'text/html', 'text/plain')
+    # None leaves writeback to the OS, 'file' syncs the temp file before it is
+    # renamed into place, 'full' syncs the directory after the rename too
+    fsync_policies = (None, 'file', 'full')
+    # Seconds between sweeps for interrupted fetches past partial_ttl
+    sweep_interval = 3600
+        
+    def __init__(self, remote_base_urls, cache_dir, background_fill=False, connection_pool=None,
+        memory_cache=None, index=False, freshness=None, stale_while_revalidate=False,
+        max_size=None, eviction='lru', hedge=True, lock_files=False, segments=4,
+        segment_threshold=64 * 1024 * 1024, blob_store=None, compress=False, negative_ttl=0,
+        negative_statuses=(404, 410), storage=None, peers=(), peer_timeout=0.25, lanes=None,
+        read_size=64 * 1024, write_size=64 * 1024, fallocate=True, fsync=None, partial_ttl=24 * 3600):
+        if fsync not in self.fsync_policies:
+            raise ValueError('Unknown fsync policy %r' % (fsync, ))
+
+        # A base URL or list of base URLs per mirror name
+        self.mirrors = dict(
+            (name, Mirror(base_urls, hedge)) for name, base_urls in remote_base_urls.items()
+        )
+        self.cache_dir = cache_dir
+        # (pattern, max_age) rules for files that change upstream, patterns are
+        # matched against the path below the mirror, e.g. ('*/repodata/*', 600).
+        # Files matching no rule are cached forever.
+        self.freshness = freshness or []
+        # Serve stale files at once and revalidate them in the background
+        self.stale_while_revalidate = stale_while_revalidate
+        self.connection_pool = connection_pool or ConnectionPool()
+        # Storage such as a PackStorage that cached files can be moved to,
+        # by default they all stay plain files
+        self.storage = storage or Storage()
+        # Optional MemoryCache for small files
+        self.memory_cache = memory_cache
+        # Optional CacheIndex answering lookups without touching the filesystem
+        self.index = None
+        if index:
+            self.index = CacheIndex(cache_dir, self.guess_type)
+            self.index.scan()
+        # Optional DiskQuota keeping the store under max_size bytes
+        self.quota = None
+        if max_size:
+            self.quota = DiskQuota(cache_dir, max_size, eviction, on_evict=self._removed,
+                exclude=(blob_store.root, ) if blob_store else (), packed=self.storage.files,
+                shared=lock_files)
+            self.quota.scan()
+        # Complete files left to fetch in the background after a range request
+        self.background_fill = background_fill
+        # Coordinate fetches with other processes sharing cache_dir through lock files
+        self.lock_files = lock_files
+        # Fetch misses of at least segment_threshold bytes as this many
+        # parallel ranges, if upstream accepts ranges
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        # Optional BlobStore sharing identical files between mirror names
+        self.blob_store = blob_store
+        # Negotiate gzip for compressible_types. The encoded variant is
+        # computed once in the background and kept beside the file.
+        self.compress = compress
+        self._compressing = set()
+        # Upstream errors with negative_statuses are answered from memory for
+        # negative_ttl seconds
+        self.negative_ttl = negative_ttl
+        self.negative_statuses = negative_statuses
+        # path -> (status line, expires), in order of expiry
+        self._negative = OrderedDict()
+        # Base URLs of sibling caches asked before upstream on a miss
+        self.peers = Peers(peers, peer_timeout) if peers else None
+        # Optional RequestLanes limiting requests served at once
+        self.lanes = lanes
+        # Bytes read from upstream at once, and buffered before writing to the
+        # temp file. Followers see bytes no sooner than either fills up.
+        self.read_size = read_size
+        self.write_size = write_size
+        # Reserve disk blocks for files of known size before fetching them
+        self.fallocate = fallocate
+        # Durability of completed fills, see fsync_policies
+        self.fsync = fsync
+        # Interrupted fetches kept to resume are removed once untouched for
+        # partial_ttl seconds, None keeps them forever
+        self.partial_ttl = partial_ttl
+        self.stats = Stats()
+        # GreenPool serving requests, set by start() to report its occupancy
+        self.worker_pool = None
+        # Fetches in progress, keyed by cache path
+        self._fills = {}
+        # Cache paths being revalidated in the background, see _refresh()
+        self._refreshing = set()
+        # Partially cached files, keyed by cache path
+        self._sparse_files = {}
+        self._started = False
+        # Green threads of the background work, see _start()
+        self._background = []
+
+    def _start(self):
+        """
+        Start background work on the hub that serves requests.
+        """
+        self._started = True
+        if self.index:
+            watcher = self.index.watch()
+            if watcher:
+                self._background.append(watcher)
+        if self.quota:
+            self._background.append(eventlet.spawn(self.quota.run, lambda path: path in self._fills))
+            self._background.append(eventlet.spawn(self.quota.tick))
+        if self.blob_store:
+            self._background.append(eventlet.spawn(self.blob_store.run))
+        self._background.append(eventlet.spawn(self.storage.run))
+        if self.partial_ttl:
+            self._background.append(eventlet.spawn(self._sweep))
+
+    def stop(self):
+        """
+        Stop the background work started by the first request, for instances
+        that only serve a while such as the one of warm().
+        """
+        background, self._background = self._background, []
+        for worker in background:
+            worker.kill()
+        self._started = False
+        if self.quota:
+            self.quota.close()
+
+    def _sweep(self):
+        """
+        Sweep for interrupted fetches forever, call in a green thread.
+        """
+        while 1:
+            try:
+                scratch = self._sweep_partials()
+                if self.quota:
+                    self.quota.charge(scratch)
+            except Exception:
+                log.exception('Sweeping interrupted fetches failed')
+            eventlet.sleep(self.sweep_interval)
+
+    def _sweep_partials(self):
+        """
+        Remove files of interrupted fetches nobody resumed within partial_ttl
+        seconds. Returns the bytes on disk of those left to resume.
+        """
+        expired = time.time() - self.partial_ttl
+        scratch = 0
+        for dir, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(RESUMABLE_SUFFIXES):
+                    continue
+
+                path = os.path.join(dir, name)
+                cache_path = os.path.splitext(path)[0]
+                sparse = self._sparse_files.get(cache_path)
+                if cache_path in self._fills or (sparse and sparse.filling) or _locked(cache_path + '.lock'):
+                    continue
+
+                try:
+                    fs = os.stat(path)
+                except OSError:
+                    continue
+
+                if fs.st_mtime >= expired:
+                    # Sparse files only take the blocks fetched so far
+                    scratch += fs.st_blocks * 512
+                elif sparse:
+                    log.info('Discarding partial copy of "%s" unused since %s', cache_path, time.ctime(fs.st_mtime))
+                    sparse.discard()
+                else:
+                    log.info('Removing "%s" of a fetch interrupted at %s', path, time.ctime(fs.st_mtime))
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+            eventlet.sleep(0)
+        return scratch
+
+    def _stored(self, path, meta=None, checksum=None):
+        """
+        Called when a file has been written into the cache.
+        """
+        if self.blob_store:
+            self._add_blob(path, checksum)
+        packed = self._pack(path, meta)
+        if packed:
+            if self.index:
+                self.index.discard(path)
+        else:
+            if meta is not None:
+                self._write_meta(path, meta)
+            if self.compress and self.guess_type(path) in self.compressible_types and path not in self._compressing:
+                self._compressing.add(path)
+                eventlet.spawn_n(self._compress, path)
+            if self.index:
+                self.index.add(path)
+        if self.memory_cache:
+            self.memory_cache.discard(path)
+        if self.quota:
+            try:
+                if packed:
+                    self.quota.add(path, packed)
+                else:
+                    fs = os.stat(path)
+                    self.quota.add(path, fs.st_size, _shared_inode(fs))
+            except OSError:
+                pass
+
+    def _pack(self, path, meta):
+        """
+        Move a file into the storage, returns its size if it was.
+        """
+        if self.compress and self.guess_type(path) in self.compressible_types:
+            # The gzip variant is made from the plain file
+            return None
+        if meta is None:
+            meta = self._read_meta(path)
+        return self.storage.store(path, meta)
+
+    def _open_cached(self, path):
+        """
+        Open a cached file for reading, wherever it is stored.
+        """
+        try:
+            return open(path, 'rb')
+        except IOError:
+            packed = self.storage.open(path)
+            if not packed:
+                raise
+            f, offset, size = packed
+            with f:
+                f.seek(offset)
+                return StringIO(f.read(size))
+
+    def _add_blob(self, path, checksum):
+        repodata, name = os.path.split(path)
+        if os.path.basename(repodata) == 'repodata' and name.endswith(('primary.xml', 'primary.xml.gz')):
+            try:
+                self._learn_packages(os.path.dirname(repodata), path)
+            except Exception:
+                log.exception('Could not read package checksums from "%s"', path)
+        else:
+            self.blob_store.add(path, checksum)
+
+    def _learn_packages(self, repo_dir, primary):
+        with open(primary, 'rb') as f:
+            if primary.endswith('.gz'):
+                f = gzip.GzipFile(fileobj=f)
+            self.blob_store.learn(repo_dir, _primary_packages(f))
+
+    def _record(self, mirror_name, result, cached_bytes=0):
+        """
+        Count a request for path and the bytes it was served from the cache.
+        """
+        mirror = (('mirror', mirror_name),)
+        self.stats.inc('httpcache_requests_total', mirror + (('result', result),))
+        if cached_bytes:
+            self.stats.inc('httpcache_cache_bytes_total', mirror, cached_bytes)
+
+    def _refused(self, path, e):
+        """
+        Remember an upstream HTTPError for path if its status is cached.
+        """
+        status = '%s %s' % (e.code, e)
+        if self.negative_ttl and e.code in self.negative_statuses:
+            now = time.time()
+            self._negative.pop(path, None)
+            self._negative[path] = (status, now + self.negative_ttl)
+            while self._negative:
+                first = next(iter(self._negative.itervalues()))
+                if first[1] > now:
+                    break
+                self._negative.popitem(last=False)
+        return status
+
+    def _negative_status(self, path):
+        entry = self._negative.get(path)
+        if entry is None:
+            return None
+        elif entry[1] < time.time():
+            del self._negative[path]
+            return None
+        return entry[0]
+
+    def stats_text(self):
+        """
+        Metrics in the Prometheus text format.
+        """
+        values = []
+        if self.worker_pool is not None:
+            values += [
+                ('httpcache_pool_running', 'gauge', 'Connections being served', self.worker_pool.running()),
+                ('httpcache_pool_free', 'gauge', 'Free connection slots', self.worker_pool.free()),
+            ]
+        if self.lanes:
+            for lane in ('small', 'large'):
+                values += [
+                    ('httpcache_%s_running' % lane, 'gauge', 'Requests holding a %s lane slot' % lane,
+                        self.lanes.running[lane]),
+                    ('httpcache_%s_queued' % lane, 'gauge', 'Requests waiting for the %s lane' % lane,
+                        len(self.lanes.waiting[lane])),
+                    ('httpcache_%s_slots' % lane, 'gauge', 'Slots of the %s lane' % lane,
+                        self.lanes.slots[lane]),
+                ]
+
+        pool_stats = self.connection_pool.stats()
+        values += [
+            ('httpcache_upstream_connections_created_total', 'counter', 'Upstream connections opened',
+                pool_stats['created']),
+            ('httpcache_upstream_connections_reused_total', 'counter', 'Upstream requests on a reused connection',
+                pool_stats['reused']),
+            ('httpcache_upstream_connections_idle', 'gauge', 'Idle upstream connections', pool_stats['idle']),
+            ('httpcache_fills_in_flight', 'gauge', 'Upstream fetches in progress', len(self._fills)),
+        ]
+        if self.memory_cache:
+            values.append(('httpcache_memory_bytes', 'gauge', 'Bytes held in the memory tier', self.memory_cache.size))
+        # Counted by the worker keeping a shared quota only
+        if self.quota and self.quota.keeper:
+            values += [
+                ('httpcache_disk_bytes', 'gauge', 'Bytes held in cache_dir', self.quota.size),
+                ('httpcache_evicted_files_total', 'counter', 'Files evicted for the disk quota', self.quota.evicted),
+            ]
+
+        return self.stats.render(values)
+
+    def _removed(self, path):
+        """
+        Called when a file is evicted from the cache, before it is removed.
+        """
+        if self.blob_store:
+            self.blob_store.release(path)
+        self.storage.discard(path)
+        if self.index:
+            self.index.discard(path)
+        if self.memory_cache:
+            self.memory_cache.discard(path)
+
+    def _read_meta(self, path):
+        try:
+            with open(path + '.meta', 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return self.storage.meta(path)
+
+    def _write_meta(self, path, meta):
+        tmp_path = path + '.meta.tmp'
+        with open(tmp_path, 'wb') as f:
+            json.dump(meta, f)
+        os.rename(tmp_path, path + '.meta')
+
+    def _validators(self, path):
+        """
+        Validator headers kept for a cached file.
+        """
+        if self.index:
+            validators = self.index.meta.get(path)
+            if validators is None:
+                meta = self._read_meta(path)
+                validators = self.index.meta[path] = [(name, meta[name]) for name in META_HEADERS if name in meta]
+            return validators
+
+        meta = self._read_meta(path)
+        return [(name, meta[name]) for name in META_HEADERS if name in meta]
+
+    def _not_modified(self, environ, validators):
+        """
+        Return True if the client's conditional headers match validators.
+        """
+        validators = dict(validators)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match:
+            etag = validators.get('ETag')
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return bool(etag) and ('*' in tags or etag in tags)
 
-        total = (self.range[1] - self.range[0]) + 1
-        sent = 0
-        remaining = total
-        while remaining:
-            output = self.f.read(min(self.readsize, remaining))
-            if not output:
-                break
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE', None)
+        last_modified = validators.get('Last-Modified')
+        if if_modified_since and last_modified:
+            since = email.utils.parsedate_tz(if_modified_since)
+            modified = email.utils.parsedate_tz(last_modified)
+            if since and modified:
+                return email.utils.mktime_tz(modified) <= email.utils.mktime_tz(since)
 
-            yield output
-            size = len(output)
-            sent += size
-            remaining -= size
-            
-        log.debug('Sent %d bytes of %d (range: %d-%d)', sent, total, self.range[0], self.range[1])
-        self.f.close()
-                
-# FIXME Handle range downloads (need to download the full file, not just the range)        
-class FileCacheContent(object):
-    readsize = 4096
+        return False
 
-    def __init__(self, f, outfilename):
-        self.f = f
-        
-        self.outfilename = outfilename
-        self.outfile = open(self.outfilename + '.tmp', 'wb', self.readsize)
-        
-    def __iter__(self):
-        sent = 0
-        while 1:
-            bytes = self.f.read(self.readsize)
-            if not bytes:
-                break
-                
-            self.outfile.write(bytes)
-            
-            yield bytes
-            sent += len(bytes)
-            
-        log.debug('Sent %d bytes', sent)
-                       
-        self.f.close()
-        self.outfile.close()
-        os.rename(self.outfilename + '.tmp', self.outfilename)
-                
-class HttpCache(object):
-    """
-    HTTP pass-through cache server.
+    def _max_age(self, url):
+        for pattern, max_age in self.freshness:
+            if fnmatch.fnmatch(url, pattern):
+                return max_age
 
-    Requests first checked for local copy, if not existing
-    requests are forwarded to remote_base_url.
+    def _expires(self, path):
+        """
+        When the cached copy of path goes stale, None if it never does.
+        """
+        if not self.freshness:
+            return None
+        names = os.path.relpath(path, self.cache_dir).split(os.sep, 1)
+        max_age = self._max_age('/' + names[-1].replace(os.sep, '/')) if len(names) == 2 else None
+        if max_age is None:
+            return None
+        entry = self._lookup(path)
+        return (self._validated(path, entry[1]) if entry else time.time()) + max_age
 
-    Files are cached in cache_dir.
-    """
-    extensions_map = {
-        '.rpm' : 'application/x-redhat-package-manager',
-        None : 'application/octet-stream',
-    }
-        
-    def __init__(self, remote_base_urls, cache_dir):
-        self.mirrors = remote_base_urls
-        self.cache_dir = cache_dir
+    def _freshness(self, url, path, mtime):
+        """
+        The max_age of a cached file, None if it never goes stale, and when
+        its copy with mtime was last known to be current.
+        """
+        max_age = self._max_age(url) if self.freshness else None
+        if max_age is not None and time.time() - mtime > max_age:
+            mtime = self._validated(path, mtime)
+        return max_age, mtime
+
+    def _validated(self, path, mtime):
+        """
+        When the cached copy of path with mtime was last known to be current.
+        """
+        return max(mtime, self._read_meta(path).get(VALIDATED_META, 0))
+
+    def _lookup(self, path):
+        """
+        Return (size, mtime, content type) of a cached file or None.
+        """
+        if self.index:
+            entry = self.index.get(path)
+            if entry or self.index.watching:
+                return entry or self._lookup_packed(path)
+
+        try:
+            fs = os.stat(path)
+        except OSError:
+            return self._lookup_packed(path)
+
+        if not stat.S_ISREG(fs.st_mode):
+            return None
+        elif self.index:
+            self.index.add(path)
+        return fs.st_size, fs.st_mtime, self.guess_type(path)
+
+    def _lookup_packed(self, path):
+        entry = self.storage.lookup(path)
+        if entry:
+            return entry + (self.guess_type(path), )
+
+    def guess_type(self, path):
+        name, ext = os.path.splitext(path)
+        return self.extensions_map.get(ext, self.extensions_map[None])
         
     def translate_path(self, mirror_name, path):
         """Translate a /-separated PATH to the local filename syntax.
@@ -166,17 +3307,12 @@ class HttpCache(object):
         url += quote(environ.get('PATH_INFO','')).replace(url.replace(':', '%3A'), '')
         return url
                 
+    def _status_line(self, response):
+        return '%d %s' % (response.status, BaseHTTPRequestHandler.responses[response.status][0])
+
     def _start_response(self, start_response, response):
-        status = '%d %s' % (response.status, BaseHTTPRequestHandler.responses[response.status][0])
-        start_response(status, response.headers)
-                
-    def _find_file(self, paths):
-        for path, range in paths:
-            if os.path.isfile(path):
-                return path, range
+        start_response(self._status_line(response), response.headers)
                 
-        return None, None
-        
     def _get_range(self, environ):
         http_range = environ.get('HTTP_RANGE', None)
         if http_range:
@@ -189,7 +3325,144 @@ class HttpCache(object):
                 
             return (int(m.group('start')), end)
         
-    def do_GET(self, environ, start_response):
+    def _open_upstream(self, mirror_name, url, headers=None, method='GET', source=None):
+        """
+        Request url from the best upstream of the mirror, or from source, the
+        full URL of an earlier response whose validator must hold.
+        """
+        labels = (('mirror', mirror_name),)
+        start = time.time()
+        try:
+            if source:
+                remote_file = self.connection_pool.urlopen(source, headers, method)
+            else:
+                remote_file = self.mirrors[mirror_name].urlopen(self.connection_pool, url, headers, method)
+        finally:
+            self.stats.observe('httpcache_upstream_ttfb_seconds', time.time() - start, labels)
+
+        def closed(remote_file):
+            self.stats.observe('httpcache_upstream_seconds', time.time() - start, labels)
+            self.stats.inc('httpcache_upstream_bytes_total', labels, remote_file.bytes_read)
+
+        remote_file.on_close = closed
+        return remote_file
+
+    def _not_satisfiable(self, start_response, size):
+        start_response('416 Requested Range Not Satisfiable', [
+            ('Content-Range', 'bytes */%d' % size),
+        ])
+        return ''
+
+    def _resolve(self, environ):
+        """
+        Return the mirror name, mirror relative url and cache path of a request.
+        """
+        url = self.reconstruct_url(environ)
+        _, mirror_name, url = url.split('/', 2)
+        url = '/' + url
+        return mirror_name, url, self.translate_path(mirror_name, url)
+
+    def do_HEAD(self, environ, start_response):
+        """
+        Answer from the cache when possible, otherwise ask upstream without
+        caching anything.
+        """
+        mirror_name, url, path = self._resolve(environ)
+
+        entry = self.memory_cache and self.memory_cache.get(path)
+        if entry:
+            data, status, headers = entry
+            if self._not_modified(environ, headers):
+                start_response('304 Not Modified', [header for header in headers if header[0] in META_HEADERS])
+            else:
+                start_response(status, headers)
+            return ['']
+
+        response = None
+        entry = self._lookup(path)
+        if entry:
+            response = self._cached_response(mirror_name, url, path, entry)
+        elif PEER_ENVIRON in environ:
+            # A peer asking, see Peers
+            start_response('404 Not Found', [])
+            return ['']
+        elif path in self._fills:
+            fill = self._fills[path]
+            fill.wait()
+            response = fill.response
+        elif path in self._sparse_files:
+            sparse = self._sparse_files[path]
+            response = Response(self.guess_type(path), sparse.size, headers=_validator_meta(sparse.blocks.validator).items())
+        elif self._negative:
+            status = self._negative_status(path)
+            if status:
+                start_response(status, [])
+                return ['']
+
+        if response is None:
+            try:
+                remote_file = self._open_upstream(mirror_name, url, method='HEAD')
+            except urllib2.HTTPError as e:
+                start_response(self._refused(path, e), [])
+                return ['']
+            except Exception as e:
+                log.warning('Could not reach upstream of "%s": %s', path, e)
+                start_response('502 Bad Gateway', [])
+                return ['']
+
+            info = remote_file.info()
+            remote_file.close()
+            headers = [(name, info.getheader(name)) for name in ('Content-Length', ) + META_HEADERS
+                if info.getheader(name)]
+            if remote_file.code == 200:
+                headers = self._vary(self.guess_type(path), headers)
+            start_response('%d %s' % (remote_file.code, remote_file.msg), headers)
+        elif self._not_modified(environ, response.extra_headers):
+            start_response('304 Not Modified', response.extra_headers)
+        else:
+            self._start_response(start_response, Response(response.content_type, response.size,
+                headers=self._vary(response.content_type, response.extra_headers)))
+        return ['']
+
+    def _cached_response(self, mirror_name, url, path, entry):
+        """
+        Response to a HEAD for the cached file of entry, revalidated first if
+        it is stale as for a GET. None if refetching it failed.
+        """
+        size, mtime, ctype = entry
+        max_age, mtime = self._freshness(url, path, mtime)
+        if max_age is not None and time.time() - mtime > max_age:
+            if self.stale_while_revalidate:
+                self._queue_refresh(mirror_name, url, path, ctype, size)
+            else:
+                fill = self._fills.get(path)
+                if not fill:
+                    refetch = self._revalidate(mirror_name, url, path, ctype, size)
+                    if refetch:
+                        fill, remote_file = refetch
+                        if remote_file:
+                            # Cache the new copy as a GET would
+                            eventlet.spawn_n(self._drain, mirror_name, url, ctype, fill, remote_file)
+                if fill:
+                    fill.wait()
+                    return fill.response
+
+        return Response(ctype, size, headers=self._validators(path))
+
+    def _find(self, environ):
+        """
+        Resolve a GET request and look its file up in the memory tier, or
+        failing that the cache. Returns the mirror name, mirror relative url,
+        cache path, memory tier entry and cache entry.
+        """
+        mirror_name, url, path = self._resolve(environ)
+        if self.memory_cache and not self._accepts_gzip(environ, self.guess_type(path)):
+            cached = self.memory_cache.get(path)
+            if cached:
+                return mirror_name, url, path, cached, None
+        return mirror_name, url, path, None, self._lookup(path)
+
+    def do_GET(self, environ, start_response, found=None):
         """Common code for GET and HEAD commands.
 
         This sends the response code and MIME headers.
@@ -199,110 +3472,906 @@ class HttpCache(object):
         and must be closed by the caller under all circumstances), or
         None, in which case the caller has nothing further to do.
 
+        found is what _find returned for the request, if it was called
+        already.
         """
         log.debug(environ)
-        url = self.reconstruct_url(environ)
-        _, mirror_name, url = url.split('/', 2)
-        url = '/' + url
-        path = self.translate_path(mirror_name, url)
-        if os.path.isdir(path):
+        mirror_name, url, path, cached, entry = found or self._find(environ)
+        range = self._get_range(environ)
+
+        if self.quota:
+            self.quota.touch(path)
+
+        if cached:
+            return self._serve_memory(environ, start_response, mirror_name, cached, range)
+
+        if entry:
+            size, mtime, ctype = entry
+            max_age, mtime = self._freshness(url, path, mtime)
+            content = None
+            if max_age is None or time.time() - mtime <= max_age:
+                content = self._serve_file(environ, start_response, mirror_name, path, ctype, range, size,
+                    mtime + max_age if max_age is not None else None)
+            elif self.stale_while_revalidate:
+                self._queue_refresh(mirror_name, url, path, ctype, size)
+                # Stale already, never served from memory without a look
+                content = self._serve_file(environ, start_response, mirror_name, path, ctype, range, size,
+                    time.time())
+            elif path not in self._fills:
+                refetch = self._revalidate(mirror_name, url, path, ctype, size)
+                if refetch is None:
+                    content = self._serve_file(environ, start_response, mirror_name, path, ctype, range, size,
+                        time.time() + max_age)
+                else:
+                    fill, remote_file = refetch
+                    if remote_file is None:
+                        return self._follow(start_response, mirror_name, fill, ctype, range)
+                    self._record(mirror_name, 'miss')
+                    return self._cache_response(start_response, remote_file, fill, ctype,
+                        self._opener(mirror_name, url))
+
+            if content is not None:
+                return content
+            # Removed since it was indexed, fetch it again
+
+        elif os.path.isdir(path):
             return
 
+        if PEER_ENVIRON in environ:
+            # Only complete files are shared with peers, so a miss never
+            # bounces between caches
+            start_response('404 Not Found', [])
+            return ''
+
         log.debug('Serving %s: %s - %s', mirror_name, path, url)
         
-        name, ext = os.path.splitext(path)
-        ctype = self.extensions_map.get(ext, self.extensions_map[None])
-        
-        range = self._get_range(environ)   
-        range_path = path 
-        if range:
-            name, ext = os.path.splitext(path)                        
-            range_path = '%s(%d-%d)%s' % (name, range[0], range[1], ext)
-                        
-        local_path, file_range = self._find_file([(path, True), (range_path, False)])
-        if local_path:
-            try:
-                # Always read in binary mode. Opening files in text mode may cause
-                # newline translations, making the actual size of the content
-                # transmitted *less* than the content-length!
-                f = open(local_path, 'rb')
-            except IOError:
-                start_response('500 Could not read file', [])
-                return ''
-                
-            fs = os.stat(local_path)
+        ctype = self.guess_type(path)
+
+        fill = self._fills.get(path)
+        if fill:
+            return self._follow(start_response, mirror_name, fill, ctype, range)
+
+        status = self._negative and self._negative_status(path)
+        if status:
+            self._record(mirror_name, 'negative')
+            start_response(status, [])
+            return ''
+
+        if self.blob_store and self.blob_store.link(path):
+            log.info('Linked "%s" from the blob store', path)
+            self._stored(path, checksum=self.blob_store.known[path])
+            content = self._serve_file(environ, start_response, mirror_name, path, ctype, range)
+            if content is not None:
+                return content
+
+        sparse = self._sparse_files.get(path)
+        if not sparse:
+            sparse = SparseFile.load(path, self._opener(mirror_name, url), self)
+
+        if sparse:
+            return self._serve_sparse(start_response, mirror_name, sparse, ctype, range)
+        elif range:
+            return self._start_sparse(start_response, mirror_name, url, path, ctype, range)
+        else:
+            return self._start_fill(start_response, mirror_name, url, path, ctype)
+
+    def _revalidate(self, mirror_name, url, path, ctype, size):
+        """
+        Conditionally refetch a stale file.
+
+        Returns None if the cached copy is still current, otherwise the
+        CacheFill and upstream response to replace it with. If another worker
+        is already refetching it, its ForeignFill and None.
+        """
+        lock = self._fill_lock(path)
+        if lock is False:
+            return ForeignFill(path, ctype, self.storage), None
+
+        fill = CacheFill(path, self, lock)
+        meta = self._read_meta(path)
+        headers = {}
+        if meta.get('ETag'):
+            headers['If-None-Match'] = meta['ETag']
+        if meta.get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['Last-Modified']
+
+        try:
+            remote_file = self._open_upstream(mirror_name, url, headers)
+        except Exception as e:
+            log.warning('Could not revalidate "%s", serving stale copy: %s', path, e)
+            remote_file = None
+        else:
+            if remote_file.code != 304:
+                log.info('Refreshing "%s"', path)
+                return fill, remote_file
+
+            remote_file.close()
+            log.debug('Revalidated "%s"', path)
+            if not self.storage.touch(path):
+                # Not in the mtime, the gzip variant would look stale and the
+                # quota would count a newly stored file
+                meta[VALIDATED_META] = time.time()
+                self._write_meta(path, meta)
+
+        fill.unchanged(Response(ctype, size))
+
+    def _queue_refresh(self, mirror_name, url, path, ctype, size):
+        """
+        Revalidate a stale file in the background, unless that is under way.
+        """
+        if path not in self._fills and path not in self._refreshing:
+            self._refreshing.add(path)
+            eventlet.spawn_n(self._refresh, mirror_name, url, path, ctype, size)
+
+    def _refresh(self, mirror_name, url, path, ctype, size):
+        """
+        Revalidate a stale file in the background.
+        """
+        try:
+            refetch = self._revalidate(mirror_name, url, path, ctype, size)
+            if refetch and refetch[1]:
+                fill, remote_file = refetch
+                self._drain(mirror_name, url, ctype, fill, remote_file)
+        finally:
+            self._refreshing.discard(path)
+
+    def _drain(self, mirror_name, url, ctype, fill, remote_file):
+        """
+        Cache an upstream response without a client to send it to.
+        """
+        for _ in self._cache_response(lambda status, headers: None, remote_file, fill, ctype,
+                self._opener(mirror_name, url)):
+            pass
+
+    def _serve_file(self, environ, start_response, mirror_name, path, ctype, range, filesize=None, expires=None):
+        """
+        Serve a cached file. Returns None without responding if it is gone,
+        for the caller to fetch it again.
+        """
+        try:
+            # Always read in binary mode. Opening files in text mode may cause
+            # newline translations, making the actual size of the content
+            # transmitted *less* than the content-length!
+            f = open(path, 'rb')
+            offset = None
+        except IOError:
+            packed = self.storage.open(path)
+            if not packed:
+                if self.index:
+                    self.index.discard(path)
+                return None
+            f, offset, filesize = packed
+
+        if filesize is None:
+            fs = os.fstat(f.fileno())
             filesize = fs[6]
-                
-            response = Response(ctype, filesize, range)
-            content = FileContent(f, range=(response.content_start, response.content_end) if file_range else None)            
+        if range and range[0] >= filesize:
+            f.close()
+            return self._not_satisfiable(start_response, filesize)
+
+        validators = headers = self._validators(path)
+        if self.compress and ctype in self.compressible_types:
+            if not range and self._accepts_gzip(environ, ctype):
+                content = self._serve_gzip(environ, start_response, mirror_name, path, ctype, f, validators)
+                if content is not None:
+                    return content
+            headers = self._vary(ctype, validators)
+
+        if self.memory_cache and filesize <= self.memory_cache.max_object_size:
+            with f:
+                if offset is not None:
+                    f.seek(offset)
+                data = f.read(filesize)
+            full = Response(ctype, len(data), headers=headers)
+            entry = (data, self._status_line(full), full.headers)
+            if expires is None:
+                expires = self._expires(path)
+            self.memory_cache.put(path, data, entry[1], entry[2], expires)
+            return self._serve_memory(environ, start_response, mirror_name, entry, range)
 
-            self._start_response(start_response, response)
+        if self._not_modified(environ, validators):
+            f.close()
+            self._record(mirror_name, 'hit')
+            start_response('304 Not Modified', validators)
+            return ['']
+
+        response = Response(ctype, filesize, range, headers)
+        self._record(mirror_name, 'hit', response.content_length)
+        file_wrapper = environ.get('wsgi.file_wrapper', None)
+        if offset is not None:
+            # Served from a pack
+            start, end = response.content_range
+            content = FileContent(f, range=(offset + start, offset + end))
+        elif file_wrapper and response.status == 200:
+            # Let the server use sendfile() or similar for full hits
+            content = file_wrapper(f, FileContent.readsize)
+        else:
+            content = FileContent(f, range=response.content_range)
+
+        self._start_response(start_response, response)
+        return content
+
+    def _vary(self, ctype, headers):
+        """
+        Add Vary to the headers of a response whose encoding is negotiated.
+        """
+        headers = list(headers)
+        if self.compress and ctype in self.compressible_types and 'Vary' not in dict(headers):
+            headers.append(('Vary', 'Accept-Encoding'))
+        return headers
+
+    def _accepts_gzip(self, environ, ctype):
+        if not self.compress or ctype not in self.compressible_types:
+            return False
+        for coding in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            coding, _, params = coding.partition(';')
+            if coding.strip() == 'gzip':
+                return not re.match(r'^\s*q\s*=\s*0(\.0*)?\s*$', params)
+        return False
+
+    def _serve_gzip(self, environ, start_response, mirror_name, path, ctype, f, validators):
+        """
+        Serve the gzip variant of the open cached file f, if it is current.
+
+        Otherwise start computing it and return None.
+        """
+        try:
+            variant = open(path + '.gzip', 'rb')
+        except IOError:
+            variant = None
+        else:
+            # The variant carries the mtime of the file it was made from
+            if abs(os.fstat(variant.fileno()).st_mtime - os.fstat(f.fileno()).st_mtime) > 0.001:
+                variant.close()
+                variant = None
+
+        if variant is None:
+            if path not in self._compressing:
+                self._compressing.add(path)
+                eventlet.spawn_n(self._compress, path)
+            return None
+
+        f.close()
+        validators = [
+            (name, value[:-1] + '-gzip"' if name == 'ETag' and value.endswith('"') else value)
+            for name, value in validators
+        ]
+        if self._not_modified(environ, validators):
+            variant.close()
+            self._record(mirror_name, 'hit')
+            start_response('304 Not Modified', validators)
+            return ['']
+
+        response = Response(ctype, os.fstat(variant.fileno()).st_size,
+            headers=validators + [('Content-Encoding', 'gzip'), ('Vary', 'Accept-Encoding')])
+        self._record(mirror_name, 'hit', response.content_length)
+        self._start_response(start_response, response)
+        return FileContent(variant, response.content_range)
+
+    def _compress(self, path):
+        """
+        Write the gzip variant of a cached file.
+        """
+        tmp_path = '%s.gzip.%d.tmp' % (path, os.getpid())
+        try:
+            with open(path, 'rb') as f:
+                mtime = os.fstat(f.fileno()).st_mtime
+                with open(tmp_path, 'wb') as out:
+                    gz = gzip.GzipFile(os.path.basename(path), 'wb', 6, out, mtime)
+                    for block in iter(lambda: f.read(FileContent.readsize), ''):
+                        gz.write(block)
+                        eventlet.sleep()
+                    gz.close()
+            os.utime(tmp_path, (mtime, mtime))
+            os.rename(tmp_path, path + '.gzip')
+        except (IOError, OSError) as e:
+            log.warning('Could not compress "%s": %s', path, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        finally:
+            self._compressing.discard(path)
+
+    def _serve_memory(self, environ, start_response, mirror_name, entry, range):
+        data, status, headers = entry
+        if self._not_modified(environ, headers):
+            self._record(mirror_name, 'hit')
+            start_response('304 Not Modified', [header for header in headers if header[0] in META_HEADERS])
+            return ['']
+        elif not range:
+            self._record(mirror_name, 'hit', len(data))
+            start_response(status, headers)
+            return [data]
+        elif range[0] >= len(data):
+            return self._not_satisfiable(start_response, len(data))
+
+        response = Response(dict(headers).get('Content-Type'), len(data), range,
+            [header for header in headers if header[0] in META_HEADERS])
+        self._record(mirror_name, 'hit', response.content_length)
+        self._start_response(start_response, response)
+        return [data[response.content_start:response.content_end + 1]]
+
+    def _follow(self, start_response, mirror_name, fill, ctype, range):
+        log.debug('Following in-flight fetch of %s', fill.path)
+        fill.wait()
+        if fill.status:
+            start_response(fill.status, [])
+            return ''
+        elif fill.failed:
+            start_response('502 Bad Gateway', [])
+            return ''
+
+        try:
+            content = FollowContent(fill, readsize=self.read_size)
+        except IOError:
+            if not self._lookup_packed(fill.path):
+                raise
+            # Small enough to have been moved into a pack already
+            content = self._serve_file({}, start_response, mirror_name, fill.path, ctype, range)
+            if content is None:
+                raise
             return content
+
+        response = fill.response
+        headers = self._vary(ctype, response.extra_headers)
+        if range and response.size:
+            if range[0] >= response.size:
+                content.f.close()
+                return self._not_satisfiable(start_response, response.size)
+            response = Response(ctype, response.size, range, headers)
         else:
-            fetch_url = self.mirrors[mirror_name] + url
-            headers = {}
-            if range:
-                headers = {
-                    'Range' : 'bytes=%d-%s' % (range[0], range[1] if range[1] != -1 else '')
-                }
-                
-            fetch_request = urllib2.Request(fetch_url, headers=headers)
-            
+            response = Response(response.content_type, response.size, headers=headers)
+
+        content.range = response.content_range if range else None
+        self._record(mirror_name, 'coalesced', response.content_length)
+        self._start_response(start_response, response)
+        return content
+
+    def _opener(self, mirror_name, url):
+        """
+        Return a function opening url with headers, optionally from a source
+        URL as in _open_upstream.
+        """
+        return lambda headers, source=None: self._open_upstream(mirror_name, url, headers, source=source)
+
+    def _serve_sparse(self, start_response, mirror_name, sparse, ctype, range, remote_file=None):
+        if range and range[0] >= sparse.size:
+            return self._not_satisfiable(start_response, sparse.size)
+
+        if self.background_fill and not sparse.filling:
+            eventlet.spawn_n(sparse.fill_missing)
+
+        response = Response(ctype, sparse.size, range, _validator_meta(sparse.blocks.validator).items())
+        start, end = response.content_range
+        block_size = sparse.blocks.block_size
+        if any(block in sparse.blocks for block in xrange(start // block_size, end // block_size + 1)):
+            result = 'partial'
+        else:
+            result = 'miss'
+
+        self._start_response(start_response, response)
+        return SparseContent(sparse, response.content_range, remote_file,
+            lambda cached: self._record(mirror_name, result, cached))
+
+    def _start_sparse(self, start_response, mirror_name, url, path, ctype, range):
+        """
+        Fetch the blocks around a range of an uncached file.
+        """
+        if self.lock_files and _locked(path + '.lock'):
+            # Another worker is fetching the whole file
+            return self._follow(start_response, mirror_name, ForeignFill(path, ctype, self.storage), ctype, range)
+
+        block_size = SparseFile.block_size
+        start = range[0] // block_size * block_size
+        end = ''
+        if range[1] != -1:
+            end = (range[1] // block_size + 1) * block_size - 1
+
+        try:
+            remote_file = self._open_upstream(mirror_name, url, {
+                'Range' : 'bytes=%d-%s' % (start, end)
+            })
+        except urllib2.HTTPError as e:
+            self._record(mirror_name, 'error')
+            start_response(self._refused(path, e), [])
+            return ''
+        except Exception as e:
+            log.warning('Could not reach upstream of "%s": %s', path, e)
+            self._record(mirror_name, 'error')
+            start_response('502 Bad Gateway', [])
+            return ''
+
+        content_range = _content_range(remote_file)
+        if not content_range:
+            # Upstream ignored the range, cache the whole file instead
+            fill = self._fills.get(path)
+            if fill:
+                remote_file.close()
+                return self._follow(start_response, mirror_name, fill, ctype, None)
+
+            lock = self._fill_lock(path)
+            if lock is False:
+                remote_file.close()
+                fill = ForeignFill(path, ctype, self.storage)
+                return self._follow(start_response, mirror_name, fill, ctype, None)
+            elif lock and (os.path.isfile(path) or self._lookup_packed(path)):
+                # Another process finished it before we got the lock
+                content = self._serve_file({}, start_response, mirror_name, path, ctype, range)
+                if content is not None:
+                    remote_file.close()
+                    _unlock(lock)
+                    return content
+
+            fill = CacheFill(path, self, lock)
+            self._record(mirror_name, 'miss')
+            return self._cache_response(start_response, remote_file, fill, ctype)
+
+        sparse = self._sparse_files.get(path)
+        if not sparse:
+            log.info('Caching ranges of "%s" as "%s"', remote_file.geturl(), path)
+            sparse = SparseFile.create(path, content_range[2], _validator(remote_file),
+                self._opener(mirror_name, url), self, remote_file.geturl())
+
+        return self._serve_sparse(start_response, mirror_name, sparse, ctype, range, remote_file)
+
+    def _fill_lock(self, path):
+        """
+        With lock_files, take the lock other workers see while path is
+        fetched. Returns False if another worker holds it, None without
+        lock_files.
+        """
+        if not self.lock_files:
+            return None
+        _makedirs(os.path.dirname(path))
+        lock = _try_lock(path + '.lock')
+        if not lock:
+            return False
+        try:
+            # Left by an earlier refused fill
+            os.unlink(path + '.status')
+        except OSError:
+            pass
+        return lock
+
+    def _start_fill(self, start_response, mirror_name, url, path, ctype):
+        lock = self._fill_lock(path)
+        if lock is False:
+            return self._follow(start_response, mirror_name, ForeignFill(path, ctype, self.storage), ctype, None)
+        elif lock and (os.path.isfile(path) or self._lookup_packed(path)):
+            # Another process finished it before we got the lock
+            content = self._serve_file({}, start_response, mirror_name, path, ctype, None)
+            if content is not None:
+                _unlock(lock)
+                return content
+
+        fill = CacheFill(path, self, lock)
+        partial = self._partial_download(path)
+        if self.peers and not partial and self._max_age(url) is None:
+            # Files that change upstream could be stale on a peer
+            remote_file = self.peers.urlopen(mirror_name, url)
+            if remote_file:
+                log.info('Caching "%s" as "%s"', remote_file.geturl(), path)
+                self._record(mirror_name, 'peer')
+                return self._cache_response(start_response, remote_file, fill, ctype)
+
+        remote_file = None
+        if partial:
+            # If-Range makes upstream send the whole file if it changed. Ask
+            # the upstream the validator came from, others have their own.
+            headers = {'Range' : 'bytes=%d-' % partial[0], 'If-Range' : partial[1]}
             try:
-                remote_file = urllib2.urlopen(fetch_request)
-            except urllib2.HTTPError as e:
-                start_response('%s %s' % (e.code, e), [])
-                return ''
-                
-            log.info('Caching "%s" as "%s"', fetch_url, range_path)
+                remote_file = self._open_upstream(mirror_name, url, headers, source=partial[2])
+                if remote_file.code == 206 and (_content_range(remote_file) or (None, ))[0] != partial[0]:
+                    raise IOError('Upstream sent range %s' % remote_file.info().getheader('Content-Range'))
+            except Exception as e:
+                log.warning('Could not resume "%s" from %s: %s', path, partial[2], e)
+                if remote_file is not None:
+                    remote_file.close()
+                    remote_file = None
+        try:
+            if remote_file is None:
+                remote_file = self._open_upstream(mirror_name, url)
+        except urllib2.HTTPError as e:
+            status = self._refused(path, e)
+            fill.refuse(status)
+            self._record(mirror_name, 'error')
+            start_response(status, [])
+            return ''
+        except Exception as e:
+            # Every upstream failed, answer as followers of the fill are
+            log.warning('Could not reach upstream of "%s": %s', path, e)
+            fill.refuse('502 Bad Gateway')
+            self._record(mirror_name, 'error')
+            start_response('502 Bad Gateway', [])
+            return ''
+        except:
+            fill.refuse('502 Bad Gateway')
+            raise
 
-            dir = os.path.dirname(range_path)
-            if not os.path.exists(dir):
-                os.makedirs(dir)
-                
-            response_range = remote_file.info().getheader('Content-Range', None)         
-            if response_range:
-                m = re.match(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<size>\d+)$', response_range)
-                filesize = int(m.group('size'))
-                range = int(m.group('start')), int(m.group('end'))
+        offset = 0
+        content_range = partial and _content_range(remote_file)
+        if content_range and content_range[0] == partial[0]:
+            log.info('Resuming "%s" as "%s" at %d bytes', remote_file.geturl(), path, partial[0])
+            offset = partial[0]
+        else:
+            log.info('Caching "%s" as "%s"', remote_file.geturl(), path)
+        self._record(mirror_name, 'miss')
+        return self._cache_response(start_response, remote_file, fill, ctype,
+            self._opener(mirror_name, url), offset)
+
+    def _partial_download(self, path):
+        """
+        Return (bytes, validator, source URL) of an interrupted fetch of path
+        to resume.
+        """
+        try:
+            with open(path + '.progress', 'rb') as f:
+                record = json.load(f)
+            if record['validator'] and 0 < record['written'] <= os.path.getsize(path + '.tmp'):
+                return record['written'], record['validator'], record.get('source')
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def _cache_response(self, start_response, remote_file, fill, ctype, opener=None, offset=0):
+        try:
+            _makedirs(os.path.dirname(fill.path))
+
+            info = remote_file.info()
+            if offset:
+                filesize = _content_range(remote_file)[2]
             else:
-                filesize = int(remote_file.info().getheader('Content-Length', 0))
-                
-            response = Response(ctype, filesize, range)
-            content = FileCacheContent(remote_file, range_path)            
-            
-            self._start_response(start_response, response)
-            return content
+                filesize = int(info.getheader('Content-Length', 0))
+            segmented = (opener and not offset and self.segments > 1 and filesize >= self.segment_threshold
+                and info.getheader('Accept-Ranges', '') == 'bytes')
+            fill.meta = dict((name, info.getheader(name)) for name in META_HEADERS if info.getheader(name))
+            if opener:
+                fill.source = remote_file.geturl()
+            response = Response(ctype, filesize, headers=self._vary(ctype, fill.meta.items()))
+            fill.start(response, self.write_size, preallocate=segmented, offset=offset)
+        except:
+            remote_file.close()
+            fill.refuse('500 Internal Server Error')
+            raise
+
+        if segmented:
+            log.info('Fetching %s in %d segments', fill.path, self.segments)
+            download = SegmentedDownload(fill, remote_file, opener, self.segments, self.read_size)
+        else:
+            download = StreamingDownload(fill, remote_file, self.read_size)
+        # Open the temp file before the download can rename it
+        content = FollowContent(fill, readsize=self.read_size)
+        eventlet.spawn_n(download.run)
+        self._start_response(start_response, response)
+        return content
                             
     def __call__(self, environ, start_response):
+        if not self._started:
+            self._start()
+
+        if environ.get('PATH_INFO') == '/_stats':
+            body = self.stats_text()
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain; version=0.0.4'),
+                ('Content-Length', str(len(body))),
+            ])
+            return [body]
+        elif self.lanes:
+            return self._admit(environ, start_response)
+        return self._handle(environ, start_response)
+
+    def _handle(self, environ, start_response, found=None):
         if environ['REQUEST_METHOD'] == 'GET':
-            return self.do_GET(environ, start_response)
+            return self.do_GET(environ, start_response, found)
+        elif environ['REQUEST_METHOD'] == 'HEAD':
+            return self.do_HEAD(environ, start_response)
         else:
             raise Exception('Unkown method %s' % environ['REQUEST_METHOD'])
 
-def serve(mirror_url, cache_dir, port=8996):
-    listener = HttpCache(mirror_url, cache_dir)
+    def _admit(self, environ, start_response):
+        """
+        Handle a request once its lane has a free slot, or shed it.
+        """
+        # Looked up once, do_GET carries on with the result. A file gone
+        # meanwhile is fetched again, see _serve_file.
+        found = self._find(environ) if environ['REQUEST_METHOD'] == 'GET' else None
+        lane = self.lanes.classify(self._expected_size(environ, found))
+        start = time.time()
+        slot = self.lanes.acquire(lane)
+        self.stats.observe('httpcache_queue_wait_seconds', time.time() - start, (('lane', lane),))
+        if slot is None:
+            self.stats.inc('httpcache_shed_total', (('lane', lane),))
+            start_response('503 Service Unavailable', [
+                ('Retry-After', str(self.lanes.retry_after)),
+                ('Content-Length', '0'),
+            ])
+            return ['']
+
+        held = [slot]
+        def release():
+            if held:
+                self.lanes.release(held.pop())
+
+        admitted = time.time()
+        def admitted_start_response(status, headers):
+            self.lanes.observe(lane, time.time() - admitted)
+            size = dict((name.lower(), value) for name, value in headers).get('content-length')
+            if held and size and self.lanes.classify(int(size)) == 'large':
+                held[0] = self.lanes.promote(held[0])
+            return start_response(status, headers)
+
+        try:
+            return LaneContent(self._handle(environ, admitted_start_response, found), release)
+        except:
+            release()
+            raise
+
+    def _expected_size(self, environ, found):
+        """
+        Bytes a request is likely to send, None if only upstream knows. found
+        is what _find returned for a GET, None for other requests.
+        """
+        if found is None:
+            return 0
+
+        mirror_name, url, path, cached, entry = found
+        range = self._get_range(environ)
+        if range and range[1] != -1:
+            return range[1] + 1 - range[0]
+
+        fill = self._fills.get(path)
+        sparse = self._sparse_files.get(path)
+        if cached:
+            size = len(cached[0])
+        elif entry:
+            size = entry[0]
+        elif fill and fill.response:
+            size = fill.response.size
+        elif sparse:
+            size = sparse.size
+        else:
+            return None
+        return size - range[0] if range else size
+
+def _listen(port, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(50)
+    return sock
+
+def _shutdown(worker_pool, sock, app=None):
+    """
+    Stop accepting, wait for running requests, then stop the background work
+    of app and exit the server.
+    """
+    worker_pool.resize(0)
+    sock.close()
+    log.info("Shutting down. Requests left: %s", worker_pool.running())
+    worker_pool.waitall()
+    if app:
+        app.stop()
+    log.info("Exiting.")
+    raise SystemExit()
+
+def serve(mirror_url, cache_dir, port=8996, **options):
+    listener = HttpCache(mirror_url, cache_dir, **options)
     wsgi.server(eventlet.listen(('', port)), listener)
 
-def start(mirror_urls, cache_dir, port=8996):
+def _serve_worker(mirror_urls, cache_dir, port, connections, options):
+    """
+    Run one pre-forked worker until it receives SIGTERM.
+    """
+    options.setdefault('lock_files', True)
+    worker_pool = eventlet.GreenPool(connections)
+    sock = _listen(port, reuse_port=True)
+    app = HttpCache(mirror_urls, cache_dir, **options)
+    app.worker_pool = worker_pool
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: eventlet.spawn_n(_shutdown, worker_pool, sock, app))
+    wsgi.server(sock, app, custom_pool=worker_pool)
+
+def start(mirror_urls, cache_dir, port=8996, workers=None, connections=1000, **options):
     """
     Serve in the background
+
+    By default requests are served from a thread of this process. With
+    ``workers`` that many worker processes are forked, each accepting on the
+    port through SO_REUSEPORT and sharing misses through lock files.
+
+    Each process keeps up to ``connections`` client connections open. How
+    many requests are served at once is up to the ``lanes`` option, a
+    RequestLanes with its defaults unless given.
+
+    Extra options are passed to HttpCache. Returns a function that shuts the
+    server down once running requests have finished.
     """
-    worker_pool = eventlet.GreenPool(20)
+    options.setdefault('lanes', RequestLanes())
+    if workers:
+        return _start_workers(mirror_urls, cache_dir, port, workers, connections, options)
+
+    worker_pool = eventlet.GreenPool(connections)
     sock = eventlet.listen(('', port))
-    app = HttpCache(mirror_urls, cache_dir)
-    
-    def proper_shutdown():
-        worker_pool.resize(0)
-        sock.close()
-        log.info("Shutting down. Requests left: %s", worker_pool.running())
-        worker_pool.waitall()
-        log.info("Exiting.")
-        raise SystemExit()
+    app = HttpCache(mirror_urls, cache_dir, **options)
+    app.worker_pool = worker_pool
+    # The server thread has a hub of its own, the shutdown is run there
+    # once a byte arrives on this pipe
+    wakeup, notify = os.pipe()
+
+    def wait_for_shutdown():
+        trampoline(wakeup, read=True)
+        os.close(wakeup)
+        _shutdown(worker_pool, sock, app)
+
+    def serve():
+        eventlet.spawn_n(wait_for_shutdown)
+        wsgi.server(sock, app, custom_pool=worker_pool)
+
+    def queue_shutdown():
+        os.write(notify, 'x')
+        os.close(notify)
+
+    thread.start_new_thread(serve, ())
+
+    return queue_shutdown
+
+def _start_workers(mirror_urls, cache_dir, port, workers, connections, options):
+    pids = []
+    for _ in xrange(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_worker(mirror_urls, cache_dir, port, connections, options)
+            except SystemExit:
+                pass
+            except:
+                log.exception('Worker %d failed', os.getpid())
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    log.info('Started %d workers on port %d: %s', workers, port, pids)
+
+    def shutdown():
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        log.info("All workers exited.")
 
     def queue_shutdown():
-        eventlet.spawn_n(proper_shutdown)
+        thread.start_new_thread(shutdown, ())
+
+    return queue_shutdown
+
+def _get(app, path):
+    """
+    GET path through app as a client would, returning the status line.
+    """
+    status = []
+    content = app({'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': path},
+        lambda line, headers: status.append(line))
+    try:
+        for _ in content or ():
+            pass
+    finally:
+        if hasattr(content, 'close'):
+            content.close()
+    return status[0] if status else None
+
+def _fetch_metadata(app, path):
+    """
+    Make sure a repository metadata file is cached and open it.
+    """
+    status = _get(app, path)
+    if not status or not status.startswith('200'):
+        raise IOError('Could not fetch %s: %s' % (path, status))
+    return app._open_cached(app._resolve({'SCRIPT_NAME': '', 'PATH_INFO': path})[2])
+
+def _primary_packages(f):
+    """
+    Parse a primary.xml into (location, checksum type, checksum) per package.
+    """
+    for _, elem in ElementTree.iterparse(f):
+        if elem.tag == COMMON_NS + 'package':
+            checksum = elem.find(COMMON_NS + 'checksum')
+            yield (elem.find(COMMON_NS + 'location').get('href'),
+                checksum.get('type'), checksum.text)
+            elem.clear()
+
+def _repo_packages(app, repo):
+    """
+    Read the packages of the yum repository at request path repo.
+    """
+    with closing(_fetch_metadata(app, repo + '/repodata/repomd.xml')) as f:
+        repomd = ElementTree.parse(f)
+    for data in repomd.getroot().findall(REPO_NS + 'data'):
+        if data.get('type') == 'primary':
+            href = data.find(REPO_NS + 'location').get('href')
+            break
+    else:
+        raise IOError('No primary metadata in %s' % repo)
+
+    with closing(_fetch_metadata(app, repo + '/' + href)) as f:
+        if href.endswith('.gz'):
+            f = gzip.GzipFile(fileobj=f)
+        for package in _primary_packages(f):
+            yield package
+
+def _warm_package(app, path):
+    if app._lookup(app._resolve({'SCRIPT_NAME': '', 'PATH_INFO': path})[2]):
+        return 'present'
+    try:
+        status = _get(app, path)
+    except Exception:
+        log.exception('Could not fetch %s', path)
+        return 'failed'
+    if status and status.startswith('200'):
+        return 'fetched'
+    log.warning('Could not fetch %s: %s', path, status)
+    return 'failed'
+
+def warm(mirror_urls, cache_dir, repos, concurrency=8, include=(), exclude=(), progress=None, **options):
+    """
+    Prefetch the packages of yum repositories into the cache.
+
+    repos are repository paths as clients request them, e.g.
+    '/centos/7/os/x86_64'. Packages are filtered on their location in the
+    repository with fnmatch patterns: with include only matching packages
+    are fetched, matches of exclude never are.
+
+    Packages already cached are skipped, the rest are fetched through
+    HttpCache ``concurrency`` at a time, landing where a client request would
+    put them. Pass lock_files=True when a server is running on cache_dir.
+    With a blob_store, packages stored under another mirror name are linked
+    rather than fetched.
+
+    progress is called with (done, total, path, result) after each package,
+    result being 'present', 'fetched' or 'failed'; by default progress is
+    logged. Returns the number of packages with each result.
+    """
+    app = HttpCache(mirror_urls, cache_dir, **options)
+    try:
+        return _warm(app, repos, concurrency, include, exclude, progress)
+    finally:
+        app.stop()
+
+def _warm(app, repos, concurrency, include, exclude, progress):
+    if isinstance(repos, basestring):
+        repos = [repos]
 
-    thread.start_new_thread(wsgi.server, (sock, app), dict(custom_pool=worker_pool))
+    paths = []
+    for repo in repos:
+        repo = '/' + repo.strip('/')
+        packages = list(_repo_packages(app, repo))
+        if app.blob_store:
+            # A trailing slash so the root of a mirror resolves too
+            app.blob_store.learn(app._resolve({'SCRIPT_NAME': '', 'PATH_INFO': repo + '/'})[2], packages)
+        for href, checksum_type, checksum in packages:
+            if include and not any(fnmatch.fnmatch(href, pattern) for pattern in include):
+                continue
+            if any(fnmatch.fnmatch(href, pattern) for pattern in exclude):
+                continue
+            paths.append(repo + '/' + href)
 
-    return queue_shutdown
\ No newline at end of file
+    log.info('Warming %d packages from %s', len(paths), ', '.join(repos))
+    results = dict.fromkeys(('present', 'fetched', 'failed'), 0)
+    pool = eventlet.GreenPool(concurrency)
+    warmed = pool.imap(lambda path: (path, _warm_package(app, path)), paths)
+    for done, (path, result) in enumerate(warmed, 1):
+        results[result] += 1
+        if progress:
+            progress(done, len(paths), path, result)
+        elif done % 100 == 0 or done == len(paths):
+            log.info('Warmed %d of %d packages: %d fetched, %d present, %d failed',
+                done, len(paths), results['fetched'], results['present'], results['failed'])
+    return results
@@ -0,0 +1,98 @@
+import os
+import fcntl
+import hashlib
+import threading
+
+import pytest
+
+from fragrant.contrib.filecache import FileCache
+from fragrant.exceptions import Timeout
+
+@pytest.fixture
+def remote(tmpdir):
+    """
+    URL of a file to cache.
+    """
+    source = tmpdir.join('remote', 'box.img')
+    source.write('disk image', ensure=True)
+    return 'file://' + str(source)
+
+def cache_path(cache_dir, url):
+    return os.path.join(cache_dir, '%s-%s' % (hashlib.sha1(url).hexdigest(), os.path.basename(url)))
+
+def hold_lock(path):
+    """
+    Take the download lock of path as another process would.
+    """
+    f = open(path + '.lock', 'a+b')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.write('4242')
+    f.flush()
+    return f
+
+def test_get(tmpdir, remote):
+    cache_dir = str(tmpdir.join('cache'))
+    cache = FileCache(cache_dir)
+    path = cache.get(remote)
+    assert path == cache_path(cache_dir, remote)
+    with open(path, 'rb') as f:
+        assert f.read() == 'disk image'
+    assert os.listdir(cache_dir) == [os.path.basename(path)]
+
+    os.unlink(str(tmpdir.join('remote', 'box.img')))
+    assert cache.get(remote) == path
+
+def test_get_waits_for_other_process(tmpdir, remote):
+    cache_dir = str(tmpdir.join('cache'))
+    os.makedirs(cache_dir)
+    path = cache_path(cache_dir, remote)
+    lock = hold_lock(path)
+
+    def finish():
+        with open(path, 'wb') as f:
+            f.write('from the other process')
+        os.unlink(lock.name)
+        lock.close()
+    threading.Timer(0.2, finish).start()
+
+    cache = FileCache(cache_dir)
+    cache.poll_interval = 0.01
+    assert cache.get(remote) == path
+    with open(path, 'rb') as f:
+        assert f.read() == 'from the other process'
+    assert not os.path.exists(path + '.lock')
+
+def test_get_times_out(tmpdir, remote):
+    cache_dir = str(tmpdir.join('cache'))
+    os.makedirs(cache_dir)
+    lock = hold_lock(cache_path(cache_dir, remote))
+
+    cache = FileCache(cache_dir, lock_timeout=0.1)
+    cache.poll_interval = 0.01
+    try:
+        with pytest.raises(Timeout) as e:
+            cache.get(remote)
+        assert 'pid 4242' in str(e.value)
+    finally:
+        lock.close()
+
+def test_get_cleans_up_after_crash(tmpdir, remote):
+    cache_dir = str(tmpdir.join('cache'))
+    os.makedirs(cache_dir)
+    path = cache_path(cache_dir, remote)
+    # Left by a process that died mid download, the kernel dropped its lock
+    hold_lock(path).close()
+    with open(path + '.tmp', 'wb') as f:
+        f.write('disk')
+
+    assert FileCache(cache_dir).get(remote) == path
+    with open(path, 'rb') as f:
+        assert f.read() == 'disk image'
+    assert os.listdir(cache_dir) == [os.path.basename(path)]
+
+def test_failed_download_leaves_nothing(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    cache = FileCache(cache_dir)
+    with pytest.raises(IOError):
+        cache.get('file://' + str(tmpdir.join('missing.img')))
+    assert os.listdir(cache_dir) == []
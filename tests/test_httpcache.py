@@ -0,0 +1,1225 @@
+import os
+import re
+import stat
+import errno
+import ctypes
+import json
+import gzip
+import mmap
+import hashlib
+from StringIO import StringIO
+from wsgiref.util import FileWrapper
+
+import pytest
+
+eventlet = pytest.importorskip('eventlet')
+from eventlet import wsgi
+from eventlet.green import urllib2
+
+from fragrant.contrib import httpcache
+from fragrant.contrib.httpcache import (BlobStore, ConnectionPool, DiskQuota, FileContent, HttpCache,
+    MemoryCache, Mirror, PackStorage, RequestLanes, SparseFile)
+
+class Upstream(object):
+    """
+    Origin server for the caches under test, on a port of its own.
+    """
+
+    def __init__(self):
+        # path -> content
+        self.files = {}
+        # (path, Range header) of every request
+        self.requests = []
+        # Seconds to wait before answering
+        self.delay = 0
+        # Drop the connection after this many bytes of a body
+        self.cut = None
+        # Start ranges this many bytes early
+        self.range_shift = 0
+        self.server = eventlet.listen(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d' % self.server.getsockname()[1]
+        self.thread = eventlet.spawn(wsgi.server, self.server, self.app, log_output=False,
+            log=open(os.devnull, 'w'))
+
+    def app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        self.requests.append((path, environ.get('HTTP_RANGE')))
+        if self.delay:
+            eventlet.sleep(self.delay)
+
+        data = self.files.get(path)
+        if data is None:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return ['']
+
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        headers = [('ETag', etag), ('Accept-Ranges', 'bytes')]
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', headers)
+            return ['']
+
+        match = re.match(r'bytes=(\d+)-(\d*)$', environ.get('HTTP_RANGE', ''))
+        if match and environ.get('HTTP_IF_RANGE') in (None, etag):
+            start = max(0, int(match.group(1)) - self.range_shift)
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                start_response('416 Requested Range Not Satisfiable', [
+                    ('Content-Range', 'bytes */%d' % len(data)), ('Content-Length', '0')])
+                return ['']
+            body = data[start:end + 1]
+            start_response('206 Partial Content', headers + [('Content-Length', str(len(body))),
+                ('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))])
+        else:
+            body = data
+            start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return ['']
+        return self._send(body, self.cut)
+
+    def _send(self, body, cut):
+        for i in xrange(0, len(body), 4096):
+            if cut is not None and i >= cut:
+                raise IOError('Connection dropped')
+            yield body[i:i + 4096]
+            eventlet.sleep(0)
+
+    def fetched(self, path):
+        return len([request for request in self.requests if request[0] == path])
+
+    def close(self):
+        self.thread.kill()
+        self.server.close()
+
+class Hangup(object):
+    """
+    Server closing every connection after delay seconds without an answer.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.server = eventlet.listen(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d' % self.server.getsockname()[1]
+        self.thread = eventlet.spawn(self._accept)
+
+    def _accept(self):
+        while 1:
+            sock, address = self.server.accept()
+            eventlet.spawn_after(self.delay, sock.close)
+
+    def close(self):
+        self.thread.kill()
+        self.server.close()
+
+@pytest.fixture
+def upstream():
+    server = Upstream()
+    yield server
+    server.close()
+
+def request(app, path, method='GET', **headers):
+    """
+    Send a request for path to app, headers given as environ keys such as
+    HTTP_RANGE. Returns the status line, headers and body.
+    """
+    response = []
+    environ = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '', 'PATH_INFO': path}
+    environ.update(headers)
+    body = app(environ, lambda line, headers: response.append((line, dict(headers))))
+    try:
+        data = ''.join(body or ())
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    status, headers = response[0]
+    return status, headers, data
+
+def get(app, path, range=None):
+    """
+    Request path from app, returns the status line and body.
+    """
+    if range:
+        status, headers, data = request(app, path, HTTP_RANGE=range)
+    else:
+        status, headers, data = request(app, path)
+    return status, data
+
+def stored(storage, path, data, meta=None):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return storage.store(path, meta or {})
+
+def test_pool_reuses_connections(upstream):
+    upstream.files['/a.rpm'] = 'x' * 10000
+    pool = ConnectionPool()
+    for _ in range(3):
+        response = pool.urlopen(upstream.url + '/a.rpm')
+        assert response.read() == 'x' * 10000
+        response.close()
+    assert pool.stats() == dict(created=1, reused=2, idle=1)
+
+def test_pool_max_idle(upstream):
+    upstream.files['/a.rpm'] = 'package'
+    pool = ConnectionPool(max_idle=1)
+    responses = [pool.urlopen(upstream.url + '/a.rpm') for _ in range(3)]
+    for response in responses:
+        response.read()
+        response.close()
+    assert pool.stats() == dict(created=3, reused=0, idle=1)
+
+def test_pool_max_per_host(upstream):
+    upstream.files['/a.rpm'] = 'package'
+    pool = ConnectionPool(max_per_host=1)
+    first = pool.urlopen(upstream.url + '/a.rpm')
+    second = eventlet.spawn(pool.urlopen, upstream.url + '/a.rpm')
+    eventlet.sleep(0.1)
+    # Waits for the connection of the first
+    assert not second.dead
+    assert pool.created == 1
+
+    first.read()
+    first.close()
+    with eventlet.Timeout(5):
+        assert second.wait().read() == 'package'
+    assert pool.stats() == dict(created=1, reused=1, idle=0)
+
+def test_pool_drops_unread_responses(upstream):
+    upstream.files['/a.rpm'] = 'x' * 100000
+    pool = ConnectionPool()
+    response = pool.urlopen(upstream.url + '/a.rpm')
+    response.read(4096)
+    response.close()
+    assert pool.stats()['idle'] == 0
+
+    pool.urlopen(upstream.url + '/a.rpm').close()
+    assert pool.stats() == dict(created=2, reused=0, idle=0)
+
+def test_pack_store_and_replay(tmpdir):
+    cache_dir = str(tmpdir)
+    path = os.path.join(cache_dir, 'm', 'small.rpm')
+    os.makedirs(os.path.dirname(path))
+    storage = PackStorage(cache_dir)
+
+    assert stored(storage, path, 'packed bytes', {'ETag': '"1"'}) == len('packed bytes')
+    assert not os.path.exists(path)
+    f, offset, size = storage.open(path)
+    with f:
+        f.seek(offset)
+        assert f.read(size) == 'packed bytes'
+
+    # Another worker replays the index log
+    other = PackStorage(cache_dir)
+    assert other.lookup(path)[0] == len('packed bytes')
+    assert other.meta(path) == {'ETag': '"1"'}
+
+    storage.discard(path)
+    assert storage.lookup(path) is None
+    assert other.lookup(path) is not None
+    other.refresh()
+    assert other.lookup(path) is None
+
+def test_pack_keeps_large_files_plain(tmpdir):
+    storage = PackStorage(str(tmpdir), max_object_size=10)
+    path = str(tmpdir.join('large.rpm'))
+    assert stored(storage, path, 'x' * 11) is None
+    assert os.path.isfile(path)
+
+def test_pack_compact(tmpdir):
+    cache_dir = str(tmpdir)
+    storage = PackStorage(cache_dir, pack_size=1000)
+    paths = [os.path.join(cache_dir, 'f%d' % i) for i in range(10)]
+    for i in range(30):
+        stored(storage, paths[i % 10], '%03d' % i * 100)
+    packs = [name for name in os.listdir(storage.dir) if name.endswith('.pack')]
+    assert len(packs) == 10
+
+    storage.compact()
+    assert len([name for name in os.listdir(storage.dir) if name.endswith('.pack')]) < len(packs)
+    for i, path in enumerate(paths):
+        f, offset, size = storage.open(path)
+        with f:
+            f.seek(offset)
+            assert f.read(size) == '%03d' % (i + 20) * 100
+
+    # The rewritten index is replayed from the start by others
+    other = PackStorage(cache_dir)
+    storage._rewrite_index()
+    other.refresh()
+    assert other._records == len(paths)
+    assert sorted(path for path, size, mtime in other.files()) == sorted(paths)
+
+def test_pack_rewrite_keeps_concurrent_appends(tmpdir):
+    cache_dir = str(tmpdir)
+    storage = PackStorage(cache_dir)
+    other = PackStorage(cache_dir)
+    for i in range(100):
+        stored(storage, os.path.join(cache_dir, 'f%d' % (i % 10)), 'version %d' % i)
+
+    # Another worker stores a file while the snapshot is being written
+    storage.chunk = 3
+    late = os.path.join(cache_dir, 'late')
+    record = storage._record
+    def _record(*args):
+        if not os.path.exists(late) and other.lookup(late) is None:
+            stored(other, late, 'late bytes')
+        return record(*args)
+    storage._record = _record
+    storage._rewrite_index()
+
+    reader = PackStorage(cache_dir)
+    assert reader.lookup(late)[0] == len('late bytes')
+    assert len(reader.files()) == 11
+    assert not [name for name in os.listdir(storage.dir) if name.endswith('.tmp')]
+
+def test_serve_packed_file(tmpdir, upstream):
+    upstream.files['/small.xml'] = 'small file'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), storage=PackStorage(str(tmpdir)))
+    assert get(app, '/m/small.xml') == ('200 OK', 'small file')
+    assert not os.path.exists(str(tmpdir.join('m', 'small.xml')))
+    assert get(app, '/m/small.xml') == ('200 OK', 'small file')
+    assert upstream.fetched('/small.xml') == 1
+
+def test_head_packed_file(tmpdir, upstream):
+    upstream.files['/small.xml'] = 'small file'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), storage=PackStorage(str(tmpdir)))
+    get(app, '/m/small.xml')
+    status, headers, data = request(app, '/m/small.xml', 'HEAD')
+    assert (status, headers['Content-Length'], data) == ('200 OK', str(len('small file')), '')
+    assert request(app, '/m/small.xml', HTTP_IF_NONE_MATCH=headers['ETag'])[0] == '304 Not Modified'
+    assert upstream.fetched('/small.xml') == 1
+
+@pytest.fixture(params=['mmap', 'read'])
+def file_content(request, monkeypatch):
+    """
+    FileContent, either memory mapping files or falling back to read().
+    """
+    if request.param == 'read':
+        def unmappable(self, start, total):
+            raise mmap.error('unmappable')
+        monkeypatch.setattr(FileContent, '_mapped', unmappable)
+    monkeypatch.setattr(FileContent, 'readsize', 4096)
+    return FileContent
+
+@pytest.mark.parametrize('range', [(0, 9999), (1000, 5095), (4096, 8191), (9990, 9999), (9999, 9999)])
+def test_file_content_range(tmpdir, file_content, range):
+    data = os.urandom(10000)
+    path = tmpdir.join('f')
+    path.write(data, 'wb')
+    chunks = list(file_content(open(str(path), 'rb'), range))
+    assert ''.join(chunks) == data[range[0]:range[1] + 1]
+    assert max(len(chunk) for chunk in chunks) <= 4096
+
+def test_file_content_empty_file(tmpdir, file_content):
+    path = tmpdir.join('empty')
+    path.write('', 'wb')
+    f = open(str(path), 'rb')
+    assert list(file_content(f, (0, -1))) == []
+    assert f.closed
+
+def test_serve_file_ranges(tmpdir, upstream, file_content):
+    data = os.urandom(10000)
+    upstream.files['/f.rpm'] = data
+    upstream.files['/empty.rpm'] = ''
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+    get(app, '/m/f.rpm')
+    assert get(app, '/m/f.rpm', 'bytes=1000-5095') == ('206 Partial Content', data[1000:5096])
+    assert get(app, '/m/f.rpm', 'bytes=9990-') == ('206 Partial Content', data[9990:])
+    assert get(app, '/m/empty.rpm') == ('200 OK', '')
+    assert get(app, '/m/empty.rpm') == ('200 OK', '')
+    assert upstream.fetched('/f.rpm') == upstream.fetched('/empty.rpm') == 1
+
+def test_serve_file_with_file_wrapper(tmpdir, upstream):
+    upstream.files['/f.rpm'] = data = os.urandom(10000)
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+    get(app, '/m/f.rpm')
+
+    wrapped = []
+    def file_wrapper(f, blksize):
+        wrapped.append(blksize)
+        return FileWrapper(f, blksize)
+    assert request(app, '/m/f.rpm', **{'wsgi.file_wrapper': file_wrapper})[2] == data
+    assert wrapped == [FileContent.readsize]
+
+    # Ranges are cut out by FileContent
+    status, headers, body = request(app, '/m/f.rpm', HTTP_RANGE='bytes=10-19',
+        **{'wsgi.file_wrapper': file_wrapper})
+    assert (status, body) == ('206 Partial Content', data[10:20])
+    assert wrapped == [FileContent.readsize]
+
+def test_foreign_fill(tmpdir, upstream):
+    data = os.urandom(200000)
+    upstream.files['/big.rpm'] = data
+    upstream.delay = 0.2
+    first = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+    second = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+
+    leader = eventlet.spawn(get, first, '/m/big.rpm')
+    eventlet.sleep(0.1)
+    follower = eventlet.spawn(get, second, '/m/big.rpm')
+    assert leader.wait() == ('200 OK', data)
+    assert follower.wait() == ('200 OK', data)
+    assert upstream.fetched('/big.rpm') == 1
+
+def test_foreign_fill_refused(tmpdir, upstream):
+    upstream.delay = 0.2
+    first = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+    second = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+
+    leader = eventlet.spawn(get, first, '/m/missing.rpm')
+    eventlet.sleep(0.1)
+    follower = eventlet.spawn(get, second, '/m/missing.rpm')
+    assert leader.wait()[0].startswith('404')
+    assert follower.wait()[0].startswith('404')
+    assert upstream.fetched('/missing.rpm') == 1
+
+def test_foreign_fill_range(tmpdir, upstream):
+    data = os.urandom(200000)
+    upstream.files['/big.rpm'] = data
+    upstream.delay = 0.2
+    first = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+    second = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+
+    leader = eventlet.spawn(get, first, '/m/big.rpm')
+    eventlet.sleep(0.1)
+    assert get(second, '/m/big.rpm', 'bytes=1000-1999') == ('206 Partial Content', data[1000:2000])
+    assert leader.wait() == ('200 OK', data)
+    assert sorted(os.listdir(str(tmpdir.join('m')))) == ['big.rpm', 'big.rpm.meta']
+
+@pytest.mark.parametrize('range_shift', [0, 1000])
+def test_resume(tmpdir, upstream, range_shift):
+    data = os.urandom(100000)
+    upstream.files['/big.rpm'] = data
+    upstream.cut = 50000
+    app = HttpCache({'m': upstream.url}, str(tmpdir), read_size=4096, write_size=4096, partial_ttl=None)
+    assert len(get(app, '/m/big.rpm')[1]) < len(data)
+    eventlet.sleep(0.1)
+    assert os.path.exists(str(tmpdir.join('m', 'big.rpm.tmp')))
+
+    upstream.cut = None
+    upstream.range_shift = range_shift
+    assert get(app, '/m/big.rpm') == ('200 OK', data)
+    assert upstream.requests[1][1] is not None
+    with open(str(tmpdir.join('m', 'big.rpm')), 'rb') as f:
+        assert f.read() == data
+
+def test_concurrent_misses_share_one_fetch(tmpdir, upstream):
+    data = os.urandom(200000)
+    upstream.files['/big.rpm'] = data
+    upstream.delay = 0.05
+    app = HttpCache({'m': upstream.url}, str(tmpdir), read_size=4096, write_size=4096)
+    path = str(tmpdir.join('m', 'big.rpm'))
+
+    misses = [eventlet.spawn(get, app, '/m/big.rpm') for _ in range(5)]
+    while path not in app._fills or not app._fills[path].written:
+        eventlet.sleep(0.001)
+    # Join while the body is landing
+    assert app._fills[path].written < len(data)
+    late = eventlet.spawn(get, app, '/m/big.rpm')
+    ranged = eventlet.spawn(get, app, '/m/big.rpm', 'bytes=150000-189999')
+    eventlet.sleep(0)
+    assert path in app._fills
+
+    for miss in misses + [late]:
+        assert miss.wait() == ('200 OK', data)
+    assert ranged.wait() == ('206 Partial Content', data[150000:190000])
+    assert upstream.requests == [('/big.rpm', None)]
+
+def start_get(app, path):
+    """
+    Send a GET for path to app without reading the body.
+    """
+    return app({'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': path}, lambda line, headers: None)
+
+def test_abandoned_download_is_cached(tmpdir, upstream):
+    data = os.urandom(200000)
+    upstream.files['/big.rpm'] = data
+    app = HttpCache({'m': upstream.url}, str(tmpdir), read_size=4096, write_size=4096)
+    path = str(tmpdir.join('m', 'big.rpm'))
+
+    body = start_get(app, '/m/big.rpm')
+    assert data.startswith(next(iter(body)))
+    # The client disconnects
+    body.close()
+    with eventlet.Timeout(5):
+        while not os.path.exists(path):
+            eventlet.sleep(0.01)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    assert get(app, '/m/big.rpm') == ('200 OK', data)
+    assert upstream.fetched('/big.rpm') == 1
+
+def test_slow_client_does_not_stall_download(tmpdir, upstream):
+    data = os.urandom(200000)
+    upstream.files['/big.rpm'] = data
+    app = HttpCache({'m': upstream.url}, str(tmpdir), read_size=4096, write_size=4096)
+
+    slow = iter(start_get(app, '/m/big.rpm'))
+    received = next(slow)
+    with eventlet.Timeout(5):
+        assert get(app, '/m/big.rpm') == ('200 OK', data)
+    # The download finished before the slow client read on
+    assert not app._fills
+    received += ''.join(slow)
+    assert received == data
+    assert upstream.fetched('/big.rpm') == 1
+
+@pytest.fixture
+def stat_calls(monkeypatch):
+    """
+    (call, path) of each os.stat, os.lstat and open.
+    """
+    calls = []
+    def counted(call):
+        def wrapper(path, *args, **kwargs):
+            calls.append((call.__name__, path))
+            return call(path, *args, **kwargs)
+        return wrapper
+    monkeypatch.setattr(os, 'stat', counted(os.stat))
+    monkeypatch.setattr(os, 'lstat', counted(os.lstat))
+    monkeypatch.setattr(httpcache, 'open', counted(open), raising=False)
+    return calls
+
+@pytest.mark.parametrize('lanes', [None, RequestLanes()])
+def test_memory_hits_skip_filesystem(tmpdir, upstream, stat_calls, lanes):
+    upstream.files['/repomd.xml'] = 'repository metadata'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), memory_cache=MemoryCache(1024 * 1024), lanes=lanes)
+    get(app, '/m/repomd.xml')
+    get(app, '/m/repomd.xml')
+    assert app.memory_cache.size == len('repository metadata')
+
+    del stat_calls[:]
+    status, headers, data = request(app, '/m/repomd.xml')
+    assert (status, data, headers['Content-Type']) == ('200 OK', 'repository metadata', 'text/xml')
+    assert request(app, '/m/repomd.xml', HTTP_IF_NONE_MATCH=headers['ETag'])[0] == '304 Not Modified'
+    status, headers, data = request(app, '/m/repomd.xml', HTTP_RANGE='bytes=11-')
+    assert (status, data, headers['Content-Type']) == ('206 Partial Content', 'metadata', 'text/xml')
+    assert stat_calls == []
+    assert upstream.fetched('/repomd.xml') == 1
+
+def test_memory_tier_evicts_least_recently_used():
+    memory = MemoryCache(10, max_object_size=6)
+    memory.put('a', 'aaaa', '200 OK', [])
+    memory.put('b', 'bbbb', '200 OK', [])
+    memory.get('a')
+    memory.put('c', 'cccc', '200 OK', [])
+    memory.put('d', 'd' * 7, '200 OK', [])
+    assert memory.get('b') is None and memory.get('d') is None
+    assert memory.get('a')[0] == 'aaaa'
+    assert memory.size == 8
+
+def test_index_serves_hits(tmpdir, upstream, stat_calls):
+    upstream.files['/a.rpm'] = 'package'
+    tmpdir.join('m', 'old.rpm').write('cached before', ensure=True)
+    app = HttpCache({'m': upstream.url}, str(tmpdir), index=True)
+    assert app.index.get(str(tmpdir.join('m', 'old.rpm')))[0] == len('cached before')
+
+    get(app, '/m/a.rpm')
+    del stat_calls[:]
+    assert get(app, '/m/a.rpm') == ('200 OK', 'package')
+    assert get(app, '/m/old.rpm') == ('200 OK', 'cached before')
+    assert [call for call, path in stat_calls if call != 'open'] == []
+
+def test_index_refetches_removed_file(tmpdir, upstream):
+    upstream.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), index=True)
+    get(app, '/m/a.rpm')
+    os.unlink(str(tmpdir.join('m', 'a.rpm')))
+
+    assert get(app, '/m/a.rpm') == ('200 OK', 'package')
+    assert upstream.fetched('/a.rpm') == 2
+    assert get(app, '/m/a.rpm') == ('200 OK', 'package')
+    assert upstream.fetched('/a.rpm') == 2
+
+def test_failover(tmpdir, upstream):
+    dead = Hangup()
+    upstream.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': [dead.url, upstream.url]}, str(tmpdir))
+    try:
+        assert get(app, '/m/a.rpm') == ('200 OK', 'package')
+        first, second = app.mirrors['m'].upstreams
+        assert not first.healthy and second.healthy
+        assert app.mirrors['m'].ranked() == [second, first]
+    finally:
+        dead.close()
+
+def test_hedge_slow_upstream(tmpdir, monkeypatch):
+    monkeypatch.setattr(Mirror, 'default_hedge_delay', 0.05)
+    slow, fast = Upstream(), Upstream()
+    slow.delay = 1
+    slow.files['/a.rpm'] = fast.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': [slow.url, fast.url]}, str(tmpdir))
+    try:
+        with eventlet.Timeout(0.5):
+            assert get(app, '/m/a.rpm') == ('200 OK', 'package')
+        assert fast.fetched('/a.rpm') == 1
+    finally:
+        slow.close()
+        fast.close()
+
+def test_all_upstreams_down(tmpdir):
+    dead = [Hangup(0.2), Hangup(0.2)]
+    app = HttpCache({'m': [server.url for server in dead]}, str(tmpdir))
+    try:
+        leader = eventlet.spawn(get, app, '/m/a.rpm')
+        eventlet.sleep(0.1)
+        follower = eventlet.spawn(get, app, '/m/a.rpm')
+        assert leader.wait() == ('502 Bad Gateway', '')
+        assert follower.wait() == ('502 Bad Gateway', '')
+        assert get(app, '/m/b.iso', 'bytes=0-99')[0] == '502 Bad Gateway'
+        assert request(app, '/m/a.rpm', 'HEAD')[0] == '502 Bad Gateway'
+    finally:
+        for server in dead:
+            server.close()
+
+def test_head_and_not_modified(tmpdir, upstream):
+    upstream.files['/a.rpm'] = 'package'
+    etag = '"%s"' % hashlib.md5('package').hexdigest()
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+
+    # Uncached files are asked of upstream, not cached
+    status, headers, data = request(app, '/m/a.rpm', 'HEAD')
+    assert (status, headers['Content-Length'], headers['ETag'], data) == ('200 OK', '7', etag, '')
+    assert not os.path.exists(str(tmpdir.join('m', 'a.rpm')))
+    get(app, '/m/a.rpm')
+
+    # Answered from the .meta sidecar, after a restart too
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+    status, headers, data = request(app, '/m/a.rpm', 'HEAD')
+    assert (status, headers['Content-Length'], headers['ETag'], data) == ('200 OK', '7', etag, '')
+    assert request(app, '/m/a.rpm', 'HEAD', HTTP_IF_NONE_MATCH=etag)[0] == '304 Not Modified'
+    status, headers, data = request(app, '/m/a.rpm', HTTP_IF_NONE_MATCH='"other", %s' % etag)
+    assert (status, headers, data) == ('304 Not Modified', {'ETag': etag}, '')
+    assert request(app, '/m/a.rpm', HTTP_IF_NONE_MATCH='"other"')[2] == 'package'
+    assert upstream.fetched('/a.rpm') == 2
+
+def get_since(app, date):
+    return request(app, '/m/a.rpm', HTTP_IF_MODIFIED_SINCE=date)[0]
+
+def test_not_modified_since(tmpdir):
+    tmpdir.join('m', 'a.rpm').write('package', ensure=True)
+    tmpdir.join('m', 'a.rpm.meta').write(json.dumps({'Last-Modified': 'Mon, 05 Oct 2026 10:00:00 GMT'}))
+    app = HttpCache({'m': 'http://127.0.0.1:1'}, str(tmpdir))
+    assert get_since(app, 'Mon, 05 Oct 2026 10:00:00 GMT') == '304 Not Modified'
+    assert get_since(app, 'Tue, 06 Oct 2026 10:00:00 GMT') == '304 Not Modified'
+    assert get_since(app, 'Sun, 04 Oct 2026 10:00:00 GMT') == '200 OK'
+
+def test_segmented_download(tmpdir, upstream):
+    data = os.urandom(100000)
+    upstream.files['/disc.iso'] = data
+    app = HttpCache({'m': upstream.url}, str(tmpdir), segments=4, segment_threshold=50000, read_size=4096)
+
+    assert get(app, '/m/disc.iso') == ('200 OK', data)
+    assert sorted(upstream.requests) == [('/disc.iso', None), ('/disc.iso', 'bytes=25000-49999'),
+        ('/disc.iso', 'bytes=50000-74999'), ('/disc.iso', 'bytes=75000-99999')]
+    with open(str(tmpdir.join('m', 'disc.iso')), 'rb') as f:
+        assert f.read() == data
+
+def test_segmented_download_misplaced_range(tmpdir, upstream):
+    data = os.urandom(100000)
+    upstream.files['/disc.iso'] = data
+    upstream.range_shift = 1000
+    app = HttpCache({'m': upstream.url}, str(tmpdir), segments=4, segment_threshold=50000, read_size=4096)
+
+    status, body = get(app, '/m/disc.iso')
+    assert status == '200 OK' and data.startswith(body) and len(body) < len(data)
+    assert not os.path.exists(str(tmpdir.join('m', 'disc.iso')))
+
+def test_gzip_variant(tmpdir, upstream):
+    data = '<metadata>%s</metadata>' % ('<package/>' * 1000)
+    upstream.files['/primary.xml'] = data
+    upstream.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), compress=True)
+
+    status, headers, body = request(app, '/m/primary.xml', HTTP_ACCEPT_ENCODING='gzip')
+    assert (body, headers['Vary']) == (data, 'Accept-Encoding')
+    eventlet.sleep(0.1)
+
+    status, headers, body = request(app, '/m/primary.xml', HTTP_ACCEPT_ENCODING='deflate, gzip;q=0.5')
+    assert (headers['Content-Encoding'], headers['Vary']) == ('gzip', 'Accept-Encoding')
+    assert headers['Content-Type'] == 'text/xml'
+    assert headers['Content-Length'] == str(len(body)) and len(body) < len(data)
+    assert gzip.GzipFile(fileobj=StringIO(body)).read() == data
+    assert headers['ETag'].endswith('-gzip"')
+    assert request(app, '/m/primary.xml', HTTP_ACCEPT_ENCODING='gzip',
+        HTTP_IF_NONE_MATCH=headers['ETag'])[0] == '304 Not Modified'
+
+    for accept in ('gzip;q=0', 'identity'):
+        status, headers, body = request(app, '/m/primary.xml', HTTP_ACCEPT_ENCODING=accept)
+        assert (body, headers['Vary'], headers['Content-Type']) == (data, 'Accept-Encoding', 'text/xml')
+        assert 'Content-Encoding' not in headers
+    assert request(app, '/m/primary.xml', 'HEAD')[1]['Vary'] == 'Accept-Encoding'
+    assert 'Vary' not in request(app, '/m/a.rpm', HTTP_ACCEPT_ENCODING='gzip')[1]
+    assert request(app, '/m/a.rpm', HTTP_RANGE='bytes=1-3')[1]['Content-Type'] == \
+        'application/x-redhat-package-manager'
+    assert upstream.fetched('/primary.xml') == 1
+
+def test_negative_cache(tmpdir, upstream):
+    app = HttpCache({'m': upstream.url}, str(tmpdir), negative_ttl=0.2)
+    for _ in range(3):
+        assert get(app, '/m/missing.rpm')[0].startswith('404')
+    assert request(app, '/m/missing.rpm', 'HEAD')[0].startswith('404')
+    assert upstream.fetched('/missing.rpm') == 1
+
+    eventlet.sleep(0.25)
+    upstream.files['/missing.rpm'] = 'package'
+    assert get(app, '/m/missing.rpm') == ('200 OK', 'package')
+    assert upstream.fetched('/missing.rpm') == 2
+    assert not app._negative
+
+def test_negative_cache_off(tmpdir, upstream):
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+    for _ in range(2):
+        assert get(app, '/m/missing.rpm')[0].startswith('404')
+    assert upstream.fetched('/missing.rpm') == 2
+
+def serve(app):
+    """
+    Serve app on a port of its own, returns its URL and a function stopping it.
+    """
+    server = eventlet.listen(('127.0.0.1', 0))
+    thread = eventlet.spawn(wsgi.server, server, app, log_output=False, log=open(os.devnull, 'w'))
+    def close():
+        thread.kill()
+        server.close()
+    return 'http://127.0.0.1:%d' % server.getsockname()[1], close
+
+def test_peers(tmpdir, upstream):
+    upstream.files['/a.rpm'] = 'package a'
+    upstream.files['/b.rpm'] = 'package b'
+    upstream.files['/repodata/repomd.xml'] = '<repomd/>'
+    peer = HttpCache({'m': upstream.url}, str(tmpdir.join('peer')))
+    get(peer, '/m/a.rpm')
+    get(peer, '/m/repodata/repomd.xml')
+    peer_url, close = serve(peer)
+    app = HttpCache({'m': upstream.url}, str(tmpdir.join('node')), peers=[peer_url],
+        freshness=[('*/repodata/*', 60)])
+    try:
+        assert get(app, '/m/a.rpm') == ('200 OK', 'package a')
+        assert upstream.fetched('/a.rpm') == 1
+        # The peer answers from complete files only, it never goes upstream
+        assert get(app, '/m/b.rpm') == ('200 OK', 'package b')
+        assert upstream.fetched('/b.rpm') == 1
+        assert not os.path.exists(str(tmpdir.join('peer', 'm', 'b.rpm')))
+        # Files that change upstream could be stale on the peer
+        get(app, '/m/repodata/repomd.xml')
+        assert upstream.fetched('/repodata/repomd.xml') == 2
+        assert 'httpcache_requests_total{mirror="m",result="peer"} 1' in app.stats_text().splitlines()
+    finally:
+        close()
+
+def test_dead_peer_ejected(tmpdir, upstream):
+    upstream.files['/a.rpm'] = 'package a'
+    dead = Hangup(1)
+    app = HttpCache({'m': upstream.url}, str(tmpdir), peers=[dead.url], peer_timeout=0.1)
+    try:
+        with eventlet.Timeout(0.5):
+            assert get(app, '/m/a.rpm') == ('200 OK', 'package a')
+        assert not app.peers.peers[0].healthy
+    finally:
+        dead.close()
+
+def test_stats(tmpdir, upstream, monkeypatch):
+    upstream.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+    relpath = []
+    monkeypatch.setattr(os.path, 'relpath', lambda *args: relpath.append(args))
+    get(app, '/m/a.rpm')
+    get(app, '/m/a.rpm')
+    get(app, '/m/missing.rpm')
+    assert relpath == []
+
+    status, headers, data = request(app, '/_stats')
+    assert headers['Content-Type'].startswith('text/plain')
+    lines = data.splitlines()
+    assert 'httpcache_requests_total{mirror="m",result="miss"} 1' in lines
+    assert 'httpcache_requests_total{mirror="m",result="hit"} 1' in lines
+    assert 'httpcache_requests_total{mirror="m",result="error"} 1' in lines
+    assert 'httpcache_cache_bytes_total{mirror="m"} 7' in lines
+    assert 'httpcache_upstream_bytes_total{mirror="m"} 7' in lines
+    assert 'httpcache_upstream_ttfb_seconds_count{mirror="m"} 2' in lines
+    assert '# TYPE httpcache_upstream_seconds histogram' in lines
+
+def test_lanes_shed_overload(tmpdir, upstream):
+    upstream.files['/a.rpm'] = 'package'
+    upstream.delay = 0.2
+    lanes = RequestLanes(small_slots=1, large_slots=0, max_queue=1, max_wait=0.05, retry_after=7)
+    app = HttpCache({'m': upstream.url}, str(tmpdir), lanes=lanes)
+
+    running = eventlet.spawn(get, app, '/m/a.rpm')
+    eventlet.sleep(0.01)
+    queued = eventlet.spawn(request, app, '/m/a.rpm')
+    eventlet.sleep(0.01)
+    # The queue is full
+    status, headers, data = request(app, '/m/a.rpm')
+    assert (status, headers['Retry-After']) == ('503 Service Unavailable', '7')
+    # Waited longer than max_wait
+    assert queued.wait()[0] == '503 Service Unavailable'
+    assert running.wait() == ('200 OK', 'package')
+    assert lanes.running == {'small': 0, 'large': 0}
+    assert 'httpcache_shed_total{lane="small"} 2' in app.stats_text().splitlines()
+
+def test_lanes_by_size(tmpdir, upstream):
+    upstream.files['/small.xml'] = 'x' * 100
+    upstream.files['/disc.iso'] = 'x' * 2000
+    lanes = RequestLanes(large_size=1000)
+    app = HttpCache({'m': upstream.url}, str(tmpdir), lanes=lanes)
+    lane = []
+    acquire = lanes.acquire
+    lanes.acquire = lambda name: lane.append(name) or acquire(name)
+
+    # Unknown sizes start small, the large response moves to the large lane
+    body = app({'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': '/m/disc.iso'}, lambda *args: None)
+    assert lanes.running == {'small': 0, 'large': 1}
+    body.close()
+    get(app, '/m/small.xml')
+    get(app, '/m/disc.iso')
+    get(app, '/m/disc.iso', 'bytes=0-99')
+    assert lane == ['small', 'small', 'large', 'small']
+    assert lanes.running == {'small': 0, 'large': 0}
+
+def age(path, seconds):
+    """
+    Set the mtime of path seconds back.
+    """
+    mtime = os.path.getmtime(path) - seconds
+    os.utime(path, (mtime, mtime))
+    return mtime
+
+def test_revalidate_stale_file(tmpdir, upstream):
+    upstream.files['/repodata/repomd.xml'] = '<repomd/>'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), freshness=[('*/repodata/*', 60)], compress=True)
+    path = str(tmpdir.join('m', 'repodata', 'repomd.xml'))
+    get(app, '/m/repodata/repomd.xml')
+    eventlet.sleep(0.1)
+    mtime = age(path, 120)
+    age(path + '.gzip', 120)
+
+    # Upstream answers 304, the copy is current for another 60 seconds
+    assert get(app, '/m/repodata/repomd.xml') == ('200 OK', '<repomd/>')
+    assert upstream.fetched('/repodata/repomd.xml') == 2
+    assert abs(os.path.getmtime(path) - mtime) < 0.001
+    status, headers, data = request(app, '/m/repodata/repomd.xml', HTTP_ACCEPT_ENCODING='gzip')
+    assert headers['Content-Encoding'] == 'gzip'
+    assert upstream.fetched('/repodata/repomd.xml') == 2
+
+    # Changed upstream
+    upstream.files['/repodata/repomd.xml'] = '<repomd revision="2"/>'
+    with open(path + '.meta', 'rb') as f:
+        meta = json.load(f)
+    meta['validated'] -= 120
+    with open(path + '.meta', 'wb') as f:
+        json.dump(meta, f)
+    assert get(app, '/m/repodata/repomd.xml') == ('200 OK', '<repomd revision="2"/>')
+    assert get(app, '/m/repodata/repomd.xml') == ('200 OK', '<repomd revision="2"/>')
+    assert upstream.fetched('/repodata/repomd.xml') == 3
+
+def test_head_revalidates_stale_file(tmpdir, upstream):
+    upstream.files['/repodata/repomd.xml'] = '<repomd/>'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), freshness=[('*/repodata/*', 60)])
+    path = str(tmpdir.join('m', 'repodata', 'repomd.xml'))
+    get(app, '/m/repodata/repomd.xml')
+    etag = request(app, '/m/repodata/repomd.xml', 'HEAD')[1]['ETag']
+
+    # Upstream answers 304
+    age(path, 120)
+    status, headers, data = request(app, '/m/repodata/repomd.xml', 'HEAD')
+    assert (status, headers['ETag']) == ('200 OK', etag)
+    assert upstream.fetched('/repodata/repomd.xml') == 2
+
+    # Changed upstream
+    upstream.files['/repodata/repomd.xml'] = '<repomd revision="2"/>'
+    age(path, 120)
+    with open(path + '.meta', 'rb') as f:
+        meta = json.load(f)
+    meta['validated'] -= 120
+    with open(path + '.meta', 'wb') as f:
+        json.dump(meta, f)
+    status, headers, data = request(app, '/m/repodata/repomd.xml', 'HEAD', HTTP_IF_NONE_MATCH=etag)
+    assert status == '200 OK'
+    assert headers['ETag'] != etag
+    assert headers['Content-Length'] == str(len('<repomd revision="2"/>'))
+    assert upstream.fetched('/repodata/repomd.xml') == 3
+
+    # The new copy was cached on the way
+    eventlet.sleep(0.1)
+    assert get(app, '/m/repodata/repomd.xml') == ('200 OK', '<repomd revision="2"/>')
+    assert upstream.fetched('/repodata/repomd.xml') == 3
+
+def test_stale_while_revalidate_refreshes_once(tmpdir, upstream):
+    upstream.files['/repodata/repomd.xml'] = '<repomd/>'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), freshness=[('*/repodata/*', 60)],
+        stale_while_revalidate=True)
+    path = str(tmpdir.join('m', 'repodata', 'repomd.xml'))
+    get(app, '/m/repodata/repomd.xml')
+    age(path, 120)
+
+    upstream.files['/repodata/repomd.xml'] = '<repomd revision="2"/>'
+    upstream.delay = 0.2
+    for _ in range(5):
+        assert get(app, '/m/repodata/repomd.xml') == ('200 OK', '<repomd/>')
+        eventlet.sleep(0.01)
+    eventlet.sleep(0.5)
+    assert upstream.fetched('/repodata/repomd.xml') == 2
+    assert not app._refreshing
+    assert get(app, '/m/repodata/repomd.xml') == ('200 OK', '<repomd revision="2"/>')
+
+def test_fresh_files_skip_upstream(tmpdir, upstream):
+    upstream.files['/repodata/repomd.xml'] = '<repomd/>'
+    upstream.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': upstream.url}, str(tmpdir), freshness=[('*/repodata/*', 60)])
+    for _ in range(2):
+        get(app, '/m/repodata/repomd.xml')
+        get(app, '/m/a.rpm')
+    age(str(tmpdir.join('m', 'a.rpm')), 3600)
+    get(app, '/m/a.rpm')
+    assert upstream.fetched('/repodata/repomd.xml') == upstream.fetched('/a.rpm') == 1
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(SparseFile, 'block_size', 1000)
+
+def test_ranges_complete_file(tmpdir, upstream, small_blocks):
+    data = os.urandom(2500)
+    upstream.files['/disc.iso'] = data
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+
+    assert get(app, '/m/disc.iso', 'bytes=1000-1499') == ('206 Partial Content', data[1000:1500])
+    assert sorted(os.listdir(str(tmpdir.join('m')))) == ['disc.iso.blocks', 'disc.iso.partial']
+    # Served from the block fetched already
+    assert get(app, '/m/disc.iso', 'bytes=1500-1999') == ('206 Partial Content', data[1500:2000])
+    assert upstream.fetched('/disc.iso') == 1
+
+    assert get(app, '/m/disc.iso', 'bytes=0-999') == ('206 Partial Content', data[:1000])
+    assert get(app, '/m/disc.iso', 'bytes=2000-2499') == ('206 Partial Content', data[2000:])
+    assert upstream.requests == [('/disc.iso', 'bytes=1000-1999'), ('/disc.iso', 'bytes=0-999'),
+        ('/disc.iso', 'bytes=2000-2499')]
+    assert sorted(os.listdir(str(tmpdir.join('m')))) == ['disc.iso', 'disc.iso.meta']
+    with open(str(tmpdir.join('m', 'disc.iso')), 'rb') as f:
+        assert f.read() == data
+    assert get(app, '/m/disc.iso') == ('200 OK', data)
+    assert upstream.fetched('/disc.iso') == 3
+
+def test_unread_range_releases_connection(tmpdir, upstream, small_blocks):
+    data = os.urandom(2500)
+    upstream.files['/disc.iso'] = data
+    app = HttpCache({'m': upstream.url}, str(tmpdir), connection_pool=ConnectionPool(max_per_host=1))
+
+    environ = {'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': '/m/disc.iso',
+        'HTTP_RANGE': 'bytes=1000-1499'}
+    app(environ, lambda line, headers: None).close()
+    with eventlet.Timeout(5):
+        assert get(app, '/m/disc.iso', 'bytes=0-999') == ('206 Partial Content', data[:1000])
+
+def test_range_outside_file(tmpdir, upstream, small_blocks):
+    upstream.files['/disc.iso'] = os.urandom(2500)
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+
+    assert get(app, '/m/disc.iso', 'bytes=5000-')[0].startswith('416')
+    get(app, '/m/disc.iso', 'bytes=0-99')
+    status, headers, data = request(app, '/m/disc.iso', HTTP_RANGE='bytes=2500-2600')
+    assert status.startswith('416')
+    assert headers['Content-Range'] == 'bytes */2500'
+    assert upstream.fetched('/disc.iso') == 2
+
+def test_ranges_completed_by_two_workers(tmpdir, upstream, small_blocks):
+    data = os.urandom(20000)
+    upstream.files['/disc.iso'] = data
+    first = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+    second = HttpCache({'m': upstream.url}, str(tmpdir), lock_files=True)
+
+    fetches = [eventlet.spawn(get, app, '/m/disc.iso', 'bytes=0-19999') for app in (first, second)]
+    for fetch in fetches:
+        assert fetch.wait() == ('206 Partial Content', data)
+    assert sorted(os.listdir(str(tmpdir.join('m')))) == ['disc.iso', 'disc.iso.meta']
+    assert not first._sparse_files and not second._sparse_files
+
+def test_ranges_resume_after_restart(tmpdir, upstream, small_blocks):
+    data = os.urandom(2500)
+    upstream.files['/disc.iso'] = data
+    app = HttpCache({'m': upstream.url}, str(tmpdir))
+    get(app, '/m/disc.iso', 'bytes=0-999')
+
+    restarted = HttpCache({'m': upstream.url}, str(tmpdir))
+    assert get(restarted, '/m/disc.iso', 'bytes=200-299') == ('206 Partial Content', data[200:300])
+    assert upstream.fetched('/disc.iso') == 1
+    assert get(restarted, '/m/disc.iso', 'bytes=900-') == ('206 Partial Content', data[900:])
+    assert upstream.requests[-1] == ('/disc.iso', 'bytes=1000-2499')
+    assert sorted(os.listdir(str(tmpdir.join('m')))) == ['disc.iso', 'disc.iso.meta']
+
+def yum_repo(upstream, repo, packages):
+    """
+    Serve packages, a dict of location -> content, as the yum repository at
+    path repo of upstream.
+    """
+    primary = StringIO()
+    with gzip.GzipFile(fileobj=primary, mode='wb') as f:
+        f.write('<metadata xmlns="http://linux.duke.edu/metadata/common" packages="%d">' % len(packages))
+        for href, data in sorted(packages.items()):
+            f.write('<package type="rpm"><checksum type="sha256" pkgid="YES">%s</checksum>'
+                '<location href="%s"/></package>' % (hashlib.sha256(data).hexdigest(), href))
+            upstream.files[repo + '/' + href] = data
+        f.write('</metadata>')
+    upstream.files[repo + '/repodata/primary.xml.gz'] = primary.getvalue()
+    upstream.files[repo + '/repodata/repomd.xml'] = ('<repomd xmlns="http://linux.duke.edu/metadata/repo">'
+        '<data type="primary"><location href="repodata/primary.xml.gz"/></data></repomd>')
+
+def test_warm(tmpdir, upstream):
+    yum_repo(upstream, '/os', {'Packages/a.rpm': 'package a', 'Packages/b.rpm': 'package b',
+        'Packages/c-debuginfo.rpm': 'debug symbols'})
+    cache_dir = str(tmpdir)
+    tmpdir.join('m', 'os', 'Packages', 'b.rpm').write('package b', ensure=True)
+
+    progress = []
+    results = httpcache.warm({'m': upstream.url}, cache_dir, '/m/os/', exclude=['*debuginfo*'],
+        progress=lambda *args: progress.append(args))
+    assert results == {'fetched': 1, 'present': 1, 'failed': 0}
+    assert [args[:2] for args in progress] == [(1, 2), (2, 2)]
+    assert sorted(args[2:] for args in progress) == [('/m/os/Packages/a.rpm', 'fetched'),
+        ('/m/os/Packages/b.rpm', 'present')]
+    assert tmpdir.join('m', 'os', 'Packages', 'a.rpm').read() == 'package a'
+    assert not tmpdir.join('m', 'os', 'Packages', 'c-debuginfo.rpm').exists()
+    assert upstream.fetched('/os/Packages/b.rpm') == 0
+
+    del upstream.files['/os/Packages/a.rpm']
+    os.unlink(str(tmpdir.join('m', 'os', 'Packages', 'a.rpm')))
+    results = httpcache.warm({'m': upstream.url}, cache_dir, ['/m/os'], include=['Packages/a.rpm'])
+    assert results == {'fetched': 0, 'present': 0, 'failed': 1}
+
+def test_blob_store_shares_identical_files(tmpdir, upstream):
+    upstream.files['/a.rpm'] = 'package'
+    blobs = BlobStore(str(tmpdir.join('.blobs')))
+    app = HttpCache({'m': upstream.url, 'n': upstream.url}, str(tmpdir), blob_store=blobs, max_size=10000)
+    get(app, '/m/a.rpm')
+    assert get(app, '/n/a.rpm') == ('200 OK', 'package')
+
+    first, second = str(tmpdir.join('m', 'a.rpm')), str(tmpdir.join('n', 'a.rpm'))
+    assert os.path.samefile(first, second)
+    assert os.path.samefile(first, blobs.blob_path(hashlib.sha256('package').hexdigest()))
+    assert app.quota.size == len('package')
+
+    # The blob goes with the last file linking to it
+    app.quota.max_bytes = 0
+    app.quota.evict(lambda path: False)
+    assert not os.path.exists(first) and not os.path.exists(second)
+    assert not os.listdir(os.path.dirname(blobs.blob_path(hashlib.sha256('package').hexdigest())))
+    app.stop()
+
+def test_warm_links_from_blob_store(tmpdir, upstream):
+    yum_repo(upstream, '/os', {'Packages/a.rpm': 'package a'})
+    blobs = BlobStore(str(tmpdir.join('.blobs')))
+    mirrors = {'m': upstream.url, 'n': upstream.url}
+    httpcache.warm(mirrors, str(tmpdir), '/m/os', blob_store=blobs)
+    assert httpcache.warm(mirrors, str(tmpdir), '/n/os', blob_store=blobs)['fetched'] == 1
+
+    assert upstream.fetched('/os/Packages/a.rpm') == 1
+    assert os.path.samefile(str(tmpdir.join('m', 'os', 'Packages', 'a.rpm')),
+        str(tmpdir.join('n', 'os', 'Packages', 'a.rpm')))
+
+def test_sweep_interrupted_fetches(tmpdir, upstream, monkeypatch):
+    upstream.files['/big.rpm'] = os.urandom(100000)
+    upstream.cut = 50000
+    app = HttpCache({'m': upstream.url}, str(tmpdir), read_size=4096, write_size=4096, index=True,
+        max_size=10 ** 6)
+    monkeypatch.setattr(httpcache.CacheFill, 'checkpoint_interval', 4096)
+    renamed = []
+    rename = os.rename
+    monkeypatch.setattr(os, 'rename', lambda src, dst: renamed.append(src) or rename(src, dst))
+    get(app, '/m/big.rpm')
+    eventlet.sleep(0.1)
+    assert sorted(os.listdir(str(tmpdir.join('m')))) == ['big.rpm.progress', 'big.rpm.tmp']
+    # Temp files of progress records are bookkeeping files as well
+    assert renamed and all(src.endswith(httpcache.INTERNAL_SUFFIXES) for src in renamed)
+
+    # Left by a worker that crashed writing a progress record
+    leftover = tmpdir.join('m', 'big.rpm.progress.tmp')
+    leftover.write('{"written": ')
+    app.index.scan()
+    app.quota._reconcile({})
+    assert app.index.get(str(leftover)) is None
+    assert str(leftover) not in app.quota._entries
+
+    assert app._sweep_partials() > 50000
+    app.partial_ttl = -1
+    app._sweep_partials()
+    assert os.listdir(str(tmpdir.join('m'))) == []
+    app.stop()
+
+def test_unknown_fsync_policy(tmpdir):
+    with pytest.raises(ValueError):
+        HttpCache({'m': 'http://127.0.0.1:1'}, str(tmpdir), fsync='always')
+
+@pytest.mark.parametrize('fsync, synced', [(None, []), ('file', ['file']), ('full', ['file', 'dir'])])
+def test_fsync(tmpdir, upstream, monkeypatch, fsync, synced):
+    upstream.files['/a.rpm'] = 'package'
+    calls = []
+    real_fsync = os.fsync
+    def fsync_call(fd):
+        calls.append('dir' if stat.S_ISDIR(os.fstat(fd).st_mode) else 'file')
+        real_fsync(fd)
+    monkeypatch.setattr(os, 'fsync', fsync_call)
+
+    app = HttpCache({'m': upstream.url}, str(tmpdir), fsync=fsync)
+    assert get(app, '/m/a.rpm') == ('200 OK', 'package')
+    eventlet.sleep(0.1)
+    assert calls == synced
+    assert tmpdir.join('m', 'a.rpm').read('rb') == 'package'
+
+def fallocate_unsupported(fd, mode, offset, length):
+    ctypes.set_errno(errno.EOPNOTSUPP)
+    return -1
+
+@pytest.mark.parametrize('fallocate_call', [None, fallocate_unsupported])
+def test_fallocate_unavailable(tmpdir, upstream, monkeypatch, fallocate_call):
+    data = os.urandom(100000)
+    upstream.files['/big.rpm'] = data
+    monkeypatch.setattr(httpcache, '_fallocate_call', fallocate_call)
+
+    with open(str(tmpdir.join('f')), 'wb') as f:
+        assert not httpcache._fallocate(f, 0, 1000)
+        assert os.fstat(f.fileno()).st_blocks == 0
+
+    app = HttpCache({'m': upstream.url}, str(tmpdir), read_size=4096, write_size=4096, fallocate=True)
+    assert get(app, '/m/big.rpm') == ('200 OK', data)
+    eventlet.sleep(0.1)
+    assert tmpdir.join('m', 'big.rpm').read('rb') == data
+
+def store_file(quota, cache_dir, name, size):
+    path = os.path.join(cache_dir, name)
+    with open(path, 'wb') as f:
+        f.write('x' * size)
+    quota.add(path, size)
+    return path
+
+def disk_use(cache_dir):
+    return sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir)
+        if not name.endswith(httpcache.INTERNAL_SUFFIXES))
+
+def test_quota_evicts_least_recently_used(tmpdir):
+    cache_dir = str(tmpdir)
+    quota = DiskQuota(cache_dir, 10000)
+    quota.scan()
+    paths = [store_file(quota, cache_dir, 'f%d' % i, 1000) for i in range(12)]
+    quota.touch(paths[0])
+    quota.evict(lambda path: False)
+
+    assert quota.size == disk_use(cache_dir) <= 10000 * quota.low_water
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+
+def test_quota_evicts_least_frequently_used(tmpdir):
+    cache_dir = str(tmpdir)
+    quota = DiskQuota(cache_dir, 10000, policy='lfu')
+    quota.scan()
+    paths = [store_file(quota, cache_dir, 'f%d' % i, 1000) for i in range(12)]
+    for path in paths[1:]:
+        quota.touch(path)
+    quota.evict(lambda path: False)
+
+    assert not os.path.exists(paths[0])
+    assert quota.size == disk_use(cache_dir) <= 10000 * quota.low_water
+
+def test_cache_keeps_quota(tmpdir, upstream):
+    for i in range(5):
+        upstream.files['/f%d.rpm' % i] = 'x' * 1000
+    app = HttpCache({'m': upstream.url}, str(tmpdir), max_size=3500)
+    for i in range(5):
+        get(app, '/m/f%d.rpm' % i)
+        eventlet.sleep(0.01)
+    get(app, '/m/f4.rpm')
+    eventlet.sleep(0.1)
+
+    cached = sorted(name for name in os.listdir(str(tmpdir.join('m'))) if name.endswith('.rpm'))
+    assert cached == ['f2.rpm', 'f3.rpm', 'f4.rpm']
+    assert app.quota.size == 3000
+    assert get(app, '/m/f0.rpm') == ('200 OK', 'x' * 1000)
+    assert upstream.fetched('/f0.rpm') == 2
+    app.stop()
+
+def test_quota_index(tmpdir):
+    cache_dir = str(tmpdir)
+    quota = DiskQuota(cache_dir, 10000)
+    quota.scan()
+    path = store_file(quota, cache_dir, 'f', 1000)
+    quota.touch(path)
+    quota.save()
+
+    reloaded = DiskQuota(cache_dir, 10000)
+    reloaded.scan()
+    assert reloaded.size == 1000
+    assert reloaded._entries[path][1] == 2
+
+def test_quota_shared(tmpdir):
+    cache_dir = str(tmpdir)
+    keeper = DiskQuota(cache_dir, 10000, shared=True)
+    keeper.scan()
+    other = DiskQuota(cache_dir, 10000, shared=True)
+    other.scan()
+    assert keeper.keeper and not other.keeper
+
+    for i in range(8):
+        store_file(keeper, cache_dir, 'a%d' % i, 1000)
+        store_file(other, cache_dir, 'b%d' % i, 1000)
+    other.save()
+    keeper._replay()
+    assert keeper.size == 16000
+
+    keeper.evict(lambda path: False)
+    assert keeper.size == disk_use(cache_dir) <= 10000
+
+    # Another worker takes over once the keeper is gone
+    keeper.close()
+    other.scan()
+    assert other.keeper
+    assert other.size == disk_use(cache_dir)
+
+def test_worker_shutdown_saves_quota(tmpdir, upstream):
+    cache_dir = str(tmpdir)
+    upstream.files['/a.rpm'] = 'package'
+    app = HttpCache({'m': upstream.url}, cache_dir, max_size=10000, lock_files=True)
+    get(app, '/m/a.rpm')
+    get(app, '/m/a.rpm')
+    assert app.quota.keeper
+
+    with pytest.raises(SystemExit):
+        httpcache._shutdown(eventlet.GreenPool(), eventlet.listen(('127.0.0.1', 0)), app)
+    assert not app._background
+
+    # The next worker takes over the quota with the hits counted so far
+    other = DiskQuota(cache_dir, 10000, shared=True)
+    other.scan()
+    assert other.keeper
+    assert other._entries[os.path.join(cache_dir, 'm', 'a.rpm')][1] == 2
+
+def test_start_shutdown_saves_quota(tmpdir, upstream):
+    cache_dir = str(tmpdir)
+    upstream.files['/a.rpm'] = 'package'
+    sock = eventlet.listen(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    shutdown = httpcache.start({'m': upstream.url}, cache_dir, port=port, max_size=10000, lock_files=True)
+    for _ in range(2):
+        assert urllib2.urlopen('http://127.0.0.1:%d/m/a.rpm' % port).read() == 'package'
+    shutdown()
+
+    other = DiskQuota(cache_dir, 10000, shared=True)
+    for _ in range(100):
+        other.scan()
+        if other.keeper:
+            break
+        eventlet.sleep(0.05)
+    assert other.keeper
+    assert other._entries[os.path.join(cache_dir, 'm', 'a.rpm')][1] == 2
+    with pytest.raises(IOError):
+        urllib2.urlopen('http://127.0.0.1:%d/m/a.rpm' % port)
+
+def test_quota_rescan(tmpdir):
+    cache_dir = str(tmpdir)
+    quota = DiskQuota(cache_dir, 10000)
+    quota.scan()
+    path = store_file(quota, cache_dir, 'f', 1000)
+    os.unlink(path)
+    with open(os.path.join(cache_dir, 'unreported'), 'wb') as f:
+        f.write('x' * 500)
+
+    quota._reconcile({})
+    assert quota.size == 500